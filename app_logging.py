@@ -0,0 +1,224 @@
+"""Logging that never blocks a request on disk or stdout.
+
+``configure_logging`` installs one handler on the root logger that only
+puts records on an in-memory queue. A background listener thread takes
+them off the queue and writes them to stderr and the optional log file,
+as JSON lines by default. Under gevent the listener runs on a real OS
+thread instead of a greenlet, so slow writes don't stall the hub either.
+
+Volume is bounded in three ways:
+
+- Records from ``sampled_loggers`` (the per-request retrieval steps) are
+  kept with the probability given for their level in ``sample_rates``,
+  e.g. ``{'DEBUG': 0.01, 'INFO': 0.1}``.
+- Records below WARNING beyond ``max_per_second`` are dropped.
+- When ``max_pending`` records are already waiting to be written, new ones
+  are dropped instead of queueing more memory.
+
+Warnings and errors are never sampled or rate limited. Dropped records are
+counted in ``cknbook_log_records_dropped_total`` on ``/metrics``.
+"""
+import _queue
+import _thread
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+import threading
+import time
+
+from metrics import LOG_RECORDS_DROPPED
+
+# Attributes every LogRecord has; anything else was passed with ``extra=``
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_STOP = object()
+
+
+def _native_thread_api():
+    """Return (start_new_thread, allocate_lock) that make real OS threads, even under gevent"""
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            return monkey.get_original('_thread', ['start_new_thread', 'allocate_lock'])
+    except ImportError:
+        pass
+    return _thread.start_new_thread, _thread.allocate_lock
+
+
+def parse_sample_rates(value):
+    """Parse ``"DEBUG=0.01,INFO=0.1"`` into ``{'DEBUG': 0.01, 'INFO': 0.1}``"""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            level, rate = item.split('=', 1)
+            rates[level.strip().upper()] = float(rate)
+    return rates
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, pid, plus any ``extra`` fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Samples verbose loggers per level and caps the rate of records below WARNING"""
+
+    def __init__(self, sampled_loggers=(), sample_rates=None, max_per_second=0):
+        super().__init__()
+        self.sampled_loggers = tuple(sampled_loggers)
+        self.sample_rates = dict(sample_rates or {})
+        self.max_per_second = max_per_second
+        self._tokens = float(max_per_second)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _is_sampled(self, name):
+        return any(name == prefix or name.startswith(prefix + '.') for prefix in self.sampled_loggers)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rates and self._is_sampled(record.name):
+            rate = self.sample_rates.get(record.levelname, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                LOG_RECORDS_DROPPED.labels('sampled').inc()
+                return False
+        if self.max_per_second > 0:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.max_per_second, self._tokens + (now - self._updated) * self.max_per_second)
+                self._updated = now
+                limited = self._tokens < 1
+                if not limited:
+                    self._tokens -= 1
+            if limited:
+                LOG_RECORDS_DROPPED.labels('rate_limited').inc()
+                return False
+        return True
+
+
+class LogPipeline:
+    """Bounded queue of log records written out by a background thread"""
+
+    def __init__(self, handlers, max_pending=10000):
+        self.handlers = list(handlers)
+        self.max_pending = max_pending
+        self._queue = _queue.SimpleQueue()
+        self._pid = None
+        self._stopped_pid = None
+        self._done = None
+        self._lock = threading.Lock()
+
+    def put_nowait(self, record):
+        """Queue a record for writing; drops it if too many are already waiting"""
+        if self._pid != os.getpid():
+            if self._stopped_pid == os.getpid():
+                # Shutting down: write directly rather than start another listener
+                self._write(record)
+                return
+            self.start()
+        if self._queue.qsize() >= self.max_pending:
+            LOG_RECORDS_DROPPED.labels('queue_full').inc()
+            return
+        self._queue.put(record)
+
+    def start(self):
+        # Started lazily so each forked worker gets its own listener thread
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            start_new_thread, allocate_lock = _native_thread_api()
+            self._queue = _queue.SimpleQueue()
+            self._done = allocate_lock()
+            self._done.acquire()
+            start_new_thread(self._run, (self._queue, self._done))
+            self._pid = os.getpid()
+
+    def _run(self, queue, done):
+        try:
+            while True:
+                record = queue.get()
+                if record is _STOP:
+                    break
+                self._write(record)
+        finally:
+            for handler in self.handlers:
+                handler.flush()
+            done.release()
+
+    def _write(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    handler.handleError(record)
+
+    def stop(self, timeout=2.0):
+        """Write out what is queued and stop the listener"""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        if self._done.acquire(timeout=timeout):
+            self._done.release()
+        self._stopped_pid, self._pid = self._pid, None
+
+
+class PipelineHandler(logging.handlers.QueueHandler):
+    """Hands records to a LogPipeline; the message and traceback are rendered in the caller"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(level='INFO', log_format='json', log_file=None, sampled_loggers=(),
+                      sample_rates=None, max_per_second=0, max_pending=10000):
+    """Route all logging through a background writer"""
+    formatter = JSONFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT)
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        outputs.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    pipeline = LogPipeline(outputs, max_pending=max_pending)
+    sampling = SamplingFilter(sampled_loggers, sample_rates, max_per_second)
+    handler = PipelineHandler(pipeline)
+    handler.addFilter(sampling)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    atexit.register(pipeline.stop)
@@ -0,0 +1,50 @@
+"""Concurrent fan-out for the batch endpoints.
+
+A batch request carries many independent items (posts from a chat export).
+Each request runs its items on its own pool of at most ``BATCH_WORKERS``
+threads, so a 50-item batch takes a few rounds of parallel model calls
+instead of 50 sequential ones, and its items never queue behind another
+request's batch and start after their deadline. The upstream governor still
+caps the model calls in flight across the whole worker. Each item succeeds
+or fails on its own; an item whose deadline passes before its turn fails
+without a model call and without counting against the circuit breaker.
+"""
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+
+# Items of one batch request run at the same time
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', '8'))
+
+
+def run_batch(items, fn, max_workers=BATCH_WORKERS):
+    """Call ``fn(item)`` for every item concurrently; returns (result, exception) pairs in input order"""
+    if not items:
+        return []
+    outcomes = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))), thread_name_prefix='batch') as executor:
+        # Each item gets a copy of the caller's context so request deadlines carry over
+        futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+        for future in futures:
+            try:
+                outcomes.append((future.result(), None))
+            except Exception as e:
+                logger.error(f"Batch item failed: {str(e)}")
+                outcomes.append((None, e))
+    return outcomes
+
+
+def batch_item(result, error=None, error_message=None):
+    """Render one item's outcome; generation functions report failures as "錯誤:" strings"""
+    if error is not None:
+        return {'error': error_message or f"錯誤: {str(error)}"}
+    if result is None:
+        return {'error': error_message or "錯誤: API 回應為空"}
+    if isinstance(result, str) and result.startswith('錯誤'):
+        return {'error': result}
+    return {'result': result}
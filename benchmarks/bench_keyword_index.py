@@ -0,0 +1,106 @@
+"""Benchmark chapter scoring: legacy substring scan vs. the inverted keyword index.
+
+Run from the repository root:
+
+    python benchmarks/bench_keyword_index.py
+
+The real 22-chapter corpus is padded with synthetic chapters (paragraphs
+shuffled from the real ones) to show how per-call latency grows with size.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('API_KEY', 'benchmark-no-network')
+
+import main  # noqa: E402
+from knowledge_store import parse_chapter  # noqa: E402
+
+QUERIES = [
+    '今天早餐吃了雞蛋和牛奶，補充蛋白質',
+    '必需氨基酸有幾種？',
+    '第3天講的保持年輕的竅門',
+    '我最近在吃維他命c和鈣片',
+    '今天天氣很好',
+]
+CORPUS_SIZES = [22, 220, 2200, 5000]
+# Total scoring calls per corpus size are scaled down as the corpus grows
+CALL_BUDGET = 2000
+
+
+def legacy_scores(chapters, relevant_topics):
+    """The original nested-loop scorer from find_relevant_knowledge"""
+    scores = {}
+    for position, chapter in enumerate(chapters):
+        content = chapter.content
+        score = 0
+        for topic in relevant_topics:
+            if topic in content:
+                score += 10
+            if topic == '氨基酸' and ('必需氨基酸' in content or '氨基酸種類' in content):
+                score += 20
+            if topic == '數字' and any(word in content for word in ['22種', '8種', '14種']):
+                score += 15
+            if topic == '天' and any(word in content for word in ['第3天', '第三天', '第三日']):
+                score += 15
+        for topic, topic_keywords in main.TOPIC_KEYWORDS.items():
+            for keyword in topic_keywords:
+                if keyword in content:
+                    score += 5
+        if score > 0:
+            scores[position] = score
+    return scores
+
+
+def detect_topics(user_input):
+    user_input_lower = user_input.lower()
+    topics = [topic for topic, topic_keywords in main.TOPIC_KEYWORDS.items()
+              if any(keyword.lower() in user_input_lower for keyword in topic_keywords)]
+    return topics or ['general']
+
+
+def synthetic_corpus(size, seed=0):
+    rng = random.Random(seed)
+    real = main.knowledge_store.chapters
+    paragraphs = [line for chapter in real for line in chapter.lines[1:] if line.strip()]
+    chapters = list(real)
+    while len(chapters) < size:
+        day = len(chapters) + 1
+        body = rng.sample(paragraphs, min(25, len(paragraphs)))
+        content = f"### 第{day}課：合成章節\n\n" + '\n\n'.join(body)
+        chapters.append(parse_chapter(f"第{day}天：合成章節.md", content))
+    return chapters[:size]
+
+
+def time_per_call(fn, topic_sets, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for topics in topic_sets:
+            fn(topics)
+    return (time.perf_counter() - start) / (repeat * len(topic_sets)) * 1000
+
+
+def main_benchmark():
+    topic_sets = [detect_topics(query) for query in QUERIES]
+    print(f"{'chapters':>8} {'build ms':>10} {'legacy ms/call':>15} {'index ms/call':>14} {'speedup':>8}")
+    for size in CORPUS_SIZES:
+        chapters = synthetic_corpus(size)
+
+        start = time.perf_counter()
+        index, base_scores = main.build_keyword_index(chapters)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        for topics in topic_sets:
+            indexed = {p: s for p, s in main.score_chapters(topics, index, base_scores).items() if s > 0}
+            assert indexed == legacy_scores(chapters, topics), f"score mismatch for {topics}"
+
+        repeat = max(1, CALL_BUDGET // size)
+        legacy_ms = time_per_call(lambda topics: legacy_scores(chapters, topics), topic_sets, repeat)
+        index_ms = time_per_call(lambda topics: main.score_chapters(topics, index, base_scores), topic_sets, repeat)
+        print(f"{size:>8} {build_ms:>10.1f} {legacy_ms:>15.3f} {index_ms:>14.3f} {legacy_ms / index_ms:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,88 @@
+"""Recall/latency of the keyword scorer, BM25 passages and semantic passages.
+
+Run from the repository root (requires numpy):
+
+    python benchmarks/bench_semantic.py
+
+Each query is a paraphrase of a chapter's topic labelled with the day that
+should be retrieved; recall@5 counts how often that day appears among the
+first five chapters (or the chapters of the first five passages).
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('API_KEY', 'benchmark-no-network')
+
+import main  # noqa: E402
+from knowledge_store import KnowledgeStore  # noqa: E402
+from retrieval import BM25Index  # noqa: E402
+from semantic_index import SemanticIndex  # noqa: E402
+
+LABELLED_QUERIES = [
+    ('早飯應該怎樣吃才會飽', 2),
+    ('肉蛋奶吃多少才夠身體用', 3),
+    ('怎樣可以延緩衰老，讓自己看起來更年輕', 3),
+    ('甜品吃太多對身體有什麼壞處', 5),
+    ('血脂偏高應該怎樣調整飲食', 10),
+    ('多吃橙和奇異果有什麼好處', 11),
+    ('多曬太陽對骨頭有幫助嗎', 12),
+    ('抗氧化的營養素保護細胞', 13),
+    ('缺鐵和缺碘會怎樣', 15),
+    ('鈉和鉀要怎樣平衡', 16),
+    ('維他命B1和菸鹼酸的作用', 9),
+    ('壓力大的時候要補充什麼', 7),
+    ('吃保健品和營養補充劑有用嗎', 18),
+]
+TOP_K = 5
+REPEAT = 50
+
+
+def keyword_chapters(query):
+    user_input_lower = query.lower()
+    topics = [topic for topic, topic_keywords in main.TOPIC_KEYWORDS.items()
+              if any(keyword.lower() in user_input_lower for keyword in topic_keywords)] or ['general']
+    scores = main.score_chapters(topics)
+    ranked = sorted(sorted(scores.items()), key=lambda item: item[1], reverse=True)
+    return [position for position, score in ranked[:TOP_K] if score > 0]
+
+
+def passage_chapters(store, index, query):
+    chapters = []
+    for position, _ in index.search(query, top_k=TOP_K):
+        chapter = store.chunks[position].chapter
+        if chapter is not None and chapter not in chapters:
+            chapters.append(chapter)
+    return chapters
+
+
+def evaluate(name, store, retrieve):
+    hits = 0
+    for query, day in LABELLED_QUERIES:
+        days = {store.chapters[position].day for position in retrieve(query)}
+        hits += day in days
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        for query, _ in LABELLED_QUERIES:
+            retrieve(query)
+    latency_ms = (time.perf_counter() - start) / (REPEAT * len(LABELLED_QUERIES)) * 1000
+    print(f"{name:<22} recall@{TOP_K} {hits / len(LABELLED_QUERIES):>5.0%}   {latency_ms:>7.3f} ms/query")
+
+
+def main_benchmark():
+    store = KnowledgeStore().load()
+    texts = [f"{chunk.title}\n{chunk.text}" for chunk in store.chunks]
+    bm25 = BM25Index(texts)
+
+    start = time.perf_counter()
+    semantic = SemanticIndex.build_or_load(texts)
+    print(f"semantic index ready in {(time.perf_counter() - start) * 1000:.1f} ms ({semantic.size} passages)\n")
+
+    evaluate('keyword scorer', store, keyword_chapters)
+    evaluate('BM25 passages', store, lambda query: passage_chapters(store, bm25, query))
+    evaluate('semantic passages', store, lambda query: passage_chapters(store, semantic, query))
+
+
+if __name__ == '__main__':
+    main_benchmark()
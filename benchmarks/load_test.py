@@ -0,0 +1,169 @@
+"""Concurrent-request throughput of gunicorn sync vs gevent workers.
+
+Run from the repository root (requires gunicorn and gevent):
+
+    python benchmarks/load_test.py [--requests 200] [--concurrency 200] [--latency 0.5]
+
+For each worker class a gunicorn server is started with gunicorn.conf.py and
+``/process`` is hit with ``--concurrency`` parallel clients. Each request has
+a unique paragraph, so the response cache never answers it. The Gemini model
+is replaced by one that sleeps ``--latency`` seconds and does no other work.
+That makes the upstream wait the only cost, which is what the worker class
+decides how to overlap.
+
+The same file is the WSGI module gunicorn loads (``load_test:app``).
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_CLASSES = ('sync', 'gevent')
+
+
+def load_app():
+    """Import main_production with the model replaced by a fixed-latency stand-in"""
+    import google.generativeai as genai
+
+    latency = float(os.environ['LOAD_TEST_LATENCY'])
+
+    class SimulatedResponse:
+        text = "選項1: 早餐要吃好\n選項2: 早餐要吃飽\n選項3: 早餐要有蛋白質"
+
+    class SimulatedModel:
+        def __init__(self, model_name, **kwargs):
+            self.model_name = model_name
+
+        def generate_content(self, contents, **kwargs):
+            # Under gevent this sleep is cooperative, like waiting on the real API socket
+            time.sleep(latency)
+            return SimulatedResponse()
+
+    genai.GenerativeModel = SimulatedModel
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    import main_production
+    if main_production.limiter:
+        main_production.limiter.enabled = False
+    return main_production.app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+def worker_rss_kb(master_pid):
+    """Resident memory of the master's worker processes, in KiB"""
+    try:
+        with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+            children = f.read().split()
+    except OSError:
+        return None
+    total = 0
+    for pid in children:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def post(port, number):
+    body = json.dumps({
+        'paragraph': f'今天早餐吃了兩隻雞蛋和一杯牛奶 {number}',
+        'tone': '溫暖',
+        'language': '廣東話',
+    }).encode('utf-8')
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}/process', data=body, headers={'Content-Type': 'application/json'}
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            ok = response.status == 200 and 'result' in json.loads(response.read())
+    except OSError:
+        ok = False
+    return ok, time.perf_counter() - started
+
+
+def run(worker_class, args):
+    port = free_port()
+    env = dict(os.environ, LOAD_TEST_LATENCY=str(args.latency), QUIZ_BANK_VARIANTS='0',
+               API_KEY=os.getenv('API_KEY', 'load-test-no-network'))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--worker-class', worker_class, '--bind', f'127.0.0.1:{port}',
+         '--access-logfile', os.devnull, '--error-logfile', os.devnull,
+         '--timeout', '300', '--pythonpath', os.path.dirname(os.path.abspath(__file__)), 'load_test:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_up(port)
+        idle_rss = worker_rss_kb(server.pid)
+        peak_rss = idle_rss
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(post, port, number) for number in range(args.requests)]
+            while not all(future.done() for future in futures):
+                rss = worker_rss_kb(server.pid)
+                if rss is not None and peak_rss is not None:
+                    peak_rss = max(peak_rss, rss)
+                time.sleep(0.1)
+            results = [future.result() for future in futures]
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(latency for ok, latency in results if ok)
+    failures = sum(1 for ok, _ in results if not ok)
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    memory = f"{idle_rss // 1024}->{peak_rss // 1024} MiB" if idle_rss is not None else "n/a"
+    print(f"{worker_class:<8}{elapsed:>9.2f}s{len(latencies) / elapsed:>10.1f}/s"
+          f"{statistics.median(latencies) if latencies else 0.0:>9.2f}s{p95:>9.2f}s{failures:>7}   {memory}")
+    return len(latencies) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.5, help="simulated model latency in seconds")
+    parser.add_argument('--worker-class', choices=WORKER_CLASSES, action='append')
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests, {args.concurrency} concurrent, {args.latency}s model latency, "
+          f"{os.getenv('GUNICORN_WORKERS', '2')} workers per server")
+    print(f"{'worker':<8}{'wall':>10}{'rate':>12}{'p50':>10}{'p95':>10}{'failed':>7}   worker RSS")
+    rates = {worker_class: run(worker_class, args) for worker_class in args.worker_class or WORKER_CLASSES}
+    if len(rates) == 2 and rates['sync']:
+        print(f"gevent throughput: {rates['gevent'] / rates['sync']:.1f}x sync")
+
+
+if __name__ == '__main__':
+    main()
+else:
+    app = load_app()
@@ -0,0 +1,237 @@
+"""Provider-side caching of long, unchanging prompt prefixes.
+
+A quiz prompt is the quiz instructions followed by the whole chapter, and
+the quiz bank sends it several times per chapter. ``ContextCache`` registers
+such a prefix with the provider once, as a cached context. Later calls
+reference the context and send only the text after it, so they are billed
+and prefilled for that text alone.
+
+Providers:
+
+- GeminiContextProvider: Gemini API cached contents. Needs
+  google-generativeai 0.7 or later (``google.generativeai.caching``).
+- LocalContextProvider: an offline stand-in that keeps contexts in memory
+  and prepends them to the call itself. It runs the same code path and
+  metrics without an API key, for example against a fake model.
+
+Prefixes shorter than ``min_chars`` are sent inline without asking the
+provider anything. Longer ones are counted with the provider's tokenizer
+once, and only prefixes of at least ``min_tokens`` tokens are cached: the
+API refuses contexts below a per-model minimum (1,024 to 4,096 tokens for
+the 2.5 models, 32,768 for 1.5), and small prefixes gain little. Contexts
+expire on the provider after ``ttl_seconds`` and are recreated shortly
+before that. With a shared cache backend (Redis), context names are
+published there, so all workers use one context per prefix instead of each
+creating its own.
+
+Cost: cached contents are billed. Creating a context costs its tokens as
+input once, and it is then charged for storage per token-hour until it
+expires, whether or not it is used; calls that reference it pay a reduced
+rate for the cached tokens. Without Redis every worker creates and keeps its
+own copy of each context. Caching therefore only pays off for prefixes sent
+many times per TTL, which is why it is off unless ``CONTEXT_CACHE`` enables
+it.
+"""
+import datetime
+import json
+import logging
+import threading
+import time
+import uuid
+
+import google.generativeai as genai
+
+from metrics import count_cache
+from response_cache import make_cache_key
+from single_flight import SingleFlight
+
+try:
+    from google.generativeai import caching as genai_caching
+    GEMINI_CACHING_AVAILABLE = True
+except ImportError:
+    GEMINI_CACHING_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# Seconds to send a prefix inline after creating its context failed
+FAILURE_BACKOFF = 300
+
+# Enough for every current Gemini model's minimum cached content size
+DEFAULT_MIN_TOKENS = 4096
+
+
+class GeminiContextProvider:
+    """Cached contents on the Gemini API"""
+
+    name = 'gemini'
+
+    def count_tokens(self, model_name, text):
+        return genai.GenerativeModel(model_name).count_tokens(text).total_tokens
+
+    def create(self, model_name, text, ttl_seconds):
+        return genai_caching.CachedContent.create(
+            model=model_name, contents=[text], ttl=datetime.timedelta(seconds=ttl_seconds)
+        )
+
+    def restore(self, name):
+        return genai_caching.CachedContent.get(name)
+
+    def model(self, context, base_model, generation_config=None):
+        model = genai.GenerativeModel.from_cached_content(context, generation_config=generation_config)
+        # Reuse the pooled model's client (and gRPC channel)
+        model._client = getattr(base_model, '_client', None)
+        return model
+
+
+class _LocalContext:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+
+
+class _LocalContextModel:
+    """Model bound to a local context: prepends the context text to each call"""
+
+    def __init__(self, context, model):
+        self.context = context
+        self.model = model
+
+    def generate_content(self, contents, **kwargs):
+        if isinstance(contents, str):
+            contents = self.context.text + contents
+        else:
+            contents = [self.context.text + contents[0], *contents[1:]]
+        return self.model.generate_content(contents, **kwargs)
+
+
+class LocalContextProvider:
+    """In-memory stand-in for provider-side context caching"""
+
+    name = 'local'
+
+    def __init__(self):
+        self._contexts = {}
+
+    def count_tokens(self, model_name, text):
+        # Rough: about one token per character of Chinese text
+        return len(text)
+
+    def create(self, model_name, text, ttl_seconds):
+        context = _LocalContext(f"cachedContents/local-{uuid.uuid4().hex}", text)
+        self._contexts[context.name] = context
+        return context
+
+    def restore(self, name):
+        # Contexts live in one process; another worker's name can't be restored
+        return self._contexts.get(name)
+
+    def model(self, context, base_model, generation_config=None):
+        return _LocalContextModel(context, base_model)
+
+
+def create_context_provider(mode='off'):
+    """Pick a provider: 'off', 'gemini', 'local', or 'auto' (Gemini when the SDK supports it)"""
+    if mode == 'local':
+        return LocalContextProvider()
+    if mode in ('auto', 'gemini'):
+        if GEMINI_CACHING_AVAILABLE:
+            return GeminiContextProvider()
+        if mode == 'gemini':
+            logger.warning("Context caching needs google-generativeai>=0.7, sending prompts inline")
+    return None
+
+
+class ContextCache:
+    """Cached contexts for prompt prefixes, created on first use and shared by later calls"""
+
+    def __init__(self, provider, backend=None, min_chars=1500, min_tokens=DEFAULT_MIN_TOKENS,
+                 ttl_seconds=3600, refresh_margin=120):
+        self.provider = provider
+        self.backend = backend if backend is not None and backend.shared else None
+        self.min_chars = min_chars
+        self.min_tokens = min_tokens
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self._entries = {}
+        self._failed = {}
+        # Keys of prefixes counted below min_tokens; their text never changes
+        self._too_small = set()
+        self._lock = threading.Lock()
+        self._creating = SingleFlight(self.backend, lock_ttl=30)
+
+    def get(self, model_name, prompt, context_length):
+        """Return the cached context for ``prompt[:context_length]``, or None to send it inline"""
+        if self.provider is None or context_length < self.min_chars:
+            return None
+        text = prompt[:context_length]
+        key = f"context:{make_cache_key(model_name, text)}"
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and (key in self._too_small or self._failed.get(key, 0) > now):
+                return None
+        if entry is not None and entry[1] > now:
+            count_cache('context', True)
+            return entry[0]
+        count_cache('context', False)
+        entry = self._creating.do(key, lambda: self._create(key, model_name, text),
+                                  lookup=lambda: self._restore(key))
+        return entry[0] if entry is not None else None
+
+    def model(self, context, base_model, generation_config=None):
+        """Return a model that sends ``context`` by reference"""
+        return self.provider.model(context, base_model, generation_config)
+
+    def _restore(self, key):
+        """Pick up a context another worker published for ``key``"""
+        if self.backend is None:
+            return None
+        published = self.backend.get(key)
+        if not published:
+            return None
+        published = json.loads(published)
+        if published['expires'] <= time.time():
+            return None
+        try:
+            context = self.provider.restore(published['name'])
+        except Exception as e:
+            logger.warning(f"Could not restore cached context {published['name']}: {str(e)}")
+            return None
+        if context is None:
+            return None
+        entry = (context, published['expires'])
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def _create(self, key, model_name, text):
+        entry = self._restore(key)
+        if entry is not None:
+            return entry
+        try:
+            tokens = self.provider.count_tokens(model_name, text)
+            if tokens < self.min_tokens:
+                logger.info(f"Prompt prefix has {tokens} tokens, under the {self.min_tokens} needed "
+                            f"for a cached context; sending it inline")
+                with self._lock:
+                    self._too_small.add(key)
+                return None
+            context = self.provider.create(model_name, text, self.ttl_seconds)
+        except Exception as e:
+            logger.warning(f"Creating a cached context failed, sending the prefix inline: {str(e)}")
+            with self._lock:
+                self._failed[key] = time.time() + FAILURE_BACKOFF
+            return None
+
+        now = time.time()
+        # Stop using the context a little before the provider drops it
+        expires = now + self.ttl_seconds - self.refresh_margin
+        with self._lock:
+            self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+            self._entries[key] = (context, expires)
+            self._failed.pop(key, None)
+        if self.backend is not None:
+            self.backend.set(key, json.dumps({'name': context.name, 'expires': expires}),
+                             int(expires - now))
+        logger.info(f"Created cached context {context.name} ({len(text)} characters, {model_name})")
+        return (context, expires)
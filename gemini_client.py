@@ -0,0 +1,298 @@
+"""Shared entry point for Gemini generation calls.
+
+Every generation function goes through ``generate_text`` (or
+``stream_text`` for incremental output) so cross-cutting behaviour
+(response caching, request coalescing, pooled model clients, cached
+prompt contexts, admission control, retries, deadlines and hedging) lives
+in one place.
+"""
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import google.generativeai as genai
+import grpc
+from google.api_core import exceptions as api_exceptions
+from google.generativeai import client as genai_client
+from google.generativeai.types import generation_types
+
+from context_cache import ContextCache, create_context_provider
+from hedging import Hedger
+from metrics import count_cache, count_tokens, gemini_call
+from response_cache import create_cache_backend, make_cache_key
+from single_flight import SingleFlight
+from upstream_governor import DeadlinePassed, UpstreamGovernor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'gemini-2.5-flash'
+
+# Identical prompts (same chapter quiz, same paragraph and tone) are served from
+# here; with REDIS_URL set the cache is shared by every worker and instance
+response_cache = create_cache_backend(
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '512')),
+    ttl_seconds=int(os.getenv('RESPONSE_CACHE_TTL', '3600')),
+    prefix='cknbook:response:'
+)
+
+# Identical cacheable calls in flight at the same time share one API call; the
+# cache backend also carries the cross-worker lock when it is shared (Redis)
+single_flight = SingleFlight(
+    response_cache,
+    lock_ttl=int(os.getenv('SINGLE_FLIGHT_LOCK_TTL', '60'))
+)
+
+# Per-worker concurrency cap, rate limit, retry policy and circuit breaker in
+# front of every API call (GEMINI_RATE_PER_SECOND=0 leaves the rate unlimited)
+governor = UpstreamGovernor(
+    max_concurrency=int(os.getenv('GEMINI_MAX_CONCURRENCY', '32')),
+    rate=float(os.getenv('GEMINI_RATE_PER_SECOND', '0')),
+    burst=int(os.getenv('GEMINI_RATE_BURST', '10')),
+    queue_timeout=float(os.getenv('GEMINI_QUEUE_TIMEOUT', '10')),
+    max_retries=int(os.getenv('GEMINI_MAX_RETRIES', '2')),
+    failure_threshold=int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5')),
+    reset_timeout=float(os.getenv('GEMINI_BREAKER_RESET', '30'))
+)
+
+# Optional backup call when a completion is slower than the recent
+# GEMINI_HEDGE_PERCENTILE latency (costs an extra API call when it fires)
+hedger = Hedger(
+    percentile=float(os.getenv('GEMINI_HEDGE_PERCENTILE', '95')),
+    min_delay=float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '2'))
+) if os.getenv('GEMINI_HEDGING', '0') == '1' else None
+
+# time.monotonic() deadline of the request being served, see request_deadline()
+_request_deadline = contextvars.ContextVar('gemini_request_deadline', default=None)
+
+# Clients (gRPC channels) kept per model and generation config; each channel
+# multiplexes many concurrent calls, more spread the load of a busy worker
+GEMINI_CLIENT_POOL_SIZE = int(os.getenv('GEMINI_CLIENT_POOL_SIZE', '4'))
+
+
+class ModelRegistry:
+    """Long-lived GenerativeModel instances shared by every request.
+
+    Models are keyed by name and generation config. Each key holds
+    ``pool_size`` models, each bound to its own GenerativeServiceClient and
+    therefore its own gRPC channel; ``get`` rotates across them. Channels do
+    not survive a fork, so the pools are rebuilt in each new process.
+    """
+
+    def __init__(self, pool_size=GEMINI_CLIENT_POOL_SIZE):
+        self.pool_size = max(1, pool_size)
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, model_name=DEFAULT_MODEL, generation_config=None):
+        """Return a pooled model for this name and generation config"""
+        key = (model_name, json.dumps(generation_config, sort_keys=True) if generation_config else None)
+        pool = self._pools.get(key) if self._pid == os.getpid() else None
+        if pool is None:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pools = {}
+                    self._pid = os.getpid()
+                pool = self._pools.get(key)
+                if pool is None:
+                    models = [self._create(model_name, generation_config) for _ in range(self.pool_size)]
+                    pool = (models, itertools.count())
+                    self._pools[key] = pool
+                    logger.info(f"Created {len(models)} pooled clients for {model_name}")
+        models, turn = pool
+        return models[next(turn) % len(models)]
+
+    def _create(self, model_name, generation_config):
+        model = genai.GenerativeModel(model_name, generation_config=generation_config)
+        # google-generativeai binds every model to the one default client; give
+        # each pooled model its own client so calls spread across channels
+        if self.pool_size > 1 and hasattr(model, '_client'):
+            model._client = genai_client._client_manager.make_client('generative')
+        return model
+
+
+model_registry = ModelRegistry()
+
+# Long repeated prompt prefixes (a Prompt's context_length, e.g. quiz instructions
+# plus the chapter) are registered once as provider-side cached contexts and
+# referenced afterwards. Off by default because cached contexts are billed for
+# storage; CONTEXT_CACHE=local uses an in-memory stand-in offline
+context_cache = ContextCache(
+    create_context_provider(os.getenv('CONTEXT_CACHE', 'off')),
+    backend=response_cache,
+    min_chars=int(os.getenv('CONTEXT_CACHE_MIN_CHARS', '1500')),
+    min_tokens=int(os.getenv('CONTEXT_CACHE_MIN_TOKENS', '4096')),
+    ttl_seconds=int(os.getenv('CONTEXT_CACHE_TTL', '3600'))
+)
+
+
+@contextmanager
+def request_deadline(seconds):
+    """Make every model call inside the block finish within ``seconds`` from now.
+
+    The remaining time is sent with each RPC as its gRPC deadline and also
+    bounds queueing, retries and hedging. Nested deadlines keep the earlier one.
+    """
+    deadline = time.monotonic() + seconds
+    current = _request_deadline.get()
+    token = _request_deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
+
+def _cache_key(model_name, prompt, image, generation_config):
+    config = json.dumps(generation_config, sort_keys=True) if generation_config else None
+    return make_cache_key(model_name, prompt, image, config)
+
+
+def generate_text(prompt, image=None, model_name=DEFAULT_MODEL, use_cache=True, generation_config=None):
+    """Generate a completion for ``prompt`` (and optional image part) and return its text.
+
+    Non-empty responses are cached under a hash of the model name, prompt,
+    image and generation config, so a repeated request is answered without
+    calling the API. Concurrent cache misses for the same key wait on a
+    single call. ``use_cache=False`` skips both and always calls the model.
+
+    When ``prompt`` is a ``Prompt`` whose repeated leading part is long
+    enough, that part is sent by reference as a cached context.
+    """
+    if not use_cache:
+        return _generate(prompt, image, model_name, generation_config)
+
+    key = _cache_key(model_name, prompt, image, generation_config)
+    cached = response_cache.get(key)
+    count_cache('response', cached is not None)
+    if cached is not None:
+        logger.info(f"Response cache hit ({model_name})")
+        return cached
+
+    def generate_and_cache():
+        text = _generate(prompt, image, model_name, generation_config)
+        if text:
+            response_cache.set(key, text)
+        return text
+
+    return single_flight.do(key, generate_and_cache, lookup=lambda: response_cache.get(key))
+
+
+def _with_context(prompt, model_name):
+    """Split off the prompt's cached context, if it has one: returns (context, rest of prompt)"""
+    context_length = getattr(prompt, 'context_length', 0)
+    context = context_cache.get(model_name, prompt, context_length) if context_length else None
+    if context is None:
+        return None, prompt
+    return context, prompt[context_length:]
+
+
+def _model(model_name, generation_config, context=None):
+    # Each call (including a hedge) takes the next pooled client
+    model = model_registry.get(model_name, generation_config)
+    if context is not None:
+        model = context_cache.model(context, model, generation_config)
+    return model
+
+
+def _generate(prompt, image, model_name, generation_config):
+    context, text = _with_context(prompt, model_name)
+    contents = [text, image] if image else text
+    deadline = _request_deadline.get()
+
+    def attempt(cancel=None):
+        model = _model(model_name, generation_config, context)
+        return governor.call(lambda: _call(prompt, model, contents, deadline, cancel), deadline=deadline)
+
+    if hedger is not None:
+        return hedger.call(attempt, deadline)
+    return attempt()
+
+
+def _call(prompt, model, contents, deadline=None, cancel=None):
+    """One timed upstream call for ``prompt``: returns the text and counts the tokens used"""
+    with gemini_call(prompt):
+        response = _invoke(model, contents, deadline, cancel)
+        text = response.text
+    count_tokens(prompt, response)
+    return text
+
+
+def _invoke(model, contents, deadline=None, cancel=None):
+    """Make one generate_content call that honours ``deadline`` and can be cancelled; returns the response"""
+    timeout = None
+    if deadline is not None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise DeadlinePassed("Request deadline passed before the Gemini call")
+
+    prepare = getattr(model, '_prepare_request', None)
+    if cancel is None or prepare is None:
+        # The remaining time is sent as the RPC deadline
+        if timeout is None:
+            return model.generate_content(contents)
+        return model.generate_content(contents, request_options={'timeout': timeout})
+
+    # A hedged attempt must be cancellable once the other one wins, which
+    # generate_content doesn't allow: build its request the same way and start
+    # the RPC as a gRPC future
+    request = prepare(contents=contents, generation_config=None, safety_settings=None, tools=None, tool_config=None)
+    if request.contents and not request.contents[-1].role:
+        request.contents[-1].role = 'user'
+    if model._client is None:
+        model._client = genai_client.get_default_generative_client()
+    rpc = getattr(getattr(model._client, '_transport', None), 'generate_content', None)
+    if hasattr(rpc, 'future'):
+        call = rpc.future(request, timeout=timeout, metadata=[('x-goog-request-params', f'model={request.model}')])
+        cancel.on_cancel(call.cancel)
+        try:
+            response = call.result()
+        except grpc.FutureCancelledError:
+            raise api_exceptions.Cancelled("Gemini call cancelled")
+        except grpc.RpcError as e:
+            raise api_exceptions.from_grpc_error(e) from e
+    else:
+        # REST transport: the deadline still applies, but the call can't be cancelled
+        response = model._client.generate_content(request, timeout=timeout)
+    return generation_types.GenerateContentResponse.from_response(response)
+
+
+def stream_text(prompt, image=None, model_name=DEFAULT_MODEL, use_cache=True, generation_config=None):
+    """Yield the completion for ``prompt`` piece by piece as the model produces it.
+
+    A cached response is yielded in one piece. Otherwise the model is called
+    in streaming mode and the joined text is cached once the stream has been
+    read to the end, so a later ``generate_text`` call for the same prompt hits.
+    """
+    key = _cache_key(model_name, prompt, image, generation_config)
+    if use_cache:
+        cached = response_cache.get(key)
+        count_cache('response', cached is not None)
+        if cached is not None:
+            logger.info(f"Response cache hit ({model_name})")
+            yield cached
+            return
+
+    context, text = _with_context(prompt, model_name)
+    model = _model(model_name, generation_config, context)
+    contents = [text, image] if image else text
+    pieces = []
+    chunk = None
+    # A stream holds its slot until it ends; it is not retried once output has been sent
+    with governor.admit(), gemini_call(prompt):
+        for chunk in model.generate_content(contents, stream=True):
+            text = chunk.text
+            if text:
+                pieces.append(text)
+                yield text
+    if chunk is not None:
+        # The last chunk carries the totals
+        count_tokens(prompt, chunk)
+
+    text = ''.join(pieces)
+    if text and use_cache:
+        response_cache.set(key, text)
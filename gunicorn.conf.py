@@ -7,9 +7,15 @@ bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
 backlog = 2048
 
 # Worker processes
-workers = 2
-worker_class = "sync"
-worker_connections = 1000
+# Requests spend nearly all their time waiting on the Gemini API, so each
+# worker runs them as gevent greenlets: one process holds up to
+# worker_connections requests in flight instead of one. Set
+# GUNICORN_WORKER_CLASS=sync to fall back to one request per worker.
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+# Async workers keep heartbeating while requests wait, so this only
+# catches hung workers rather than slow or streaming generations
 timeout = 30
 keepalive = 2
 
@@ -23,6 +29,9 @@ errorlog = "error.log"
 loglevel = "info"
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
 
+# Metrics: each worker writes its samples here and /metrics sums them (see metrics.py)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/cknbook-metrics')
+
 # Process naming
 proc_name = "tone_toner"
 
@@ -31,3 +40,33 @@ limit_request_line = 4094
 limit_request_fields = 100
 limit_request_field_size = 8190
 
+
+
+def on_starting(server):
+    """Clear the previous run's metric samples before any worker starts"""
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith('.db'):
+            os.unlink(os.path.join(directory, name))
+
+
+def child_exit(server, worker):
+    """Stop counting an exited (or recycled) worker's in-flight gauge"""
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    """Make gRPC (used by google-generativeai) cooperate with gevent.
+
+    Runs after the worker has monkey-patched the standard library and before
+    it serves a request, i.e. before any gRPC channel is created.
+    """
+    if worker_class != 'gevent':
+        return
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
@@ -0,0 +1,143 @@
+"""Hedged model calls: send a backup when the first attempt is unusually slow.
+
+Most completions finish in a few seconds, but an occasional one takes far
+longer and dominates the tail latency. ``Hedger.call`` starts one attempt.
+If it hasn't answered after the ``percentile`` latency of recent successful
+attempts, a second identical attempt is started. The first success wins,
+and the other attempt is cancelled through its ``CancelToken``.
+
+A backup costs an extra API call, so hedging is opt-in and is never sent
+when the deadline leaves no time for it. To estimate the time saved when
+a backup wins, the recent latencies above the primary's age at that moment
+are averaged. Calls, backups, backup wins and the time saved are exported
+as Prometheus counters (see metrics.py).
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from google.api_core import exceptions as api_exceptions
+
+from metrics import HEDGE_BACKUP_WINS, HEDGE_CALLS, HEDGE_SAVED_SECONDS, HEDGES_SENT
+
+logger = logging.getLogger(__name__)
+
+
+class CancelToken:
+    """Lets the winner of a hedged call abort the other attempt's in-flight RPC"""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        """Register ``callback``; it runs immediately if the token is already cancelled"""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class Hedger:
+    """Issue a backup attempt when the first one is slower than the recent latency percentile"""
+
+    def __init__(self, percentile=95, min_delay=2.0, window=200, min_samples=20, max_workers=64):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gemini-hedge')
+
+    def hedge_delay(self):
+        """Seconds to wait before sending the backup; min_delay until enough samples exist"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.min_delay
+            ordered = sorted(self._latencies)
+        position = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[position])
+
+    def _record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _estimated_remaining(self, age):
+        """Average extra time recent attempts slower than ``age`` took beyond it"""
+        with self._lock:
+            ordered = sorted(self._latencies)
+        slower = ordered[bisect.bisect_right(ordered, age):]
+        return (sum(slower) / len(slower) - age) if slower else 0.0
+
+    def _timed(self, attempt, token):
+        started = time.monotonic()
+        result = attempt(token)
+        return result, time.monotonic() - started
+
+    def call(self, attempt, deadline=None):
+        """Return ``attempt(token)``, hedging with a second attempt if the first is slow.
+
+        ``deadline`` is a ``time.monotonic()`` value after which waiting stops
+        with DeadlineExceeded; attempts are expected to honour it themselves.
+        """
+        started = time.monotonic()
+        if deadline is not None and started >= deadline:
+            # Nothing to hedge; the attempt reports the passed deadline itself
+            return attempt(CancelToken())
+        HEDGE_CALLS.inc()
+        tokens = [CancelToken()]
+        futures = [self._executor.submit(self._timed, attempt, tokens[0])]
+
+        delay = self.hedge_delay()
+        if deadline is not None:
+            delay = min(delay, max(0.0, deadline - started))
+        done, _ = wait(futures, timeout=delay)
+        # A backup only helps if it has at least as long as the hedge delay to answer
+        if not done and (deadline is None or deadline - time.monotonic() > delay):
+            tokens.append(CancelToken())
+            futures.append(self._executor.submit(self._timed, attempt, tokens[1]))
+            HEDGES_SENT.inc()
+            logger.info(f"Hedging Gemini call after {delay:.2f}s")
+
+        pending = set(futures)
+        first_error = None
+        while pending:
+            timeout = None if deadline is None else deadline - time.monotonic()
+            if timeout is not None and timeout <= 0:
+                break
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    first_error = first_error or future.exception()
+                    continue
+                winner = futures.index(future)
+                for index, token in enumerate(tokens):
+                    if index != winner:
+                        token.cancel()
+                result, latency = future.result()
+                if winner == 1:
+                    age = time.monotonic() - started
+                    HEDGE_BACKUP_WINS.inc()
+                    HEDGE_SAVED_SECONDS.inc(max(0.0, self._estimated_remaining(age)))
+                self._record(latency)
+                return result
+
+        for token in tokens:
+            token.cancel()
+        if first_error is not None:
+            raise first_error
+        raise api_exceptions.DeadlineExceeded("Gemini call did not finish before the request deadline")
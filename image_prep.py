@@ -0,0 +1,250 @@
+"""Shrink uploaded photos before they are sent to Gemini.
+
+Phone photos of meals are often 4-12 MB and 4000 px or more on a side. The
+model only needs a fraction of that resolution, so sending the original
+wastes upload time and adds latency on every image reply. ``prepare_image``
+takes an image part and does the following:
+
+1. Sniffs the real format from the file's magic bytes, so PNG, WebP or HEIC
+   uploads are no longer labelled ``image/jpeg``.
+2. Passes the image through unchanged if it is already a supported format
+   within ``max_side`` pixels and ``max_bytes``.
+3. Otherwise, in a worker process, applies the EXIF orientation, downscales
+   to ``max_side``, flattens any transparency, and re-encodes as JPEG. The
+   quality is lowered step by step until the result fits ``max_bytes``.
+
+Decoding and resizing a large photo is CPU-bound. In a gevent worker it
+would stall every other request, so the work runs in a small process pool.
+The pool is forked on first use in each worker, and its children only run
+Pillow code. Image bytes are handed over through scratch files (tmpfs when
+available) and only the paths go through the pool's pipes. Pipe writes are
+not cooperative under gevent, so a multi-megabyte pickle would block the
+whole worker. If Pillow is missing or the image can't be processed, the
+original is sent with its sniffed type.
+
+A normalization that times out keeps running in its child, which still
+writes its output; its scratch files are removed when it finishes. When
+every pool slot has timed out in a row, the pool is assumed stuck and its
+processes are killed and replaced.
+"""
+import base64
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import IMAGE_PREP, IMAGE_PREP_BYTES
+
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    # Optional: lets Pillow decode HEIC/HEIF photos from iPhones
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '1536'))
+IMAGE_TARGET_BYTES = int(os.getenv('IMAGE_TARGET_BYTES', str(1024 * 1024)))
+IMAGE_PREP_WORKERS = int(os.getenv('IMAGE_PREP_WORKERS', '2'))
+IMAGE_PREP_TIMEOUT = float(os.getenv('IMAGE_PREP_TIMEOUT', '10'))
+
+# Formats Gemini accepts as inline image data
+SUPPORTED_MIME_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif'}
+
+JPEG_QUALITIES = (85, 75, 65, 50)
+
+# Scratch files for the worker processes: memory-backed where /dev/shm exists
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def sniff_mime_type(data):
+    """Return the image MIME type from the file's magic bytes, or None if unrecognised"""
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[4:8] == b'ftyp':
+        brand = data[8:12]
+        if brand in (b'heic', b'heix', b'heim', b'heis'):
+            return 'image/heic'
+        if brand in (b'mif1', b'msf1', b'heif'):
+            return 'image/heif'
+        if brand == b'avif':
+            return 'image/avif'
+    if data[:2] == b'BM':
+        return 'image/bmp'
+    return None
+
+
+def normalize_image(data, max_side=IMAGE_MAX_SIDE, max_bytes=IMAGE_TARGET_BYTES):
+    """Downscale and re-encode an image as JPEG of at most ``max_bytes`` if possible; returns the bytes"""
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG decodes straight at a reduced scale, far cheaper than a full decode
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P', 'PA'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        for quality in JPEG_QUALITIES:
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=quality, optimize=True)
+            if output.tell() <= max_bytes:
+                break
+        return output.getvalue()
+
+
+def normalize_image_file(path, max_side=IMAGE_MAX_SIDE, max_bytes=IMAGE_TARGET_BYTES):
+    """Pool entry point: normalize the image in ``path`` and write the result to ``path + '.jpg'``"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    output_path = path + '.jpg'
+    with open(output_path, 'wb') as f:
+        f.write(normalize_image(data, max_side, max_bytes))
+    return output_path
+
+
+def _remove_scratch_files(path):
+    for leftover in (path, path + '.jpg'):
+        try:
+            os.unlink(leftover)
+        except FileNotFoundError:
+            pass
+
+
+class ImagePreprocessor:
+    """Runs ``normalize_image`` on a per-worker process pool when an upload needs it"""
+
+    def __init__(self, max_side=IMAGE_MAX_SIDE, max_bytes=IMAGE_TARGET_BYTES,
+                 max_workers=IMAGE_PREP_WORKERS, timeout=IMAGE_PREP_TIMEOUT):
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = None
+        self._pid = None
+        self._timeouts = 0
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked children only run Pillow code, never the parent's gRPC channels
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork')
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _reset_pool(self, executor, terminate=False):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._pid = None
+                self._timeouts = 0
+        # shutdown() doesn't stop running tasks; a stuck child has to be killed
+        processes = list((executor._processes or {}).values()) if terminate else []
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _timed_out(self, executor):
+        """Record a timeout; recycle the pool once every slot has timed out in a row"""
+        with self._lock:
+            self._timeouts += 1
+            stuck = self._executor is executor and self._timeouts >= self.max_workers
+        if stuck:
+            logger.error(f"Image normalization timed out {self.max_workers} times in a row, recycling the pool")
+            self._reset_pool(executor, terminate=True)
+
+    def _count(self, result, data_in, data_out):
+        IMAGE_PREP.labels(result).inc()
+        IMAGE_PREP_BYTES.labels('in').inc(len(data_in))
+        IMAGE_PREP_BYTES.labels('out').inc(len(data_out))
+
+    def _needs_normalizing(self, data, mime_type):
+        if mime_type not in SUPPORTED_MIME_TYPES or len(data) > self.max_bytes:
+            return True
+        try:
+            # Only reads the header
+            with Image.open(io.BytesIO(data)) as image:
+                return max(image.size) > self.max_side
+        except Exception:
+            return False
+
+    def prepare(self, image_part):
+        """Return an image part ready for the model: right MIME type, bounded size"""
+        data = image_part['data']
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        mime_type = sniff_mime_type(data) or image_part.get('mime_type') or 'image/jpeg'
+
+        if not PIL_AVAILABLE or not self._needs_normalizing(data, mime_type):
+            self._count('passed_through', data, data)
+            return {'mime_type': mime_type, 'data': data}
+
+        executor = self._pool()
+        fd, path = tempfile.mkstemp(prefix='cknbook-image-', dir=SCRATCH_DIR)
+        future = None
+        normalized = None
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            future = executor.submit(normalize_image_file, path, self.max_side, self.max_bytes)
+            output_path = future.result(self.timeout)
+            with open(output_path, 'rb') as f:
+                normalized = f.read()
+        except BrokenProcessPool as e:
+            logger.error(f"Image worker pool broke, recreating it: {str(e)}")
+            self._reset_pool(executor)
+        except FutureTimeoutError:
+            logger.warning(f"Image normalization took over {self.timeout}s, sending the original")
+            self._timed_out(executor)
+        except Exception as e:
+            # Undecodable or unsupported by this Pillow build (e.g. HEIC without pillow-heif)
+            logger.warning(f"Could not normalize {mime_type} image, sending the original: {str(e)}")
+        finally:
+            if future is not None and not future.done():
+                # The child still owns the files and writes its output when it finishes
+                future.add_done_callback(lambda _: _remove_scratch_files(path))
+            else:
+                _remove_scratch_files(path)
+        if future is not None and future.done():
+            with self._lock:
+                self._timeouts = 0
+
+        if normalized is None:
+            self._count('failed', data, data)
+            return {'mime_type': mime_type, 'data': data}
+        self._count('resized', data, normalized)
+        logger.info(f"Normalized {mime_type} image: {len(data)} -> {len(normalized)} bytes")
+        return {'mime_type': 'image/jpeg', 'data': normalized}
+
+
+image_preprocessor = ImagePreprocessor()
+
+
+def prepare_image(image_part):
+    """Normalize an ``{'mime_type', 'data'}`` image part (raw or base64 data) for the model"""
+    return image_preprocessor.prepare(image_part)
@@ -0,0 +1,212 @@
+"""Background jobs for generations that may outlive an HTTP request.
+
+``POST /jobs/...`` stores a job record and returns its id at once; a small
+thread pool in the worker runs the generation and writes the outcome back.
+Clients poll ``GET /jobs/<id>`` or pass a ``webhook`` URL that receives the
+finished record as a JSON POST. The web request never waits on the model,
+so a slow generation can't hit the gunicorn timeout.
+
+Each worker holds at most ``max_pending`` queued or running jobs; beyond
+that ``submit`` raises ``JobQueueFull`` so a burst of submissions is turned
+away instead of piling up in memory.
+
+Records expire after ``ttl_seconds``. They are kept in the shared cache
+backend when there is one (``REDIS_URL``), so any worker or instance can
+answer a poll. Otherwise they are JSON files in a local directory shared by
+the workers on this host.
+
+Webhooks are only sent to URLs matching an entry of ``JOB_WEBHOOK_ALLOWLIST``
+(comma-separated URLs): the same scheme, host and port, and a path under the
+entry's path. URLs with credentials are refused and redirects are not
+followed, so the server can't be made to POST to arbitrary internal
+addresses. Without an allowlist no webhooks are sent.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import batch_item
+from gemini_client import request_deadline
+
+logger = logging.getLogger(__name__)
+
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Turns a redirect into an HTTPError instead of re-sending the POST elsewhere"""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_webhook_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def _url_parts(url):
+    """Return (scheme, host, port, path) of an http(s) URL without credentials, or None"""
+    try:
+        parsed = urllib.parse.urlsplit(url.strip())
+        port = parsed.port
+    except ValueError:
+        return None
+    if parsed.scheme not in _DEFAULT_PORTS or not parsed.hostname or '@' in parsed.netloc:
+        return None
+    return parsed.scheme, parsed.hostname, port or _DEFAULT_PORTS[parsed.scheme], parsed.path or '/'
+
+
+class JobQueueFull(Exception):
+    """Raised by ``submit`` when this worker already holds ``max_pending`` jobs"""
+
+
+class JobStore:
+    """Job records with a TTL, in a shared cache backend or as local files"""
+
+    def __init__(self, backend=None, directory='.cache/jobs', ttl_seconds=3600):
+        self.backend = backend if backend is not None and backend.shared else None
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self._saves = 0
+
+    def save(self, job):
+        data = json.dumps(job, ensure_ascii=False)
+        if self.backend is not None:
+            self.backend.set(job['id'], data, self.ttl_seconds)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{job['id']}.json")
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._saves += 1
+        if self._saves % 100 == 0:
+            self.purge_expired()
+
+    def load(self, job_id):
+        """Return the job record, or None if unknown or expired"""
+        if not _JOB_ID.match(job_id):
+            return None
+        if self.backend is not None:
+            data = self.backend.get(job_id)
+            return json.loads(data) if data else None
+        path = os.path.join(self.directory, f"{job_id}.json")
+        try:
+            if os.path.getmtime(path) + self.ttl_seconds < time.time():
+                os.unlink(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith('.json') and os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+        except OSError as e:
+            logger.warning(f"Could not purge expired jobs: {e}")
+
+
+class JobQueue:
+    """Runs submitted generations on a bounded thread pool and records their outcome"""
+
+    def __init__(self, store, max_workers=4, max_pending=100, deadline=120, webhook_allowlist=()):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.webhook_allowlist = []
+        for entry in webhook_allowlist:
+            parts = _url_parts(entry) if entry.strip() else None
+            if parts is not None:
+                self.webhook_allowlist.append(parts)
+            elif entry.strip():
+                logger.warning(f"Ignoring invalid JOB_WEBHOOK_ALLOWLIST entry {entry!r}")
+        self._executor = None
+        self._pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def webhook_allowed(self, url):
+        """Only http(s) URLs on an allowlisted scheme, host and port, under its path, are notified"""
+        parts = _url_parts(url) if isinstance(url, str) else None
+        if parts is None:
+            return False
+        scheme, host, port, path = parts
+        for allowed_scheme, allowed_host, allowed_port, allowed_path in self.webhook_allowlist:
+            if (scheme, host, port) != (allowed_scheme, allowed_host, allowed_port):
+                continue
+            prefix = allowed_path.rstrip('/')
+            if not prefix or path == prefix or path.startswith(prefix + '/'):
+                return True
+        return False
+
+    def submit(self, kind, fn, webhook=None):
+        """Queue ``fn()`` and return the new job record; raises JobQueueFull when at ``max_pending``"""
+        # Created lazily so each forked gunicorn worker gets its own threads
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='jobs')
+                self._pid = os.getpid()
+                self._pending = 0
+            if self._pending >= self.max_pending:
+                raise JobQueueFull(f"{self._pending} jobs are already queued or running")
+            self._pending += 1
+        job = {'id': uuid.uuid4().hex, 'kind': kind, 'status': 'queued', 'created_at': time.time()}
+        try:
+            self.store.save(job)
+            self._executor.submit(self._run, dict(job), fn, webhook)
+        except BaseException:
+            self._finished()
+            raise
+        logger.info(f"Queued {kind} job {job['id']}")
+        return job
+
+    def get(self, job_id):
+        return self.store.load(job_id)
+
+    def _finished(self):
+        with self._lock:
+            self._pending -= 1
+
+    def _run(self, job, fn, webhook):
+        try:
+            job.update(status='running', started_at=time.time())
+            self.store.save(job)
+            try:
+                with request_deadline(self.deadline):
+                    outcome = batch_item(fn())
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {str(e)}")
+                outcome = batch_item(None, e)
+            job.update(outcome, status='failed' if 'error' in outcome else 'done', finished_at=time.time())
+            self.store.save(job)
+        finally:
+            self._finished()
+        logger.info(f"{job['kind']} job {job['id']} {job['status']} in {job['finished_at'] - job['started_at']:.1f}s")
+        if webhook:
+            self._notify(webhook, job)
+
+    def _notify(self, url, job):
+        request = urllib.request.Request(
+            url, data=json.dumps(job, ensure_ascii=False).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        try:
+            with _webhook_opener.open(request, timeout=5):
+                pass
+        except OSError as e:
+            logger.warning(f"Webhook for job {job['id']} failed: {e}")
@@ -0,0 +1,193 @@
+"""Prebuilt, memory-mapped knowledge index.
+
+``python knowledge_index.py`` compiles ``knowledge/*.md`` and
+``book_knowledge.txt`` into a single binary file. Workers open it with
+``mmap`` at startup: the BM25 postings are used in place as memoryviews over
+the mapping, so every gunicorn worker shares the same page-cache copy and
+nothing has to be tokenized on a cold start.
+
+File layout (little-endian)::
+
+    b'CKNIDX01' | uint64 header length | JSON header | padding to 8 bytes |
+    UTF-8 text section | typed array sections (each 8-byte aligned)
+
+The header records size, mtime and SHA-256 of every source file. On open,
+files whose size and mtime are unchanged are trusted; the others are
+re-hashed, so touching a file without editing it keeps the index valid.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from knowledge_store import GENERAL_KNOWLEDGE_TITLE, Chunk, KnowledgeStore, parse_chapter
+from retrieval import BM25Index
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CKNIDX01'
+FORMAT_VERSION = 2
+DEFAULT_INDEX_PATH = 'knowledge.idx'
+
+_ARRAY_SECTIONS = (
+    ('offsets', 'I'),
+    ('doc_ids', 'I'),
+    ('term_freqs', 'H'),
+    ('doc_lengths', 'I'),
+    ('idf', 'f'),
+)
+
+
+def describe_source(path, previous=None):
+    """Return size/mtime/sha256 of a source file, reusing ``previous`` if unchanged"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if previous and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+
+
+def is_fresh(store, recorded_sources):
+    """True when the store's source files match the ones the index was built from"""
+    current = store.source_files()
+    if set(current) != set(recorded_sources):
+        return False
+    for path in current:
+        recorded = recorded_sources[path]
+        described = describe_source(path, recorded)
+        if described is None or recorded is None:
+            if described is not recorded:
+                return False
+        elif described['sha256'] != recorded['sha256']:
+            return False
+    return True
+
+
+def _align(length):
+    return (length + 7) & ~7
+
+
+def write_index(store, path):
+    """Serialize a parsed store to ``path`` atomically"""
+    index = store.chunk_index
+    if not isinstance(index, BM25Index):
+        raise ValueError("only BM25 passage indexes can be written")
+
+    text = bytearray()
+
+    def add_text(value):
+        data = value.encode('utf-8')
+        offset = len(text)
+        text.extend(data)
+        return [offset, len(data)]
+
+    header = {
+        'version': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'sources': {source: describe_source(source) for source in store.source_files()},
+        'k1': index.k1,
+        'b': index.b,
+        'chapters': [[chapter.filename, add_text(chapter.content)] for chapter in store.chapters],
+        'general': add_text(store.general_knowledge),
+        'chunks': [[chunk.chapter, add_text(chunk.text)] for chunk in store.chunks],
+        'vocabulary': add_text('\n'.join(sorted(index.terms, key=index.terms.get))),
+        'sections': {},
+    }
+
+    blobs = [bytes(text)]
+    position = _align(len(text))
+    header['sections']['text'] = [0, len(text)]
+    for name, typecode in _ARRAY_SECTIONS:
+        data = array(typecode, getattr(index, name)).tobytes()
+        blobs.append(data)
+        header['sections'][name] = [position, len(data), typecode]
+        position = _align(position + len(data))
+
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.knowledge-index-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+            data_start = f.tell()
+            for blob in blobs:
+                f.write(blob)
+                f.write(b'\0' * (_align(f.tell() - data_start) - (f.tell() - data_start)))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    logger.info(f"Wrote knowledge index {path} ({len(store.chunks)} passages)")
+
+
+def open_index(store, path):
+    """Load ``path`` into ``store`` if it exists and is fresh; returns True on success"""
+    try:
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return False
+
+    view = memoryview(mapping)
+    try:
+        if view[:8] != MAGIC:
+            logger.warning(f"{path} is not a knowledge index, ignoring it")
+            return False
+        (header_length,) = struct.unpack('<Q', view[8:16])
+        header = json.loads(bytes(view[16:16 + header_length]).decode('utf-8'))
+        if header.get('version') != FORMAT_VERSION or header.get('byteorder') != sys.byteorder:
+            logger.info(f"{path} was built by an incompatible version, rebuilding")
+            return False
+        if not is_fresh(store, header['sources']):
+            logger.info(f"{path} is stale, rebuilding from the knowledge files")
+            return False
+    except (ValueError, KeyError, struct.error) as e:
+        logger.warning(f"Could not read knowledge index {path}: {e}")
+        return False
+
+    data = view[_align(16 + header_length):]
+    text_offset, text_length = header['sections']['text']
+    text = data[text_offset:text_offset + text_length]
+
+    def read_text(ref):
+        offset, length = ref
+        return str(text[offset:offset + length], 'utf-8')
+
+    arrays = {}
+    for name, _ in _ARRAY_SECTIONS:
+        offset, length, typecode = header['sections'][name]
+        arrays[name] = data[offset:offset + length].cast(typecode)
+
+    chapters = [parse_chapter(filename, read_text(ref)) for filename, ref in header['chapters']]
+    chunks = [
+        Chunk(chapter, chapters[chapter].title if chapter is not None else GENERAL_KNOWLEDGE_TITLE, read_text(ref))
+        for chapter, ref in header['chunks']
+    ]
+    vocabulary = read_text(header['vocabulary'])
+    terms = {term: term_id for term_id, term in enumerate(vocabulary.split('\n'))} if vocabulary else {}
+    chunk_index = BM25Index.from_arrays(terms, k1=header['k1'], b=header['b'], **arrays)
+
+    store.set_contents(chapters, read_text(header['general']), chunks, chunk_index)
+    logger.info(f"Opened knowledge index {path} ({len(chapters)} chapters, {len(chunks)} passages)")
+    return True
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    output_path = sys.argv[1] if len(sys.argv) > 1 else os.getenv('KNOWLEDGE_INDEX_PATH', DEFAULT_INDEX_PATH)
+    knowledge = KnowledgeStore()
+    knowledge.parse_sources()
+    write_index(knowledge, output_path)
@@ -0,0 +1,268 @@
+"""In-memory corpus of the nutrition book chapters.
+
+The knowledge directory is parsed once at startup so request handlers never
+touch the filesystem when they need chapter content.
+"""
+import glob
+import logging
+import os
+import re
+import unicodedata
+from dataclasses import dataclass
+
+from retrieval import BM25Index
+
+logger = logging.getLogger(__name__)
+
+KNOWLEDGE_DIR = 'knowledge'
+BOOK_KNOWLEDGE_FILE = 'book_knowledge.txt'
+
+# Paragraphs are merged until a chunk reaches MIN_CHUNK_CHARS; longer
+# paragraphs are split on line breaks once they exceed MAX_CHUNK_CHARS
+MIN_CHUNK_CHARS = 150
+MAX_CHUNK_CHARS = 400
+
+GENERAL_KNOWLEDGE_TITLE = "一般營養知識："
+
+# Matches 第N天 / 第 N 課 with half- or full-width digits and spaces
+_DAY_PATTERN = re.compile(r'第\s*(\d+)\s*[天課]')
+
+
+@dataclass
+class Chapter:
+    """A single parsed chapter from the knowledge directory"""
+    filename: str
+    title: str
+    day: int | None
+    content: str
+    lines: list[str]
+
+
+@dataclass
+class Chunk:
+    """A passage of a chapter (or of the general knowledge) that can be retrieved on its own"""
+    chapter: int | None  # position in KnowledgeStore.chapters, None for general knowledge
+    title: str
+    text: str
+
+
+def split_into_chunks(text):
+    """Split text on blank lines into passages of roughly MIN..MAX_CHUNK_CHARS characters"""
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= MAX_CHUNK_CHARS:
+            pieces.append(paragraph)
+            continue
+        current = []
+        for line in paragraph.split('\n'):
+            if current and sum(len(l) for l in current) + len(line) > MAX_CHUNK_CHARS:
+                pieces.append('\n'.join(current))
+                current = []
+            current.append(line)
+        if current:
+            pieces.append('\n'.join(current))
+
+    chunks = []
+    current = []
+    for piece in pieces:
+        current.append(piece)
+        if sum(len(p) for p in current) >= MIN_CHUNK_CHARS:
+            chunks.append('\n\n'.join(current))
+            current = []
+    if current:
+        if chunks and len(chunks[-1]) + sum(len(p) for p in current) <= MAX_CHUNK_CHARS:
+            chunks[-1] = '\n\n'.join([chunks[-1]] + current)
+        else:
+            chunks.append('\n\n'.join(current))
+    return chunks
+
+
+def format_passages(chunks):
+    """Render retrieved chunks grouped under their chapter title"""
+    sections = []
+    current_title = None
+    for chunk in chunks:
+        if chunk.title != current_title:
+            sections.append([chunk.title])
+            current_title = chunk.title
+        sections[-1].append(chunk.text)
+    return "\n\n---\n\n".join('\n'.join(section) for section in sections)
+
+
+def parse_chapter(filename, content):
+    """Build a Chapter record from a file name and its decoded content"""
+    lines = content.split('\n')
+    title = lines[0] if lines else "未知章節"
+    match = _DAY_PATTERN.search(filename)
+    day = int(match.group(1)) if match else None
+    return Chapter(filename=filename, title=title, day=day, content=content, lines=lines)
+
+
+class KnowledgeStore:
+    """Holds every chapter and the general book knowledge in memory"""
+
+    def __init__(self, knowledge_dir=KNOWLEDGE_DIR, book_knowledge_file=BOOK_KNOWLEDGE_FILE):
+        self.knowledge_dir = knowledge_dir
+        self.book_knowledge_file = book_knowledge_file
+        self.chapters = []
+        self.general_knowledge = ""
+        self.chunks = []
+        self.chunk_index = BM25Index([])
+        self.by_day = {}
+
+    def load(self, index_path=None):
+        """Load the knowledge; returns self for chaining.
+
+        When ``index_path`` names a prebuilt index (see knowledge_index.py)
+        that is still fresh, it is opened memory-mapped instead of parsing the
+        markdown. A missing or stale index is rebuilt from the sources and
+        written back so the next worker can use it.
+        """
+        if index_path:
+            import knowledge_index
+            if knowledge_index.open_index(self, index_path):
+                return self
+
+        self.parse_sources()
+
+        if index_path:
+            import knowledge_index
+            try:
+                knowledge_index.write_index(self, index_path)
+            except OSError as e:
+                logger.warning(f"Could not write knowledge index {index_path}: {e}")
+        return self
+
+    def source_files(self):
+        """Return the paths of every file the knowledge is built from"""
+        return sorted(glob.glob(os.path.join(self.knowledge_dir, '*.md'))) + [self.book_knowledge_file]
+
+    def parse_sources(self):
+        """Read and parse the markdown chapters and the general knowledge file"""
+        chapters = []
+        for file_path in sorted(glob.glob(os.path.join(self.knowledge_dir, '*.md'))):
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+            except Exception as e:
+                logger.error(f"Error reading knowledge file {file_path}: {e}")
+                continue
+            chapters.append(parse_chapter(os.path.basename(file_path), content))
+
+        try:
+            with open(self.book_knowledge_file, 'r', encoding='utf-8') as f:
+                general_knowledge = f.read()
+        except FileNotFoundError:
+            logger.warning(f"{self.book_knowledge_file} not found")
+            general_knowledge = ""
+
+        chunks = [Chunk(None, GENERAL_KNOWLEDGE_TITLE, text) for text in split_into_chunks(general_knowledge)]
+        # A passage repeated in another chapter (第N課 copies of 第N天) is kept once,
+        # under the chapter by_day prefers, so it can't take up the budget twice
+        seen = set()
+        for position, chapter in sorted(enumerate(chapters), key=lambda item: '課' in item[1].filename):
+            body = '\n'.join(chapter.lines[1:])
+            for text in split_into_chunks(body):
+                normalized = ' '.join(unicodedata.normalize('NFKC', text).split())
+                if normalized not in seen:
+                    seen.add(normalized)
+                    chunks.append(Chunk(position, chapter.title, text))
+
+        # The title is indexed with each passage so chapter-level terms still match
+        chunk_index = BM25Index([f"{chunk.title}\n{chunk.text}" for chunk in chunks])
+        self.set_contents(chapters, general_knowledge, chunks, chunk_index)
+        logger.info(f"Loaded {len(chapters)} knowledge chapters ({len(chunks)} passages) into memory")
+
+    def set_contents(self, chapters, general_knowledge, chunks, chunk_index):
+        """Install parsed (or index-loaded) knowledge into the store"""
+        self.chapters = chapters
+        self.general_knowledge = general_knowledge
+        self.chunks = chunks
+        self.chunk_index = chunk_index
+
+        # Day number -> chapter. 第N天 files win over 第N課 duplicates of the same day.
+        by_day = {}
+        for chapter in sorted(chapters, key=lambda chapter: '課' in chapter.filename):
+            if chapter.day is not None:
+                by_day.setdefault(chapter.day, chapter)
+        self.by_day = by_day
+
+    def enable_semantic_search(self, embed=None, name=None):
+        """Rank passages by embedding similarity instead of BM25"""
+        from semantic_index import SemanticIndex
+        self.chunk_index = SemanticIndex.build_or_load(
+            [f"{chunk.title}\n{chunk.text}" for chunk in self.chunks], embed=embed, name=name
+        )
+        return self
+
+    def select_passages(self, query, char_budget, chapter_positions=None):
+        """Return the best-matching passages that fit in ``char_budget`` characters.
+
+        Only passages from ``chapter_positions`` (plus the general knowledge)
+        are considered when it is given. The result is in document order so
+        passages from the same chapter stay together.
+        """
+        selected = []
+        used = 0
+        ranked = self.chunk_index.search(query, top_k=len(self.chunks))
+        for position, score in ranked:
+            if score < ranked[0][1] * self.chunk_index.min_relative_score:
+                break
+            chunk = self.chunks[position]
+            if chapter_positions is not None and chunk.chapter is not None and chunk.chapter not in chapter_positions:
+                continue
+            size = len(chunk.title) + len(chunk.text)
+            if used + size > char_budget:
+                continue
+            selected.append(position)
+            used += size
+        return [self.chunks[position] for position in sorted(selected)]
+
+    def chapter_for_day(self, day_number):
+        """Return the chapter for a day number such as 7, "7", "７" or "第 7 天", or None"""
+        match = re.search(r'\d+', unicodedata.normalize('NFKC', str(day_number)))
+        if not match:
+            return None
+        return self.by_day.get(int(match.group()))
+
+
+class KeywordIndex:
+    """Inverted index from a fixed vocabulary of terms to the chapters containing them.
+
+    ``postings[term]`` maps a chapter's position in the store to the number
+    of times the term occurs in it, so scoring a query is a dictionary lookup
+    instead of a substring scan over every chapter.
+    """
+
+    def __init__(self, chapters, terms):
+        self.size = len(chapters)
+        self.postings = {}
+        for term in set(terms):
+            postings = {}
+            for position, chapter in enumerate(chapters):
+                count = chapter.content.count(term)
+                if count:
+                    postings[position] = count
+            self.postings[term] = postings
+
+    def chapters_with(self, term):
+        """Return {chapter position: occurrence count} for an indexed term"""
+        return self.postings.get(term, {})
+
+    def chapters_with_any(self, terms):
+        """Return the set of chapter positions containing at least one of the terms"""
+        positions = set()
+        for term in terms:
+            positions.update(self.chapters_with(term))
+        return positions
+
+    def presence_scores(self, terms, weight):
+        """Add ``weight`` to a chapter's score for every term it contains"""
+        scores = {}
+        for term in terms:
+            for position in self.chapters_with(term):
+                scores[position] = scores.get(position, 0) + weight
+        return scores
@@ -1,28 +1,101 @@
 import os
+import logging
 import google.generativeai as genai
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, url_for
 from flask_cors import CORS
 from dotenv import load_dotenv
-import json
+from app_logging import configure_logging, parse_sample_rates
+from batch import BATCH_MAX_ITEMS, batch_item, run_batch
+from gemini_client import generate_text, request_deadline, stream_text
+from image_prep import prepare_image
+from job_queue import JobQueue, JobQueueFull, JobStore
+from knowledge_store import GENERAL_KNOWLEDGE_TITLE, KeywordIndex, KnowledgeStore, format_passages
+from metrics import RETRIEVAL_LATENCY, instrument_app, metrics_response
+from prompt_registry import PromptRegistry
+from quiz_bank import QuizBank
+from response_cache import create_cache_backend
+from streaming import event_stream, sse_event, sse_response
+from structured_output import QUIZ_OUTPUT, RESPONSE_OUTPUT
+from uploads import MAX_REQUEST_BYTES, ImageUploadError, read_reply_request
 
 # Load environment variables
 load_dotenv()
 
+# Log through a background writer so requests never wait on stdout; per-request
+# retrieval steps go to the 'retrieval' logger (LOG_SAMPLE_RATES samples it)
+configure_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    log_format=os.getenv('LOG_FORMAT', 'text'),
+    log_file=os.getenv('LOG_FILE') or None,
+    sampled_loggers=('retrieval',),
+    sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', '')),
+    max_per_second=float(os.getenv('LOG_RATE_LIMIT', '0')),
+    max_pending=int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+)
+logger = logging.getLogger(__name__)
+retrieval_logger = logging.getLogger('retrieval')
+
 app = Flask(__name__)
 CORS(app)
+# Per-route latency and in-flight requests, exported at /metrics
+instrument_app(app)
+# Larger request bodies are refused before they are read
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
 # Configure Gemini API
 api_key = os.getenv('API_KEY')
 if not api_key:
-    print("ERROR: API_KEY not found in .env file")
+    logger.error("ERROR: API_KEY not found in .env file")
     exit(1)
-print(f"Configuring Gemini with API key: {api_key[:10]}...")
+logger.info("Configuring Gemini API...")
 genai.configure(api_key=api_key)
 
-def load_system_prompt():
-    """Load the system prompt from file"""
-    with open('prompts/system_prompt.txt', 'r', encoding='utf-8') as f:
-        return f.read()
+# Load the knowledge once; request handlers read from memory. The prebuilt
+# index (python knowledge_index.py) is memory-mapped when it is up to date.
+knowledge_store = KnowledgeStore().load(os.getenv('KNOWLEDGE_INDEX_PATH', 'knowledge.idx'))
+
+# Optional embedding-based passage ranking (needs numpy), e.g. KNOWLEDGE_RETRIEVAL=semantic
+if os.getenv('KNOWLEDGE_RETRIEVAL', 'bm25') == 'semantic':
+    knowledge_store.enable_semantic_search()
+logger.info(f"Loaded {len(knowledge_store.chapters)} knowledge chapters")
+
+# Prompt files are read once and reloaded when they change on disk
+prompts = PromptRegistry(
+    'prompts',
+    fallbacks={'quiz_prompt.txt': '', 'response_prompt.txt': ''},
+    check_interval=float(os.getenv('PROMPT_RELOAD_INTERVAL', '1'))
+)
+
+FINE_TUNE_USER_PROMPT = """
+        [Tone]: {tone}
+        [Language or Dialect]: {language}
+        
+        原文段落:
+        {paragraph}
+        
+        請根據上述語調和語言要求，重寫這個段落為三個不同的選項。
+        """
+
+QUIZ_USER_PROMPT = """
+        請根據以下章節內容生成測驗題：
+        
+        章節內容：
+        {chapter_content}
+        
+        請確保使用正確的章節編號：第{day_number}天
+        """
+
+RESPONSE_USER_PROMPT = """
+        用戶輸入：{text}
+        語調要求：{tone}
+        相關書本知識：{relevant_knowledge}
+        
+        請生成回應，使用以下JSON格式：
+        {{
+            "feeling": "對用戶分享內容的直接反應和感受，使用表情符號增加親切感，字數在30字內",
+            "knowledge": "結合《吃的營養科學觀》的相關知識，分析營養價值，提出建議，鼓勵成員分享，字數在120字內"
+        }}
+        {image_note}"""
 
 def load_book_knowledge():
     """Load the nutrition book knowledge from file"""
@@ -30,25 +103,7 @@ def load_book_knowledge():
         with open('book_knowledge.txt', 'r', encoding='utf-8') as f:
             return f.read()
     except FileNotFoundError:
-        print("Warning: book_knowledge.txt not found")
-        return ""
-
-def load_quiz_prompt():
-    """Load the quiz prompt from file"""
-    try:
-        with open('prompts/quiz_prompt.txt', 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print("Warning: quiz_prompt.txt not found")
-        return ""
-
-def load_response_prompt():
-    """Load the response prompt from file"""
-    try:
-        with open('prompts/response_prompt.txt', 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        print("Warning: response_prompt.txt not found")
+        logger.warning("book_knowledge.txt not found")
         return ""
 
 def load_version():
@@ -56,234 +111,222 @@ def load_version():
     import os
     current_dir = os.getcwd()
     version_file = os.path.join(current_dir, 'version.txt')
-    print(f"Looking for version file at: {version_file}")
+    logger.debug(f"Looking for version file at: {version_file}")
     
     try:
         with open(version_file, 'r', encoding='utf-8') as f:
             version = f.read().strip()
-            print(f"✓ Loaded version from file: '{version}'")
+            logger.debug(f"Loaded version from file: '{version}'")
             return version
     except FileNotFoundError:
-        print(f"Warning: version.txt not found at {version_file}")
+        logger.warning(f"version.txt not found at {version_file}")
         return "v0.1"
     except Exception as e:
-        print(f"Error reading version.txt: {e}")
+        logger.error(f"Error reading version.txt: {e}")
         return "v0.1"
 
 def get_chapter_content(day_number):
     """Get content from the knowledge directory for a specific day"""
-    import glob
-    import os
-    
-    # Try to find the chapter file with different naming patterns
-    patterns = [
-        f"knowledge/第{day_number}天：*.md",
-        f"knowledge/第 {day_number} 天：*.md",
-        f"knowledge/第{day_number}天*.md",
-        f"knowledge/第 {day_number} 天*.md"
-    ]
-    
-    for pattern in patterns:
-        files = glob.glob(pattern)
-        if files:
-            try:
-                with open(files[0], 'r', encoding='utf-8') as f:
-                    return f.read()
-            except Exception as e:
-                print(f"Error reading file {files[0]}: {e}")
-                continue
+    chapter = knowledge_store.chapter_for_day(day_number)
+    if chapter:
+        return chapter.content
     
     return f"第{day_number}課的內容未找到"
 
+def build_fine_tune_prompt(paragraph, tone, language):
+    """Build the full rewrite prompt for a paragraph"""
+    return prompts.render('system_prompt.txt', FINE_TUNE_USER_PROMPT,
+                          tone=tone, language=language, paragraph=paragraph)
+
 def fine_tune_text(paragraph, tone, language):
     """Fine-tune the paragraph using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        full_prompt = build_fine_tune_prompt(paragraph, tone, language)
         
-        system_prompt = load_system_prompt()
-        user_prompt = f"""
-        [Tone]: {tone}
-        [Language or Dialect]: {language}
-        
-        原文段落:
-        {paragraph}
+        logger.info("Sending prompt to Gemini API...")
+        response_text = generate_text(full_prompt)
+        logger.debug(f"Received response: {len(response_text)} characters")
         
-        請根據上述語調和語言要求，重寫這個段落為三個不同的選項。
-        """
-        
-        full_prompt = system_prompt + "\n\n" + user_prompt
-        
-        print(f"Sending prompt to Gemini API...")
-        response = model.generate_content(full_prompt)
-        print(f"Received response: {response.text[:200]}...")
-        
-        if response.text:
-            return response.text
+        if response_text:
+            return response_text
         else:
             return "錯誤: API 回應為空"
         
     except Exception as e:
-        print(f"Error in fine_tune_text: {str(e)}")
+        logger.error(f"Error in fine_tune_text: {str(e)}")
         return f"錯誤: {str(e)}"
 
-def generate_quiz(day_number):
+def build_quiz_prompt(day_number):
+    """Build the quiz prompt for a day's chapter"""
+    chapter_content = get_chapter_content(day_number)
+    # Instructions plus chapter repeat for every quiz of the day: cacheable as a context
+    return prompts.render('quiz_prompt.txt', QUIZ_USER_PROMPT, context_through='chapter_content',
+                          chapter_content=chapter_content, day_number=day_number)
+
+def generate_quiz(day_number, use_cache=True):
     """Generate quiz questions and answers using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        full_prompt = build_quiz_prompt(day_number)
         
-        quiz_prompt = load_quiz_prompt()
-        chapter_content = get_chapter_content(day_number)
+        logger.info(f"Generating quiz for day {day_number}...")
+        response_text = generate_text(full_prompt, use_cache=use_cache, generation_config=QUIZ_OUTPUT.generation_config)
+        logger.debug(f"Quiz response: {len(response_text)} characters")
         
-        user_prompt = f"""
-        請根據以下章節內容生成測驗題：
-        
-        章節內容：
-        {chapter_content}
-        
-        請確保使用正確的章節編號：第{day_number}天
-        """
-        
-        full_prompt = quiz_prompt + "\n\n" + user_prompt
-        
-        print(f"Generating quiz for day {day_number}...")
-        response = model.generate_content(full_prompt)
-        print(f"Quiz response: {response.text[:200]}...")
-        
-        if response.text:
-            # Try to parse as JSON
-            try:
-                # Clean up the response text - remove markdown code blocks if present
-                clean_text = response.text.strip()
-                
-                # Remove markdown code blocks more thoroughly
-                if '```json' in clean_text:
-                    # Extract content between ```json and ```
-                    start = clean_text.find('```json') + 7
-                    end = clean_text.rfind('```')
-                    if end > start:
-                        clean_text = clean_text[start:end].strip()
-                elif clean_text.startswith('```') and clean_text.endswith('```'):
-                    # Remove ``` at start and end
-                    clean_text = clean_text[3:-3].strip()
-                
-                print(f"Cleaned text for JSON parsing: {clean_text[:100]}...")
-                
-                quiz_data = json.loads(clean_text)
-                print("Successfully parsed JSON response")
-                return quiz_data  # Return the actual JSON object, not a string
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing failed: {e}")
-                print("Falling back to plain text response")
-                return response.text
+        if response_text:
+            # The parsed quiz object, or the raw text if it can't be repaired
+            return QUIZ_OUTPUT.parse(response_text)
         else:
             return "錯誤: API 回應為空"
         
     except Exception as e:
-        print(f"Error in generate_quiz: {str(e)}")
+        logger.error(f"Error in generate_quiz: {str(e)}")
         return f"錯誤: {str(e)}"
 
-def generate_effective_response(text, image_base64, tone):
+# Quizzes are pre-generated per chapter in the background (QUIZ_BANK_VARIANTS=0 disables)
+# and shared by every worker when REDIS_URL is set. A day is regenerated only once
+# its fresh variants drop below QUIZ_BANK_LOW_WATER; bank variants bypass the
+# response cache, which would hand back the same quiz for every variant.
+QUIZ_BANK_TTL = int(os.getenv('QUIZ_BANK_TTL', '21600'))
+quiz_bank = QuizBank(
+    lambda day: generate_quiz(str(day), use_cache=False),
+    sorted(knowledge_store.by_day),
+    create_cache_backend(max_entries=256, ttl_seconds=QUIZ_BANK_TTL, prefix='cknbook:quiz_bank:'),
+    variants_per_day=int(os.getenv('QUIZ_BANK_VARIANTS', '2')),
+    low_water=int(os.getenv('QUIZ_BANK_LOW_WATER', '1')),
+    ttl_seconds=QUIZ_BANK_TTL,
+    path=os.getenv('QUIZ_BANK_PATH', '.cache/quiz_bank.json')
+)
+
+# Quiz and reply generations can also run as background jobs: POST /jobs/...
+# returns a job id at once, clients poll GET /jobs/<id> or get a webhook
+JOB_TTL = int(os.getenv('JOB_TTL', '3600'))
+job_queue = JobQueue(
+    JobStore(create_cache_backend(ttl_seconds=JOB_TTL, prefix='cknbook:job:'), ttl_seconds=JOB_TTL),
+    max_workers=int(os.getenv('JOB_WORKERS', '4')),
+    max_pending=int(os.getenv('JOB_MAX_PENDING', '100')),
+    deadline=float(os.getenv('JOB_DEADLINE', '120')),
+    webhook_allowlist=os.getenv('JOB_WEBHOOK_ALLOWLIST', '').split(',')
+)
+
+def build_effective_response_prompt(text, image, tone):
+    """Build the reply prompt and optional image part for a member's post"""
+    # Find relevant knowledge content based on user input
+    relevant_knowledge = find_relevant_knowledge(text)
+    
+    full_prompt = prompts.render(
+        'response_prompt.txt', RESPONSE_USER_PROMPT,
+        text=text, tone=tone, relevant_knowledge=relevant_knowledge,
+        image_note="\n\n圖片已上傳，請分析圖片內容並納入回應考慮。" if image else ""
+    )
+    
+    logger.info(f"Generating effective response with tone: {tone}...")
+    retrieval_logger.info(f"Relevant knowledge found: {len(relevant_knowledge)} characters")
+    
+    # Handle image analysis: form uploads arrive as an image part with raw
+    # bytes, JSON requests carry base64
+    if isinstance(image, dict):
+        image_data = image
+    else:
+        image_data = {"mime_type": "image/jpeg", "data": image} if image else None
+    # Detect the real format; shrink large photos to what the model needs
+    if image_data:
+        image_data = prepare_image(image_data)
+    return full_prompt, image_data
+
+def generate_effective_response(text, image, tone):
     """Generate effective responses using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        response_prompt = load_response_prompt()
-        
-        # Find relevant knowledge content based on user input
-        relevant_knowledge = find_relevant_knowledge(text)
-        
-        user_prompt = f"""
-        用戶輸入：{text}
-        語調要求：{tone}
-        相關書本知識：{relevant_knowledge}
-        
-        請生成回應，使用以下JSON格式：
-        {{
-            "feeling": "對用戶分享內容的直接反應和感受，使用表情符號增加親切感，字數在30字內",
-            "knowledge": "結合《吃的營養科學觀》的相關知識，分析營養價值，提出建議，鼓勵成員分享，字數在120字內"
-        }}
-        """
-        
-        if image_base64:
-            user_prompt += f"\n\n圖片已上傳，請分析圖片內容並納入回應考慮。"
+        full_prompt, image_data = build_effective_response_prompt(text, image, tone)
         
-        full_prompt = response_prompt + "\n\n" + user_prompt
+        response_text = generate_text(full_prompt, image_data, generation_config=RESPONSE_OUTPUT.generation_config)
         
-        print(f"Generating effective response with tone: {tone}...")
-        print(f"Relevant knowledge found: {len(relevant_knowledge)} characters")
+        logger.debug(f"Response generation: {len(response_text)} characters")
         
-        if image_base64:
-            # Handle image analysis
-            image_data = {"mime_type": "image/jpeg", "data": image_base64}
-            response = model.generate_content([full_prompt, image_data])
-        else:
-            response = model.generate_content(full_prompt)
-        
-        print(f"Response generation: {response.text[:200]}...")
-        
-        if response.text:
-            # Try to parse as JSON
-            try:
-                # Clean up the response text - remove markdown code blocks if present
-                clean_text = response.text.strip()
-                
-                # Remove markdown code blocks more thoroughly
-                if '```json' in clean_text:
-                    # Extract content between ```json and ```
-                    start = clean_text.find('```json') + 7
-                    end = clean_text.rfind('```')
-                    if end > start:
-                        clean_text = clean_text[start:end].strip()
-                elif clean_text.startswith('```') and clean_text.endswith('```'):
-                    # Remove ``` at start and end
-                    clean_text = clean_text[3:-3].strip()
-                
-                print(f"Cleaned text for JSON parsing: {clean_text[:100]}...")
-                
-                response_data = json.loads(clean_text)
-                print("Successfully parsed JSON response")
-                return response_data  # Return the actual JSON object, not a string
-            except json.JSONDecodeError as e:
-                print(f"JSON parsing failed: {e}")
-                print("Falling back to plain text response")
-                return response.text
+        if response_text:
+            return RESPONSE_OUTPUT.parse(response_text)
         else:
             return "錯誤: API 回應為空"
         
     except Exception as e:
-        print(f"Error in generate_effective_response: {str(e)}")
+        logger.error(f"Error in generate_effective_response: {str(e)}")
         return f"錯誤: {str(e)}"
 
-def find_relevant_knowledge(user_input):
-    """Find relevant knowledge content based on user input"""
-    import glob
-    import os
-    import re
+# Enhanced keywords that might indicate specific topics
+TOPIC_KEYWORDS = {
+    '維生素': ['維生素', 'vitamin', '維他命', '維他命c', '維他命b', 'b族維生素'],
+    '蛋白質': ['蛋白質', 'protein', '氨基酸', '必需氨基酸', '必需氨基酸', '氨基酸種類'],
+    '脂肪': ['脂肪', 'fat', '油', '膽固醇', '脂肪酸'],
+    '碳水化合物': ['碳水化合物', 'carb', '糖', '澱粉', '醣類'],
+    '礦物質': ['礦物質', 'mineral', '鈣', '鐵', '鋅', '鎂'],
+    '早餐': ['早餐', 'breakfast', '早上', '早飯'],
+    '營養補充': ['營養補充', 'supplement', '補充劑', '營養品'],
+    '烹調': ['烹調', 'cooking', '煮', '蒸', '炒', '料理'],
+    '健康': ['健康', 'health', '養生', '保健'],
+    '疾病': ['疾病', 'disease', '病', '症狀', '治療'],
+    '年輕': ['年輕', '衰老', '老化', '抗衰老', '保持年輕'],
+    '氨基酸': ['氨基酸', '必需氨基酸', '非必需氨基酸', '氨基酸種類', '氨基酸數量'],
+    '數字': ['數字', '數量', '幾種', '多少種', '幾種', '數量'],
+    '天': ['天', '日', '第幾天', '第幾日']
+}
+
+# Extra score for chapters containing any of these terms when the topic is detected
+TOPIC_BONUSES = {
+    '氨基酸': (['必需氨基酸', '氨基酸種類'], 20),  # Bonus for amino acid specific content
+    '數字': (['22種', '8種', '14種'], 15),  # Bonus for specific numbers
+    '天': (['第3天', '第三天', '第三日'], 15)  # Bonus for specific days
+}
+
+def build_keyword_index(chapters):
+    """Build the inverted keyword index and the static keyword score of each chapter"""
+    all_keywords = [keyword for topic_keywords in TOPIC_KEYWORDS.values() for keyword in topic_keywords]
+    terms = list(TOPIC_KEYWORDS) + all_keywords + ['general']
+    for bonus_terms, _ in TOPIC_BONUSES.values():
+        terms.extend(bonus_terms)
     
-    # Enhanced keywords that might indicate specific topics
-    keywords = {
-        '維生素': ['維生素', 'vitamin', '維他命', '維他命c', '維他命b', 'b族維生素'],
-        '蛋白質': ['蛋白質', 'protein', '氨基酸', '必需氨基酸', '必需氨基酸', '氨基酸種類'],
-        '脂肪': ['脂肪', 'fat', '油', '膽固醇', '脂肪酸'],
-        '碳水化合物': ['碳水化合物', 'carb', '糖', '澱粉', '醣類'],
-        '礦物質': ['礦物質', 'mineral', '鈣', '鐵', '鋅', '鎂'],
-        '早餐': ['早餐', 'breakfast', '早上', '早飯'],
-        '營養補充': ['營養補充', 'supplement', '補充劑', '營養品'],
-        '烹調': ['烹調', 'cooking', '煮', '蒸', '炒', '料理'],
-        '健康': ['健康', 'health', '養生', '保健'],
-        '疾病': ['疾病', 'disease', '病', '症狀', '治療'],
-        '年輕': ['年輕', '衰老', '老化', '抗衰老', '保持年輕'],
-        '氨基酸': ['氨基酸', '必需氨基酸', '非必需氨基酸', '氨基酸種類', '氨基酸數量'],
-        '數字': ['數字', '數量', '幾種', '多少種', '幾種', '數量'],
-        '天': ['天', '日', '第幾天', '第幾日']
-    }
+    index = KeywordIndex(chapters, terms)
+    # Every keyword found in a chapter adds 5, whatever the user asked about
+    base_scores = index.presence_scores(all_keywords, 5)
+    return index, base_scores
+
+# Scoring is a lookup into the precomputed index rather than a scan of every chapter
+keyword_index, keyword_base_scores = build_keyword_index(knowledge_store.chapters)
+
+# Seconds each endpoint may spend on Gemini calls (queueing, retries and hedges
+# included); kept under gunicorn's 30s worker timeout
+ENDPOINT_DEADLINES = {
+    'process': float(os.getenv('PROCESS_DEADLINE', '25')),
+    'generate-quiz': float(os.getenv('GENERATE_QUIZ_DEADLINE', '25')),
+    'generate-response': float(os.getenv('GENERATE_RESPONSE_DEADLINE', '25')),
+    'batch': float(os.getenv('BATCH_DEADLINE', '25'))
+}
+
+# Character budget for the book passages added to the response prompt
+KNOWLEDGE_CHAR_BUDGET = int(os.getenv('KNOWLEDGE_CHAR_BUDGET', '1500'))
+
+def score_chapters(relevant_topics, index=None, base_scores=None):
+    """Return {chapter position: relevance score} for the detected topics"""
+    if index is None:
+        index, base_scores = keyword_index, keyword_base_scores
     
+    scores = dict(base_scores)
+    for topic in relevant_topics:
+        for position in index.chapters_with(topic):
+            scores[position] = scores.get(position, 0) + 10
+        if topic in TOPIC_BONUSES:
+            bonus_terms, bonus = TOPIC_BONUSES[topic]
+            for position in index.chapters_with_any(bonus_terms):
+                scores[position] = scores.get(position, 0) + bonus
+    return scores
+
+@RETRIEVAL_LATENCY.time()
+def find_relevant_knowledge(user_input):
+    """Find relevant knowledge content based on user input"""
     # Find matching topics
     relevant_topics = []
     user_input_lower = user_input.lower()
     
     # First pass: look for exact matches
-    for topic, topic_keywords in keywords.items():
+    for topic, topic_keywords in TOPIC_KEYWORDS.items():
         for keyword in topic_keywords:
             if keyword.lower() in user_input_lower:
                 relevant_topics.append(topic)
@@ -304,106 +347,51 @@ def find_relevant_knowledge(user_input):
     if not relevant_topics:
         relevant_topics = ['general']
     
-    print(f"Detected topics: {relevant_topics}")
-    
-    # Load relevant chapter content
-    relevant_content = []
+    retrieval_logger.info(f"Detected topics: {relevant_topics}")
     
-    # Always include some general knowledge
-    try:
-        with open('book_knowledge.txt', 'r', encoding='utf-8') as f:
-            general_knowledge = f.read()
-            relevant_content.append(f"一般營養知識：\n{general_knowledge}")
-            print("✓ Loaded general knowledge")
-    except Exception as e:
-        print(f"✗ Error loading general knowledge: {e}")
+    # Score the in-memory chapters against the detected topics
+    chapters = knowledge_store.chapters
+    retrieval_logger.debug(f"Found {len(chapters)} knowledge chapters")
     
-    # Load specific chapter content based on topics
-    knowledge_files = glob.glob('knowledge/*.md')
-    print(f"Found {len(knowledge_files)} knowledge files")
+    # Priority: pick the chapters most relevant to the topics. Without a detected topic
+    # the keyword scores are the same for every input, so the whole book is searched.
+    chapter_scores = score_chapters(relevant_topics) if relevant_topics != ['general'] else {}
     
-    # Priority: load chapters that are most relevant
-    chapter_scores = {}
+    # Sort chapters by relevance score and keep the most relevant ones
+    sorted_chapters = sorted(
+        ((position, score) for position, score in sorted(chapter_scores.items()) if score > 0),
+        key=lambda x: x[1], reverse=True
+    )[:5]  # Top 5 most relevant
     
-    for file_path in knowledge_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-                # Calculate relevance score
-                score = 0
-                for topic in relevant_topics:
-                    if topic in content:
-                        score += 10
-                    if topic == '氨基酸' and ('必需氨基酸' in content or '氨基酸種類' in content):
-                        score += 20  # Bonus for amino acid specific content
-                    if topic == '數字' and any(word in content for word in ['22種', '8種', '14種']):
-                        score += 15  # Bonus for specific numbers
-                    if topic == '天' and any(word in content for word in ['第3天', '第三天', '第三日']):
-                        score += 15  # Bonus for specific days
-                
-                # Check for exact keyword matches
-                for topic, topic_keywords in keywords.items():
-                    for keyword in topic_keywords:
-                        if keyword in content:
-                            score += 5
-                
-                if score > 0:
-                    chapter_scores[file_path] = score
-                    
-        except Exception as e:
-            print(f"✗ Error reading knowledge file {file_path}: {e}")
-            continue
+    for position, score in sorted_chapters:
+        retrieval_logger.debug(f"Candidate chapter: {chapters[position].filename} (score: {score})")
     
-    # Sort chapters by relevance score and load the most relevant ones
-    sorted_chapters = sorted(chapter_scores.items(), key=lambda x: x[1], reverse=True)
+    # Only the passages of those chapters that match the input go into the prompt
+    passages = []
+    if sorted_chapters:
+        candidate_positions = {position for position, _ in sorted_chapters}
+        passages = knowledge_store.select_passages(user_input, KNOWLEDGE_CHAR_BUDGET, candidate_positions)
     
-    for file_path, score in sorted_chapters[:5]:  # Load top 5 most relevant
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                lines = content.split('\n')
-                title = lines[0] if lines else "未知章節"
-                # Get more content for highly relevant chapters
-                key_content = '\n'.join(lines[1:min(15, len(lines))])
-                relevant_content.append(f"{title}\n{key_content}")
-                print(f"✓ Loaded relevant content from: {os.path.basename(file_path)} (score: {score})")
-                    
-        except Exception as e:
-            print(f"✗ Error reading knowledge file {file_path}: {e}")
-            continue
+    if not passages:
+        retrieval_logger.debug("Searching passages across the whole book...")
+        passages = knowledge_store.select_passages(user_input, KNOWLEDGE_CHAR_BUDGET)
     
-    # If no specific content found, try to find chapters that might be relevant
-    if len(relevant_content) <= 1:  # Only general knowledge
-        print("No specific content found, loading random chapters...")
-        # Load a few random chapters to provide context
-        import random
-        knowledge_files = glob.glob('knowledge/*.md')
-        if knowledge_files:
-            selected_files = random.sample(knowledge_files, min(3, len(knowledge_files)))
-            for file_path in selected_files:
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        lines = content.split('\n')
-                        title = lines[0] if lines else "未知章節"
-                        key_content = '\n'.join(lines[1:min(8, len(lines))])
-                        relevant_content.append(f"{title}\n{key_content}")
-                        print(f"✓ Loaded random content from: {os.path.basename(file_path)}")
-                except Exception as e:
-                    print(f"✗ Error reading random file {file_path}: {e}")
-                    continue
+    if passages:
+        final_content = format_passages(passages)
+    elif knowledge_store.general_knowledge:
+        # Nothing matched at all: fall back to the general book summary
+        final_content = f"{GENERAL_KNOWLEDGE_TITLE}\n{knowledge_store.general_knowledge}"
+    else:
+        final_content = ""
     
-    final_content = "\n\n---\n\n".join(relevant_content)
-    print(f"\nTotal knowledge content loaded: {len(final_content)} characters")
-    print(f"Number of content sections: {len(relevant_content)}")
+    retrieval_logger.info(f"Total knowledge content loaded: {len(final_content)} characters, {len(passages)} passages")
     
     return final_content
 
 @app.route('/')
 def index():
     version = load_version()
-    print(f"Rendering index.html with version: '{version}'")
+    logger.debug(f"Rendering index.html with version: '{version}'")
     return render_template('index.html', version=version)
 
 @app.route('/process', methods=['POST'])
@@ -417,13 +405,33 @@ def process_text():
         if not paragraph or not tone or not language:
             return jsonify({'error': '請填寫所有必要欄位'}), 400
         
-        result = fine_tune_text(paragraph, tone, language)
+        with request_deadline(ENDPOINT_DEADLINES['process']):
+            result = fine_tune_text(paragraph, tone, language)
         
         return jsonify({'result': result})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/process/stream', methods=['POST'])
+def process_text_stream():
+    """Same as /process, but forwards the rewrite to the browser as it is generated"""
+    try:
+        data = request.json
+        paragraph = data.get('paragraph', '')
+        tone = data.get('tone', '')
+        language = data.get('language', '')
+        
+        if not paragraph or not tone or not language:
+            return jsonify({'error': '請填寫所有必要欄位'}), 400
+        
+        full_prompt = build_fine_tune_prompt(paragraph, tone, language)
+        
+        return sse_response(event_stream(stream_text(full_prompt)))
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/quiz')
 def quiz():
     version = load_version()
@@ -443,31 +451,180 @@ def generate_quiz_route():
         if not day:
             return jsonify({'error': '請選擇天數'}), 400
         
-        result = generate_quiz(day)
+        # Serve a pre-generated variant when one is ready, else generate live
+        chapter = knowledge_store.chapter_for_day(day)
+        result = quiz_bank.get(chapter.day) if chapter else None
+        if result is None:
+            with request_deadline(ENDPOINT_DEADLINES['generate-quiz']):
+                result = generate_quiz(day)
         
         return jsonify({'result': result})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/generate-quiz/stream', methods=['POST'])
+def generate_quiz_stream_route():
+    """Same as /generate-quiz, but streams the quiz; partial events carry the fields parsed so far"""
+    try:
+        data = request.json
+        day = data.get('day', '')
+        
+        if not day:
+            return jsonify({'error': '請選擇天數'}), 400
+        
+        # A pre-generated variant is sent whole as the done event
+        chapter = knowledge_store.chapter_for_day(day)
+        result = quiz_bank.get(chapter.day) if chapter else None
+        if result is not None:
+            return sse_response(iter([sse_event('done', {'result': result})]))
+        
+        full_prompt = build_quiz_prompt(day)
+        
+        return sse_response(event_stream(stream_text(full_prompt, generation_config=QUIZ_OUTPUT.generation_config),
+                                         finish=QUIZ_OUTPUT.parse, partial=QUIZ_OUTPUT.parser()))
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/generate-response', methods=['POST'])
 def generate_response_route():
     try:
-        data = request.json
-        text = data.get('text', '')
-        image = data.get('image', '')
-        tone = data.get('tone', '')
+        # JSON with a base64 image, or a multipart form with the image as a file
+        text, image, tone = read_reply_request(request)
         
         if not text or not tone:
             return jsonify({'error': '請填寫所有必要欄位'}), 400
         
-        result = generate_effective_response(text, image, tone)
+        with request_deadline(ENDPOINT_DEADLINES['generate-response']):
+            result = generate_effective_response(text, image, tone)
         
         return jsonify({'result': result})
         
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate-response/stream', methods=['POST'])
+def generate_response_stream_route():
+    """Same as /generate-response, but streams the reply; partial and done events carry the parsed result"""
+    try:
+        # JSON with a base64 image, or a multipart form with the image as a file
+        text, image, tone = read_reply_request(request)
+        
+        if not text or not tone:
+            return jsonify({'error': '請填寫所有必要欄位'}), 400
+        
+        full_prompt, image_data = build_effective_response_prompt(text, image, tone)
+        
+        return sse_response(event_stream(stream_text(full_prompt, image_data, generation_config=RESPONSE_OUTPUT.generation_config),
+                                         finish=RESPONSE_OUTPUT.parse, partial=RESPONSE_OUTPUT.parser()))
+        
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batch/process', methods=['POST'])
+def batch_process_route():
+    """Rewrite up to BATCH_MAX_ITEMS paragraphs concurrently, each with its own tone and language"""
+    try:
+        items = request.json.get('items')
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': '請提供要處理的段落列表'}), 400
+        
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'每次最多處理{BATCH_MAX_ITEMS}個段落'}), 400
+        
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            arguments = (item.get('paragraph', ''), item.get('tone', ''), item.get('language', ''))
+            if all(arguments):
+                valid.append((index, arguments))
+            else:
+                results[index] = {'error': '請填寫所有必要欄位'}
+        
+        logger.info(f"Processing batch of {len(items)} paragraphs...")
+        
+        with request_deadline(ENDPOINT_DEADLINES['batch']):
+            outcomes = run_batch([arguments for _, arguments in valid], lambda arguments: fine_tune_text(*arguments))
+        for (index, _), (result, error) in zip(valid, outcomes):
+            results[index] = batch_item(result, error)
+        
+        return jsonify({'results': results})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/quiz', methods=['POST'])
+def create_quiz_job():
+    """Queue a quiz generation; returns 202 with the job id to poll"""
+    try:
+        data = request.json
+        day = data.get('day', '')
+        webhook = data.get('webhook') or None
+        
+        if not day:
+            return jsonify({'error': '請選擇天數'}), 400
+        
+        if webhook and not job_queue.webhook_allowed(webhook):
+            return jsonify({'error': '不允許的通知網址'}), 400
+        
+        chapter = knowledge_store.chapter_for_day(day)
+        
+        def run():
+            result = quiz_bank.get(chapter.day) if chapter else None
+            return result if result is not None else generate_quiz(day)
+        
+        job = job_queue.submit('quiz', run, webhook)
+        return jsonify({'job_id': job['id'], 'status': job['status'], 'status_url': url_for('get_job', job_id=job['id'])}), 202
+        
+    except JobQueueFull:
+        return jsonify({'error': '目前排隊中的工作過多，請稍後再試'}), 503
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/response', methods=['POST'])
+def create_response_job():
+    """Queue an effective-reply generation; returns 202 with the job id to poll"""
+    try:
+        # Same image size limit as the synchronous reply routes
+        text, image, tone = read_reply_request(request)
+        webhook = request.json.get('webhook') or None
+        
+        if not text or not tone:
+            return jsonify({'error': '請填寫所有必要欄位'}), 400
+        
+        if webhook and not job_queue.webhook_allowed(webhook):
+            return jsonify({'error': '不允許的通知網址'}), 400
+        
+        job = job_queue.submit('response', lambda: generate_effective_response(text, image, tone), webhook)
+        return jsonify({'job_id': job['id'], 'status': job['status'], 'status_url': url_for('get_job', job_id=job['id'])}), 202
+        
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except JobQueueFull:
+        return jsonify({'error': '目前排隊中的工作過多，請稍後再試'}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def metrics_route():
+    """Prometheus metrics"""
+    return metrics_response()
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return a job's status, and its result or error once it has finished"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '找不到該任務或任務已過期'}), 404
+    return jsonify(job)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
     app.run(debug=False, host='0.0.0.0', port=port)
@@ -1,7 +1,7 @@
 import os
 import logging
 import google.generativeai as genai
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, url_for
 from flask_cors import CORS
 try:
     from flask_limiter import Limiter
@@ -9,24 +9,44 @@ try:
     LIMITER_AVAILABLE = True
 except ImportError:
     LIMITER_AVAILABLE = False
-    print("Warning: flask_limiter not available, rate limiting disabled")
 from dotenv import load_dotenv
 import re
 from datetime import datetime
+from app_logging import configure_logging, parse_sample_rates
+from batch import BATCH_MAX_ITEMS, batch_item, run_batch
+from gemini_client import generate_text, request_deadline, stream_text
+from image_prep import prepare_image
+from job_queue import JobQueue, JobQueueFull, JobStore
+from knowledge_store import GENERAL_KNOWLEDGE_TITLE, KeywordIndex, KnowledgeStore, format_passages
+from metrics import RETRIEVAL_LATENCY, instrument_app, metrics_response
+from prompt_registry import PromptRegistry
+from quiz_bank import QuizBank
+from response_cache import create_cache_backend
+from streaming import event_stream, sse_event, sse_response
+from structured_output import (ENCOURAGEMENT_OUTPUT, ENCOURAGEMENT_PACK_OUTPUT, QUIZ_OUTPUT,
+                               RESPONSE_OUTPUT)
+from uploads import MAX_REQUEST_BYTES, ImageUploadError, is_multipart, read_reply_request
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('tone_toner.log'),
-        logging.StreamHandler()
-    ]
+# Configure logging: JSON lines written by a background thread, so request
+# threads never wait on the log file or stderr. Per-request retrieval steps go
+# to the 'retrieval' logger, which is sampled; volume below WARNING is capped.
+configure_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    log_format=os.getenv('LOG_FORMAT', 'json'),
+    log_file=os.getenv('LOG_FILE', 'tone_toner.log') or None,
+    sampled_loggers=('retrieval',),
+    sample_rates=parse_sample_rates(os.getenv('LOG_SAMPLE_RATES', 'DEBUG=0.01,INFO=0.1')),
+    max_per_second=float(os.getenv('LOG_RATE_LIMIT', '200')),
+    max_pending=int(os.getenv('LOG_QUEUE_SIZE', '10000'))
 )
 logger = logging.getLogger(__name__)
+retrieval_logger = logging.getLogger('retrieval')
+
+if not LIMITER_AVAILABLE:
+    logger.warning("flask_limiter not available, rate limiting disabled")
 
 app = Flask(__name__)
 
@@ -34,10 +54,15 @@ app = Flask(__name__)
 app.config['ENV'] = 'production'
 app.config['DEBUG'] = False
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-change-this')
+# Larger request bodies are refused before they are read
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
 # CORS configuration - restrict in production
 CORS(app, origins=os.getenv('ALLOWED_ORIGINS', '*').split(','))
 
+# Per-route latency and in-flight requests, exported at /metrics
+instrument_app(app)
+
 # Rate limiting (if available)
 if LIMITER_AVAILABLE:
     limiter = Limiter(
@@ -57,32 +82,50 @@ if not api_key:
 logger.info("Configuring Gemini API...")
 genai.configure(api_key=api_key)
 
-def load_system_prompt():
-    """Load the system prompt from file"""
-    try:
-        with open('prompts/system_prompt.txt', 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        logger.error("System prompt file not found")
-        return "You are a helpful assistant that rewrites text."
-
-def load_response_prompt():
-    """Load the response prompt from file"""
-    try:
-        with open('prompts/response_prompt.txt', 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        logger.error("Response prompt file not found")
-        return "You are a helpful assistant that generates effective responses."
-
-def load_quiz_prompt():
-    """Load the quiz prompt from file"""
-    try:
-        with open('prompts/quiz_prompt.txt', 'r', encoding='utf-8') as f:
-            return f.read()
-    except FileNotFoundError:
-        logger.error("Quiz prompt file not found")
-        return "You are a helpful assistant that generates quiz questions."
+# Load the knowledge once; request handlers read from memory. The prebuilt
+# index (python knowledge_index.py) is memory-mapped when it is up to date.
+knowledge_store = KnowledgeStore().load(os.getenv('KNOWLEDGE_INDEX_PATH', 'knowledge.idx'))
+
+# Optional embedding-based passage ranking (needs numpy), e.g. KNOWLEDGE_RETRIEVAL=semantic
+if os.getenv('KNOWLEDGE_RETRIEVAL', 'bm25') == 'semantic':
+    knowledge_store.enable_semantic_search()
+
+# Prompt files are read once and reloaded when they change on disk
+prompts = PromptRegistry(
+    'prompts',
+    fallbacks={
+        'system_prompt.txt': "You are a helpful assistant that rewrites text.",
+        'response_prompt.txt': "You are a helpful assistant that generates effective responses.",
+        'quiz_prompt.txt': "You are a helpful assistant that generates quiz questions.",
+        'encouragement_prompt.txt': "You are a helpful assistant that encourages learners.",
+    },
+    check_interval=float(os.getenv('PROMPT_RELOAD_INTERVAL', '1'))
+)
+
+FINE_TUNE_USER_PROMPT = """
+        [Tone]: {tone}
+        [Language or Dialect]: {language}
+        
+        原文段落:
+        {paragraph}
+        
+        請根據上述語調和語言要求，重寫這個段落為三個不同的選項。
+        """
+
+RESPONSE_USER_PROMPT = """
+        用戶輸入：{text}
+        語調要求：{tone}
+        相關書本知識：{relevant_knowledge}
+        {image_note}"""
+
+QUIZ_USER_PROMPT = """
+        請根據以下章節內容生成測驗題：
+        
+        章節內容：
+        {chapter_content}
+        
+        請確保使用正確的章節編號：第{day_number}天
+        """
 
 def validate_input(paragraph, tone, language):
     """Validate user input"""
@@ -107,30 +150,22 @@ def validate_input(paragraph, tone, language):
     
     return True, ""
 
+def build_fine_tune_prompt(paragraph, tone, language):
+    """Build the full rewrite prompt for a paragraph"""
+    return prompts.render('system_prompt.txt', FINE_TUNE_USER_PROMPT,
+                          tone=tone, language=language, paragraph=paragraph)
+
 def fine_tune_text(paragraph, tone, language):
     """Fine-tune the paragraph using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        system_prompt = load_system_prompt()
-        user_prompt = f"""
-        [Tone]: {tone}
-        [Language or Dialect]: {language}
-        
-        原文段落:
-        {paragraph}
-        
-        請根據上述語調和語言要求，重寫這個段落為三個不同的選項。
-        """
-        
-        full_prompt = system_prompt + "\n\n" + user_prompt
+        full_prompt = build_fine_tune_prompt(paragraph, tone, language)
         
         logger.info(f"Processing request - Tone: {tone}, Language: {language}")
-        response = model.generate_content(full_prompt)
+        response_text = generate_text(full_prompt)
         
-        if response.text:
+        if response_text:
             logger.info("Successfully generated response")
-            return response.text
+            return response_text
         else:
             logger.warning("Empty response from API")
             return "錯誤: API 回應為空"
@@ -139,73 +174,91 @@ def fine_tune_text(paragraph, tone, language):
         logger.error(f"Error in fine_tune_text: {str(e)}")
         return f"錯誤: 服務暫時不可用，請稍後再試"
 
-def generate_effective_response(text, image_base64, tone):
+def build_effective_response_prompt(text, image, tone):
+    """Build the reply prompt and optional image part for a member's post"""
+    # Find relevant knowledge content based on user input
+    relevant_knowledge = find_relevant_knowledge(text)
+    
+    full_prompt = prompts.render(
+        'response_prompt.txt', RESPONSE_USER_PROMPT,
+        text=text, tone=tone, relevant_knowledge=relevant_knowledge,
+        image_note="\n\n圖片已上傳，請分析圖片內容並納入回應考慮。" if image else ""
+    )
+    
+    logger.info(f"Generating effective response with tone: {tone}...")
+    retrieval_logger.info(f"Relevant knowledge found: {len(relevant_knowledge)} characters")
+    
+    # Handle image analysis: form uploads arrive as an image part with raw
+    # bytes, JSON requests carry base64
+    if isinstance(image, dict):
+        image_data = image
+    else:
+        image_data = {"mime_type": "image/jpeg", "data": image} if image else None
+    # Detect the real format; shrink large photos to what the model needs
+    if image_data:
+        image_data = prepare_image(image_data)
+    return full_prompt, image_data
+
+def generate_effective_response(text, image, tone):
     """Generate effective responses using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        full_prompt, image_data = build_effective_response_prompt(text, image, tone)
         
-        response_prompt = load_response_prompt()
+        response_text = generate_text(full_prompt, image_data, generation_config=RESPONSE_OUTPUT.generation_config)
         
-        # Find relevant knowledge content based on user input
-        relevant_knowledge = find_relevant_knowledge(text)
+        logger.debug(f"Response generation: {len(response_text)} characters")
         
-        user_prompt = f"""
-        用戶輸入：{text}
-        語調要求：{tone}
-        相關書本知識：{relevant_knowledge}
-        """
-        
-        if image_base64:
-            user_prompt += f"\n\n圖片已上傳，請分析圖片內容並納入回應考慮。"
-        
-        full_prompt = response_prompt + "\n\n" + user_prompt
-        
-        print(f"Generating effective response with tone: {tone}...")
-        print(f"Relevant knowledge found: {len(relevant_knowledge)} characters")
-        
-        if image_base64:
-            # Handle image analysis
-            image_data = {"mime_type": "image/jpeg", "data": image_base64}
-            response = model.generate_content([full_prompt, image_data])
-        else:
-            response = model.generate_content(full_prompt)
-        
-        print(f"Response generation: {response.text[:200]}...")
-        
-        if response.text:
-            return response.text
+        if response_text:
+            # The parsed feeling/knowledge object, or the raw text if it can't be repaired
+            return RESPONSE_OUTPUT.parse(response_text)
         else:
             return "錯誤: API 回應為空"
         
     except Exception as e:
-        print(f"Error in generate_effective_response: {str(e)}")
+        logger.error(f"Error in generate_effective_response: {str(e)}")
         return f"錯誤: {str(e)}"
 
+# Keywords that might indicate specific topics
+TOPIC_KEYWORDS = {
+    '維生素': ['維生素', 'vitamin', '維他命'],
+    '蛋白質': ['蛋白質', 'protein', '氨基酸'],
+    '脂肪': ['脂肪', 'fat', '油', '膽固醇'],
+    '碳水化合物': ['碳水化合物', 'carb', '糖', '澱粉'],
+    '礦物質': ['礦物質', 'mineral', '鈣', '鐵', '鋅'],
+    '早餐': ['早餐', 'breakfast', '早上'],
+    '營養補充': ['營養補充', 'supplement', '補充劑'],
+    '烹調': ['烹調', 'cooking', '煮', '蒸', '炒'],
+    '健康': ['健康', 'health', '養生'],
+    '疾病': ['疾病', 'disease', '病', '症狀']
+}
+
+# Inverted index over every topic and keyword, built once from the in-memory chapters
+keyword_index = KeywordIndex(
+    knowledge_store.chapters,
+    [term for topic, topic_keywords in TOPIC_KEYWORDS.items() for term in [topic] + topic_keywords]
+)
+
+# Seconds each endpoint may spend on Gemini calls (queueing, retries and hedges
+# included); kept under gunicorn's 30s worker timeout
+ENDPOINT_DEADLINES = {
+    'process': float(os.getenv('PROCESS_DEADLINE', '25')),
+    'generate-encouragement': float(os.getenv('GENERATE_ENCOURAGEMENT_DEADLINE', '25')),
+    'generate-quiz': float(os.getenv('GENERATE_QUIZ_DEADLINE', '25')),
+    'generate-response': float(os.getenv('GENERATE_RESPONSE_DEADLINE', '25')),
+    'batch': float(os.getenv('BATCH_DEADLINE', '25'))
+}
+
+# Character budget for the book passages added to the response prompt
+KNOWLEDGE_CHAR_BUDGET = int(os.getenv('KNOWLEDGE_CHAR_BUDGET', '1500'))
+
+@RETRIEVAL_LATENCY.time()
 def find_relevant_knowledge(user_input):
     """Find relevant knowledge content based on user input"""
-    import glob
-    import os
-    import re
-    
-    # Keywords that might indicate specific topics
-    keywords = {
-        '維生素': ['維生素', 'vitamin', '維他命'],
-        '蛋白質': ['蛋白質', 'protein', '氨基酸'],
-        '脂肪': ['脂肪', 'fat', '油', '膽固醇'],
-        '碳水化合物': ['碳水化合物', 'carb', '糖', '澱粉'],
-        '礦物質': ['礦物質', 'mineral', '鈣', '鐵', '鋅'],
-        '早餐': ['早餐', 'breakfast', '早上'],
-        '營養補充': ['營養補充', 'supplement', '補充劑'],
-        '烹調': ['烹調', 'cooking', '煮', '蒸', '炒'],
-        '健康': ['健康', 'health', '養生'],
-        '疾病': ['疾病', 'disease', '病', '症狀']
-    }
-    
     # Find matching topics
     relevant_topics = []
     user_input_lower = user_input.lower()
     
-    for topic, topic_keywords in keywords.items():
+    for topic, topic_keywords in TOPIC_KEYWORDS.items():
         for keyword in topic_keywords:
             if keyword.lower() in user_input_lower:
                 relevant_topics.append(topic)
@@ -215,138 +268,52 @@ def find_relevant_knowledge(user_input):
     if not relevant_topics:
         relevant_topics = ['general']
     
-    # Load relevant chapter content
-    relevant_content = []
+    # Restrict the passage search to chapters mentioning a detected topic
+    relevant_positions = None
+    if relevant_topics != ['general']:
+        relevant_positions = set()
+        for topic in relevant_topics:
+            relevant_positions |= keyword_index.chapters_with_any([topic] + TOPIC_KEYWORDS.get(topic, []))
     
-    # Always include some general knowledge
-    try:
-        with open('book_knowledge.txt', 'r', encoding='utf-8') as f:
-            general_knowledge = f.read()
-            relevant_content.append(f"一般營養知識：\n{general_knowledge}")
-    except:
-        pass
-    
-    # Load specific chapter content based on topics
-    knowledge_files = glob.glob('knowledge/*.md')
+    # Only the passages that match the input go into the prompt
+    passages = knowledge_store.select_passages(user_input, KNOWLEDGE_CHAR_BUDGET, relevant_positions)
+    if not passages and relevant_positions is not None:
+        passages = knowledge_store.select_passages(user_input, KNOWLEDGE_CHAR_BUDGET)
     
-    for file_path in knowledge_files:
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                
-                # Check if this chapter is relevant to the user's input
-                is_relevant = False
-                for topic in relevant_topics:
-                    if topic in content or any(keyword in content for keyword in keywords.get(topic, [])):
-                        is_relevant = True
-                        break
-                
-                if is_relevant:
-                    # Extract chapter title and key content
-                    lines = content.split('\n')
-                    title = lines[0] if lines else "未知章節"
-                    # Get first few paragraphs for context
-                    key_content = '\n'.join(lines[1:min(10, len(lines))])
-                    relevant_content.append(f"{title}\n{key_content}")
-                    
-        except Exception as e:
-            print(f"Error reading knowledge file {file_path}: {e}")
-            continue
+    if passages:
+        return format_passages(passages)
     
-    # If no specific content found, try to find chapters that might be relevant
-    if len(relevant_content) <= 1:  # Only general knowledge
-        # Load a few random chapters to provide context
-        import random
-        knowledge_files = glob.glob('knowledge/*.md')
-        if knowledge_files:
-            selected_files = random.sample(knowledge_files, min(3, len(knowledge_files)))
-            for file_path in selected_files:
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        lines = content.split('\n')
-                        title = lines[0] if lines else "未知章節"
-                        key_content = '\n'.join(lines[1:min(8, len(lines))])
-                        relevant_content.append(f"{title}\n{key_content}")
-                except:
-                    continue
-    
-    return "\n\n---\n\n".join(relevant_content)
+    # Nothing matched at all: fall back to the general book summary
+    if knowledge_store.general_knowledge:
+        return f"{GENERAL_KNOWLEDGE_TITLE}\n{knowledge_store.general_knowledge}"
+    return ""
 
 def get_chapter_content(day_number):
     """Get content from the knowledge directory for a specific day"""
-    import glob
-    import os
-    
-    # Try to find the chapter file with different naming patterns
-    patterns = [
-        f"knowledge/第{day_number}天：*.md",
-        f"knowledge/第 {day_number} 天：*.md",
-        f"knowledge/第{day_number}天*.md",
-        f"knowledge/第 {day_number} 天*.md"
-    ]
-    
-    for pattern in patterns:
-        files = glob.glob(pattern)
-        if files:
-            try:
-                with open(files[0], 'r', encoding='utf-8') as f:
-                    return f.read()
-            except Exception as e:
-                logger.error(f"Error reading file {files[0]}: {e}")
-                continue
+    chapter = knowledge_store.chapter_for_day(day_number)
+    if chapter:
+        return chapter.content
     
     return f"第{day_number}課的內容未找到"
 
-def generate_quiz(day_number):
+def build_quiz_prompt(day_number):
+    """Build the quiz prompt for a day's chapter"""
+    chapter_content = get_chapter_content(day_number)
+    # Instructions plus chapter repeat for every quiz of the day: cacheable as a context
+    return prompts.render('quiz_prompt.txt', QUIZ_USER_PROMPT, context_through='chapter_content',
+                          chapter_content=chapter_content, day_number=day_number)
+
+def generate_quiz(day_number, use_cache=True):
     """Generate quiz questions and answers using Gemini API"""
     try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        quiz_prompt = load_quiz_prompt()
-        chapter_content = get_chapter_content(day_number)
-        
-        user_prompt = f"""
-        請根據以下章節內容生成測驗題：
-        
-        章節內容：
-        {chapter_content}
-        
-        請確保使用正確的章節編號：第{day_number}天
-        """
-        
-        full_prompt = quiz_prompt + "\n\n" + user_prompt
+        full_prompt = build_quiz_prompt(day_number)
         
         logger.info(f"Generating quiz for day {day_number}...")
-        response = model.generate_content(full_prompt)
-        
-        if response.text:
-            # Try to parse as JSON
-            try:
-                # Clean up the response text - remove markdown code blocks if present
-                clean_text = response.text.strip()
-                
-                # Remove markdown code blocks more thoroughly
-                if '```json' in clean_text:
-                    # Extract content between ```json and ```
-                    start = clean_text.find('```json') + 7
-                    end = clean_text.rfind('```')
-                    if end > start:
-                        clean_text = clean_text[start:end].strip()
-                elif clean_text.startswith('```') and clean_text.endswith('```'):
-                    # Remove ``` at start and end
-                    clean_text = clean_text[3:-3].strip()
-                
-                logger.info(f"Cleaned text for JSON parsing: {clean_text[:100]}...")
-                
-                import json
-                quiz_data = json.loads(clean_text)
-                logger.info("Successfully parsed JSON response")
-                return quiz_data  # Return the actual JSON object, not a string
-            except json.JSONDecodeError as e:
-                logger.warning(f"JSON parsing failed: {e}")
-                logger.info("Falling back to plain text response")
-                return response.text
+        response_text = generate_text(full_prompt, use_cache=use_cache, generation_config=QUIZ_OUTPUT.generation_config)
+        
+        if response_text:
+            # The parsed quiz object, or the raw text if it can't be repaired
+            return QUIZ_OUTPUT.parse(response_text)
         else:
             logger.warning("Empty response from API")
             return "錯誤: API 回應為空"
@@ -355,35 +322,34 @@ def generate_quiz(day_number):
         logger.error(f"Error in generate_quiz: {str(e)}")
         return f"錯誤: {str(e)}"
 
-def generate_encouragement(user_input):
-    """Generate encouragement based on user input analysis"""
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        
-        encouragement_prompt = """
-你是一個專業的學習群組管理員，專門分析學員分享的內容並提供合適的鼓勵回覆。
-
-請分析用戶分享的內容，並根據以下5種鼓勵類型選擇最合適的一種：
-
-1. 👍【精華筆記】- 適合詳盡整理、條列清晰、重點到位的分享
-2. 🌟【深度學習】- 適合用心提煉書中精華+個人實踐心得的分享  
-3. 📚【優質分享】- 適合結構化筆記+金句標註的認真分享
-4. 💡【知識燈塔】- 適合從理論到案例解析都超扎實的深度分享
-5. 🎯【學習楷模】- 適合附有「行動清單」等實用內容的分享
+# Quizzes are pre-generated per chapter in the background (QUIZ_BANK_VARIANTS=0 disables)
+# and shared by every worker when REDIS_URL is set. A day is regenerated only once
+# its fresh variants drop below QUIZ_BANK_LOW_WATER; bank variants bypass the
+# response cache, which would hand back the same quiz for every variant.
+QUIZ_BANK_TTL = int(os.getenv('QUIZ_BANK_TTL', '21600'))
+quiz_bank = QuizBank(
+    lambda day: generate_quiz(str(day), use_cache=False),
+    sorted(knowledge_store.by_day),
+    create_cache_backend(max_entries=256, ttl_seconds=QUIZ_BANK_TTL, prefix='cknbook:quiz_bank:'),
+    variants_per_day=int(os.getenv('QUIZ_BANK_VARIANTS', '2')),
+    low_water=int(os.getenv('QUIZ_BANK_LOW_WATER', '1')),
+    ttl_seconds=QUIZ_BANK_TTL,
+    path=os.getenv('QUIZ_BANK_PATH', '.cache/quiz_bank.json')
+)
 
-重要：encouragement 欄位必須使用廣東話（粵語）表達，不能使用普通話。
+# Quiz and reply generations can also run as background jobs: POST /jobs/...
+# returns a job id at once, clients poll GET /jobs/<id> or get a webhook
+JOB_TTL = int(os.getenv('JOB_TTL', '3600'))
+JOB_POLL_RATE_LIMIT = os.getenv('JOB_POLL_RATE_LIMIT', '120 per minute')
+job_queue = JobQueue(
+    JobStore(create_cache_backend(ttl_seconds=JOB_TTL, prefix='cknbook:job:'), ttl_seconds=JOB_TTL),
+    max_workers=int(os.getenv('JOB_WORKERS', '4')),
+    max_pending=int(os.getenv('JOB_MAX_PENDING', '100')),
+    deadline=float(os.getenv('JOB_DEADLINE', '120')),
+    webhook_allowlist=os.getenv('JOB_WEBHOOK_ALLOWLIST', '').split(',')
+)
 
-請以JSON格式回覆：
-{
-    "analysis": "對分享內容的簡短分析（50字內）",
-    "type": "推薦的鼓勵類型（包含emoji和標題）",
-    "encouragement1": "第一個鼓勵回覆選項，必須使用廣東話（粵語）表達，限制在30字以內",
-    "encouragement2": "第二個鼓勵回覆選項，必須使用廣東話（粵語）表達，限制在30字以內",
-    "encouragement3": "第三個鼓勵回覆選項，必須使用廣東話（粵語）表達，限制在30字以內"
-}
-"""
-        
-        user_prompt = f"""
+ENCOURAGEMENT_USER_PROMPT = """
 學員分享內容：
 {user_input}
 
@@ -400,39 +366,34 @@ def generate_encouragement(user_input):
 
 不要使用普通話。
 """
-        
-        full_prompt = encouragement_prompt + "\n\n" + user_prompt
+
+ENCOURAGEMENT_PACK_USER_PROMPT = """
+以下有 {count} 位學員的分享，每篇以【分享 N】開頭：
+
+{posts}
+
+請逐篇獨立分析，每篇選擇最合適的鼓勵類型，並生成3個不同的鼓勵回覆選項：
+- 選項1：溫馨鼓勵風格
+- 選項2：活潑讚美風格  
+- 選項3：實用建議風格
+
+所有encouragement選項都必須使用廣東話（粵語）來表達，不要使用普通話。
+
+請輸出一個JSON陣列，每篇分享對應一個物件，依分享次序排列，並加上 "id" 欄位（分享編號 N），其餘欄位與上面的JSON格式相同：
+[{{"id": 1, "analysis": "...", "type": "...", "encouragement1": "...", "encouragement2": "...", "encouragement3": "..."}}]
+"""
+
+def generate_encouragement(user_input):
+    """Generate encouragement based on user input analysis"""
+    try:
+        full_prompt = prompts.render('encouragement_prompt.txt', ENCOURAGEMENT_USER_PROMPT, user_input=user_input)
         
         logger.info(f"Generating encouragement for input length: {len(user_input)}")
-        response = model.generate_content(full_prompt)
-        
-        if response.text:
-            # Try to parse as JSON
-            try:
-                # Clean up the response text - remove markdown code blocks if present
-                clean_text = response.text.strip()
-                
-                # Remove markdown code blocks more thoroughly
-                if '```json' in clean_text:
-                    # Extract content between ```json and ```
-                    start = clean_text.find('```json') + 7
-                    end = clean_text.rfind('```')
-                    if end > start:
-                        clean_text = clean_text[start:end].strip()
-                elif clean_text.startswith('```') and clean_text.endswith('```'):
-                    # Remove ``` at start and end
-                    clean_text = clean_text[3:-3].strip()
-                
-                logger.info(f"Cleaned text for JSON parsing: {clean_text[:100]}...")
-                
-                import json
-                response_data = json.loads(clean_text)
-                logger.info("Successfully parsed JSON response")
-                return response_data  # Return the actual JSON object, not a string
-            except json.JSONDecodeError as e:
-                logger.warning(f"JSON parsing failed: {e}")
-                logger.info("Falling back to plain text response")
-                return response.text
+        response_text = generate_text(full_prompt, generation_config=ENCOURAGEMENT_OUTPUT.generation_config)
+        
+        if response_text:
+            # The parsed encouragement object, or the raw text if it can't be repaired
+            return ENCOURAGEMENT_OUTPUT.parse(response_text)
         else:
             logger.warning("Empty response from API")
             return "錯誤: API 回應為空"
@@ -441,6 +402,38 @@ def generate_encouragement(user_input):
         logger.error(f"Error in generate_encouragement: {str(e)}")
         return f"錯誤: {str(e)}"
 
+# Posts encouraged per model call in /batch/encouragement (1 disables packing)
+BATCH_PACK_SIZE = int(os.getenv('BATCH_PACK_SIZE', '5'))
+
+def generate_encouragement_pack(user_inputs):
+    """Encourage several posts with one model call; returns one result per input.
+
+    Posts the model skipped or answered malformed fall back to an
+    individual generate_encouragement call.
+    """
+    if len(user_inputs) == 1:
+        return [generate_encouragement(user_inputs[0])]
+    
+    posts = "\n\n".join(f"【分享 {number}】\n{user_input}" for number, user_input in enumerate(user_inputs, 1))
+    full_prompt = prompts.render('encouragement_prompt.txt', ENCOURAGEMENT_PACK_USER_PROMPT,
+                                 count=len(user_inputs), posts=posts)
+    
+    logger.info(f"Generating encouragement for {len(user_inputs)} posts in one call")
+    results = [None] * len(user_inputs)
+    try:
+        response_text = generate_text(full_prompt, generation_config=ENCOURAGEMENT_PACK_OUTPUT.generation_config)
+        items = ENCOURAGEMENT_PACK_OUTPUT.parse(response_text) if response_text else None
+        for item in items if isinstance(items, list) else []:
+            if isinstance(item, dict) and isinstance(item.get('id'), int) and 1 <= item['id'] <= len(user_inputs):
+                results[item.pop('id') - 1] = item
+    except Exception as e:
+        logger.warning(f"Packed encouragement failed, answering posts one by one: {str(e)}")
+    
+    for position, result in enumerate(results):
+        if result is None:
+            results[position] = generate_encouragement(user_inputs[position])
+    return results
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -477,7 +470,8 @@ def process_text():
         # Log request (without sensitive data)
         logger.info(f"Processing request - Length: {len(paragraph)}, Tone: {tone}, Language: {language}")
         
-        result = fine_tune_text(paragraph, tone, language)
+        with request_deadline(ENDPOINT_DEADLINES['process']):
+            result = fine_tune_text(paragraph, tone, language)
         
         return jsonify({'result': result})
         
@@ -485,6 +479,34 @@ def process_text():
         logger.error(f"Error in process_text: {str(e)}")
         return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
 
+@app.route('/process/stream', methods=['POST'])
+def process_text_stream():
+    """Same as /process, but forwards the rewrite to the browser as it is generated"""
+    try:
+        if not request.is_json:
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        data = request.json
+        paragraph = data.get('paragraph', '').strip()
+        tone = data.get('tone', '')
+        language = data.get('language', '')
+        
+        # Validate input
+        is_valid, error_msg = validate_input(paragraph, tone, language)
+        if not is_valid:
+            logger.warning(f"Invalid input: {error_msg}")
+            return jsonify({'error': error_msg}), 400
+        
+        logger.info(f"Streaming request - Length: {len(paragraph)}, Tone: {tone}, Language: {language}")
+        
+        full_prompt = build_fine_tune_prompt(paragraph, tone, language)
+        
+        return sse_response(event_stream(stream_text(full_prompt), error_message="錯誤: 服務暫時不可用，請稍後再試"))
+        
+    except Exception as e:
+        logger.error(f"Error in process_text_stream: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
 @app.errorhandler(429)
 def rate_limit_handler(e):
     return jsonify({'error': '請求過於頻繁，請稍後再試'}), 429
@@ -511,7 +533,8 @@ def generate_encouragement_route():
         # Log request
         logger.info(f"Processing encouragement request - Length: {len(user_input)}")
         
-        result = generate_encouragement(user_input)
+        with request_deadline(ENDPOINT_DEADLINES['generate-encouragement']):
+            result = generate_encouragement(user_input)
         
         return jsonify({'result': result})
         
@@ -534,7 +557,12 @@ def generate_quiz_route():
         # Log request
         logger.info(f"Processing quiz request for day: {day}")
         
-        result = generate_quiz(day)
+        # Serve a pre-generated variant when one is ready, else generate live
+        chapter = knowledge_store.chapter_for_day(day)
+        result = quiz_bank.get(chapter.day) if chapter else None
+        if result is None:
+            with request_deadline(ENDPOINT_DEADLINES['generate-quiz']):
+                result = generate_quiz(day)
         
         return jsonify({'result': result})
         
@@ -542,16 +570,47 @@ def generate_quiz_route():
         logger.error(f"Error in generate_quiz_route: {str(e)}")
         return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
 
-@app.route('/generate-response', methods=['POST'])
-def generate_response_route():
+@app.route('/generate-quiz/stream', methods=['POST'])
+def generate_quiz_stream_route():
+    """Same as /generate-quiz, but streams the quiz; partial events carry the fields parsed so far"""
     try:
         if not request.is_json:
             return jsonify({'error': '請求格式錯誤'}), 400
             
         data = request.json
-        text = data.get('text', '').strip()
-        image = data.get('image', '')
-        tone = data.get('tone', '').strip()
+        day = data.get('day', '').strip()
+        
+        if not day:
+            return jsonify({'error': '請選擇天數'}), 400
+        
+        logger.info(f"Streaming quiz request for day: {day}")
+        
+        # A pre-generated variant is sent whole as the done event
+        chapter = knowledge_store.chapter_for_day(day)
+        result = quiz_bank.get(chapter.day) if chapter else None
+        if result is not None:
+            return sse_response(iter([sse_event('done', {'result': result})]))
+        
+        full_prompt = build_quiz_prompt(day)
+        
+        return sse_response(event_stream(stream_text(full_prompt, generation_config=QUIZ_OUTPUT.generation_config),
+                                         finish=QUIZ_OUTPUT.parse, partial=QUIZ_OUTPUT.parser(),
+                                         error_message="錯誤: 服務暫時不可用，請稍後再試"))
+        
+    except Exception as e:
+        logger.error(f"Error in generate_quiz_stream_route: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
+@app.route('/generate-response', methods=['POST'])
+def generate_response_route():
+    try:
+        if not request.is_json and not is_multipart(request):
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        # JSON with a base64 image, or a multipart form with the image as a file
+        text, image, tone = read_reply_request(request)
+        text = text.strip()
+        tone = tone.strip()
         
         if not text or not tone:
             return jsonify({'error': '請填寫所有必要欄位'}), 400
@@ -562,14 +621,222 @@ def generate_response_route():
         # Log request
         logger.info(f"Processing response request - Length: {len(text)}, Tone: {tone}")
         
-        result = generate_effective_response(text, image, tone)
+        with request_deadline(ENDPOINT_DEADLINES['generate-response']):
+            result = generate_effective_response(text, image, tone)
         
         return jsonify({'result': result})
         
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), e.status
     except Exception as e:
         logger.error(f"Error in generate_response_route: {str(e)}")
         return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
 
+@app.route('/generate-response/stream', methods=['POST'])
+def generate_response_stream_route():
+    """Same as /generate-response, but streams the reply; partial and done events carry the parsed result"""
+    try:
+        if not request.is_json and not is_multipart(request):
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        # JSON with a base64 image, or a multipart form with the image as a file
+        text, image, tone = read_reply_request(request)
+        text = text.strip()
+        tone = tone.strip()
+        
+        if not text or not tone:
+            return jsonify({'error': '請填寫所有必要欄位'}), 400
+        
+        if len(text) > 2000:
+            return jsonify({'error': '輸入內容過長，請限制在2000字元以內'}), 400
+        
+        logger.info(f"Streaming response request - Length: {len(text)}, Tone: {tone}")
+        
+        full_prompt, image_data = build_effective_response_prompt(text, image, tone)
+        
+        return sse_response(event_stream(stream_text(full_prompt, image_data, generation_config=RESPONSE_OUTPUT.generation_config),
+                                         finish=RESPONSE_OUTPUT.parse, partial=RESPONSE_OUTPUT.parser(),
+                                         error_message="錯誤: 服務暫時不可用，請稍後再試"))
+        
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        logger.error(f"Error in generate_response_stream_route: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
+@app.route('/batch/encouragement', methods=['POST'])
+def batch_encouragement_route():
+    """Encourage up to BATCH_MAX_ITEMS posts; returns one result or error per input, in order"""
+    try:
+        if not request.is_json:
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        inputs = request.json.get('inputs')
+        
+        if not isinstance(inputs, list) or not inputs:
+            return jsonify({'error': '請提供學員分享的內容列表'}), 400
+        
+        if len(inputs) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'每次最多處理{BATCH_MAX_ITEMS}篇分享'}), 400
+        
+        results = [None] * len(inputs)
+        valid = []
+        for index, user_input in enumerate(inputs):
+            user_input = user_input.strip() if isinstance(user_input, str) else ''
+            if not user_input:
+                results[index] = {'error': '請輸入學員分享的內容'}
+            elif len(user_input) > 2000:
+                results[index] = {'error': '輸入內容過長，請限制在2000字元以內'}
+            else:
+                valid.append((index, user_input))
+        
+        logger.info(f"Processing batch encouragement request - Items: {len(inputs)}")
+        
+        packs = [valid[start:start + max(1, BATCH_PACK_SIZE)] for start in range(0, len(valid), max(1, BATCH_PACK_SIZE))]
+        with request_deadline(ENDPOINT_DEADLINES['batch']):
+            outcomes = run_batch(packs, lambda pack: generate_encouragement_pack([text for _, text in pack]))
+        for pack, (pack_results, error) in zip(packs, outcomes):
+            for position, (index, _) in enumerate(pack):
+                result = pack_results[position] if pack_results else None
+                results[index] = batch_item(result, error, error_message='處理時發生錯誤，請稍後再試')
+        
+        return jsonify({'results': results})
+        
+    except Exception as e:
+        logger.error(f"Error in batch_encouragement_route: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
+@app.route('/batch/process', methods=['POST'])
+def batch_process_route():
+    """Rewrite up to BATCH_MAX_ITEMS paragraphs concurrently, each with its own tone and language"""
+    try:
+        if not request.is_json:
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        items = request.json.get('items')
+        
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': '請提供要處理的段落列表'}), 400
+        
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({'error': f'每次最多處理{BATCH_MAX_ITEMS}個段落'}), 400
+        
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            item = item if isinstance(item, dict) else {}
+            paragraph = str(item.get('paragraph', '')).strip()
+            tone = item.get('tone', '')
+            language = item.get('language', '')
+            is_valid, error_msg = validate_input(paragraph, tone, language)
+            if is_valid:
+                valid.append((index, (paragraph, tone, language)))
+            else:
+                results[index] = {'error': error_msg}
+        
+        logger.info(f"Processing batch rewrite request - Items: {len(items)}")
+        
+        with request_deadline(ENDPOINT_DEADLINES['batch']):
+            outcomes = run_batch([arguments for _, arguments in valid], lambda arguments: fine_tune_text(*arguments))
+        for (index, _), (result, error) in zip(valid, outcomes):
+            results[index] = batch_item(result, error, error_message='處理時發生錯誤，請稍後再試')
+        
+        return jsonify({'results': results})
+        
+    except Exception as e:
+        logger.error(f"Error in batch_process_route: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
+@app.route('/jobs/quiz', methods=['POST'])
+def create_quiz_job():
+    """Queue a quiz generation; returns 202 with the job id to poll"""
+    try:
+        if not request.is_json:
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        data = request.json
+        day = data.get('day', '').strip()
+        webhook = data.get('webhook') or None
+        
+        if not day:
+            return jsonify({'error': '請選擇天數'}), 400
+        
+        if webhook and not job_queue.webhook_allowed(webhook):
+            return jsonify({'error': '不允許的通知網址'}), 400
+        
+        chapter = knowledge_store.chapter_for_day(day)
+        
+        def run():
+            result = quiz_bank.get(chapter.day) if chapter else None
+            return result if result is not None else generate_quiz(day)
+        
+        job = job_queue.submit('quiz', run, webhook)
+        return jsonify({'job_id': job['id'], 'status': job['status'], 'status_url': url_for('get_job', job_id=job['id'])}), 202
+        
+    except JobQueueFull as e:
+        logger.warning(f"Refused quiz job: {str(e)}")
+        return jsonify({'error': '目前排隊中的工作過多，請稍後再試'}), 503
+    except Exception as e:
+        logger.error(f"Error in create_quiz_job: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
+@app.route('/jobs/response', methods=['POST'])
+def create_response_job():
+    """Queue an effective-reply generation; returns 202 with the job id to poll"""
+    try:
+        if not request.is_json:
+            return jsonify({'error': '請求格式錯誤'}), 400
+            
+        # Same image size limit as the synchronous reply routes
+        text, image, tone = read_reply_request(request)
+        text = text.strip()
+        tone = tone.strip()
+        webhook = request.json.get('webhook') or None
+        
+        if not text or not tone:
+            return jsonify({'error': '請填寫所有必要欄位'}), 400
+        
+        if len(text) > 2000:
+            return jsonify({'error': '輸入內容過長，請限制在2000字元以內'}), 400
+        
+        if webhook and not job_queue.webhook_allowed(webhook):
+            return jsonify({'error': '不允許的通知網址'}), 400
+        
+        job = job_queue.submit('response', lambda: generate_effective_response(text, image, tone), webhook)
+        return jsonify({'job_id': job['id'], 'status': job['status'], 'status_url': url_for('get_job', job_id=job['id'])}), 202
+        
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), e.status
+    except JobQueueFull as e:
+        logger.warning(f"Refused response job: {str(e)}")
+        return jsonify({'error': '目前排隊中的工作過多，請稍後再試'}), 503
+    except Exception as e:
+        logger.error(f"Error in create_response_job: {str(e)}")
+        return jsonify({'error': '處理時發生錯誤，請稍後再試'}), 500
+
+@app.route('/metrics')
+def metrics_route():
+    """Prometheus metrics, summed over every gunicorn worker; needs METRICS_TOKEN"""
+    return metrics_response(require_token=True)
+
+if limiter:
+    # Scrapes must not use up the per-client request limits; the bearer token guards the route
+    limiter.exempt(metrics_route)
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return a job's status, and its result or error once it has finished"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': '找不到該任務或任務已過期'}), 404
+    return jsonify(job)
+
+if limiter:
+    # Clients poll a job every second or two until it finishes (up to JOB_DEADLINE), so
+    # it gets its own limit instead of the defaults. flask-limiter checks a decorated
+    # limit in the wrapper it returns, so the wrapper replaces the registered view.
+    app.view_functions['get_job'] = limiter.limit(JOB_POLL_RATE_LIMIT)(get_job)
+
 @app.errorhandler(500)
 def internal_error_handler(e):
     logger.error(f"Internal server error: {str(e)}")
@@ -0,0 +1,261 @@
+"""Prometheus metrics for the web app and its Gemini calls.
+
+Metrics:
+
+- ``cknbook_http_request_duration_seconds`` (route, method, status): time
+  from the start of a request until its response is closed, so a streamed
+  reply counts until its last event.
+- ``cknbook_http_requests_in_flight`` (route).
+- ``cknbook_gemini_call_duration_seconds`` (prompt, outcome): each upstream
+  call, one per retry or hedge attempt. ``prompt`` is the prompt file the
+  calling function renders (``quiz_prompt``, ``response_prompt``, ...).
+- ``cknbook_gemini_errors_total`` (prompt, error).
+- ``cknbook_gemini_tokens_total`` (prompt, direction): input and output
+  tokens as reported by the API (``usage_metadata``).
+- ``cknbook_gemini_hedge_calls_total``, ``cknbook_gemini_hedges_total``,
+  ``cknbook_gemini_hedge_backup_wins_total`` and
+  ``cknbook_gemini_hedge_saved_seconds_total``: calls made with hedging on,
+  backups sent, backups that answered first, and the estimated time those
+  wins saved (``GEMINI_HEDGING=1`` only).
+- ``cknbook_gemini_in_flight``, ``cknbook_gemini_retries_total``,
+  ``cknbook_gemini_rejected_total`` (reason),
+  ``cknbook_gemini_breaker_opened_total`` and ``cknbook_gemini_breaker_open``
+  (1 while a live worker's breaker is open): the upstream governor.
+- ``cknbook_structured_output_total`` (output, result): JSON replies parsed
+  at once, repaired locally, repaired by the model, or returned raw.
+- ``cknbook_retrieval_duration_seconds``: ``find_relevant_knowledge``.
+- ``cknbook_cache_requests_total`` (cache, result): hits and misses of the
+  response cache, cached contexts and the quiz bank. The hit ratio is
+  ``hit / (hit + miss)``.
+- ``cknbook_redis_errors_total`` (operation): failed shared-backend calls,
+  which degrade to cache misses.
+- ``cknbook_image_prep_total`` (result) and ``cknbook_image_prep_bytes_total``
+  (direction): uploaded images resized, passed through or sent unchanged
+  after a failure, and their size before and after.
+- ``cknbook_log_records_dropped_total`` (reason): log records sampled out,
+  rate limited or dropped because the write queue was full.
+
+gunicorn runs several worker processes, and each one only sees the requests
+it served. When ``PROMETHEUS_MULTIPROC_DIR`` is set (gunicorn.conf.py sets
+it), every worker writes its samples to files in that directory and
+``/metrics`` adds them all up, whichever worker answers the scrape. Without
+prometheus_client every metric is a no-op and ``/metrics`` returns 503.
+
+When ``METRICS_TOKEN`` is set, ``/metrics`` answers only requests carrying
+``Authorization: Bearer <token>`` (Prometheus' ``authorization`` scrape
+setting). The production app serves it only when a token is configured.
+"""
+import contextlib
+import hmac
+import os
+import time
+
+from flask import Response, g, request
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+MULTIPROCESS_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+# Bearer token a /metrics request must carry, if set
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Model calls take seconds; the default buckets stop at 10s
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+RETRIEVAL_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+class _NoopMetric(contextlib.ContextDecorator):
+    """Stands in for every metric when prometheus_client is not installed"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def observe(self, amount):
+        pass
+
+    def set(self, value):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _metric(kind, name, documentation, labelnames=(), **kwargs):
+    if not PROMETHEUS_AVAILABLE:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+REQUEST_LATENCY = _metric(
+    'Histogram', 'cknbook_http_request_duration_seconds', 'HTTP request duration until the response is closed',
+    ['route', 'method', 'status'], buckets=LATENCY_BUCKETS
+)
+# Summed over the live workers
+REQUESTS_IN_FLIGHT = _metric(
+    'Gauge', 'cknbook_http_requests_in_flight', 'HTTP requests being served', ['route'],
+    multiprocess_mode='livesum'
+)
+GEMINI_LATENCY = _metric(
+    'Histogram', 'cknbook_gemini_call_duration_seconds', 'Duration of one Gemini API call',
+    ['prompt', 'outcome'], buckets=LATENCY_BUCKETS
+)
+GEMINI_ERRORS = _metric(
+    'Counter', 'cknbook_gemini_errors', 'Failed Gemini API calls', ['prompt', 'error']
+)
+GEMINI_TOKENS = _metric(
+    'Counter', 'cknbook_gemini_tokens', 'Tokens reported by the Gemini API', ['prompt', 'direction']
+)
+HEDGE_CALLS = _metric(
+    'Counter', 'cknbook_gemini_hedge_calls', 'Gemini calls made with hedging enabled'
+)
+HEDGES_SENT = _metric(
+    'Counter', 'cknbook_gemini_hedges', 'Backup Gemini calls sent because the first was slow'
+)
+HEDGE_BACKUP_WINS = _metric(
+    'Counter', 'cknbook_gemini_hedge_backup_wins', 'Hedged calls answered by the backup first'
+)
+HEDGE_SAVED_SECONDS = _metric(
+    'Counter', 'cknbook_gemini_hedge_saved_seconds', 'Estimated latency saved by backups that won'
+)
+GEMINI_IN_FLIGHT = _metric(
+    'Gauge', 'cknbook_gemini_in_flight', 'Gemini API calls in flight', multiprocess_mode='livesum'
+)
+GEMINI_RETRIES = _metric(
+    'Counter', 'cknbook_gemini_retries', 'Gemini API calls retried after a retryable error'
+)
+GEMINI_REJECTED = _metric(
+    'Counter', 'cknbook_gemini_rejected', 'Gemini API calls refused before being sent', ['reason']
+)
+GEMINI_BREAKER_OPENED = _metric(
+    'Counter', 'cknbook_gemini_breaker_opened', 'Times the Gemini circuit breaker opened'
+)
+GEMINI_BREAKER_OPEN = _metric(
+    'Gauge', 'cknbook_gemini_breaker_open', 'Whether a worker is failing Gemini calls fast',
+    multiprocess_mode='livemax'
+)
+STRUCTURED_OUTPUT = _metric(
+    'Counter', 'cknbook_structured_output', 'JSON replies by how they were parsed', ['output', 'result']
+)
+RETRIEVAL_LATENCY = _metric(
+    'Histogram', 'cknbook_retrieval_duration_seconds', 'Time spent finding relevant book knowledge',
+    buckets=RETRIEVAL_BUCKETS
+)
+CACHE_REQUESTS = _metric(
+    'Counter', 'cknbook_cache_requests', 'Cache lookups by result', ['cache', 'result']
+)
+REDIS_ERRORS = _metric(
+    'Counter', 'cknbook_redis_errors', 'Failed operations on the shared Redis backend', ['operation']
+)
+IMAGE_PREP = _metric(
+    'Counter', 'cknbook_image_prep', 'Uploaded images by how they were prepared', ['result']
+)
+IMAGE_PREP_BYTES = _metric(
+    'Counter', 'cknbook_image_prep_bytes', 'Uploaded image bytes before and after preparation', ['direction']
+)
+LOG_RECORDS_DROPPED = _metric(
+    'Counter', 'cknbook_log_records_dropped', 'Log records not written', ['reason']
+)
+
+
+def prompt_label(prompt):
+    """The metrics label for a prompt: the stem of the prompt file it was rendered from"""
+    name = getattr(prompt, 'name', None)
+    return name.rsplit('.', 1)[0] if name else 'other'
+
+
+def count_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def count_tokens(prompt, response):
+    """Add the token counts the API reported for ``response``"""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return
+    label = prompt_label(prompt)
+    if usage.prompt_token_count:
+        GEMINI_TOKENS.labels(label, 'input').inc(usage.prompt_token_count)
+    if usage.candidates_token_count:
+        GEMINI_TOKENS.labels(label, 'output').inc(usage.candidates_token_count)
+
+
+@contextlib.contextmanager
+def gemini_call(prompt):
+    """Time one Gemini call and count its failure by exception type"""
+    label = prompt_label(prompt)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        GEMINI_LATENCY.labels(label, 'error').observe(time.perf_counter() - started)
+        GEMINI_ERRORS.labels(label, type(e).__name__).inc()
+        raise
+    GEMINI_LATENCY.labels(label, 'ok').observe(time.perf_counter() - started)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def instrument_app(app):
+    """Record latency and in-flight requests for every route of ``app``"""
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(_route()).inc()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        route, method, status = _route(), request.method, str(response.status_code)
+
+        def finish():
+            REQUEST_LATENCY.labels(route, method, status).observe(time.perf_counter() - started)
+            REQUESTS_IN_FLIGHT.labels(route).dec()
+
+        # Streams are still being sent here; count them once the response is closed
+        response.call_on_close(finish)
+        return response
+
+
+def metrics_response(require_token=False):
+    """The ``/metrics`` response, aggregated over every worker in multiprocess mode.
+
+    With ``require_token`` the endpoint is hidden (404) unless ``METRICS_TOKEN`` is set.
+    """
+    if not METRICS_TOKEN:
+        if require_token:
+            return Response("Not Found\n", status=404, mimetype='text/plain')
+    elif not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                 f"Bearer {METRICS_TOKEN}".encode('utf-8')):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    if not PROMETHEUS_AVAILABLE:
+        return Response("prometheus_client is not installed\n", status=503, mimetype='text/plain')
+    if MULTIPROCESS_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
@@ -0,0 +1,141 @@
+"""Prompt files loaded once, reloaded on change, and compiled into templates.
+
+Every generation used to re-read its system prompt from ``prompts/`` and
+build the user prompt by concatenating several strings. ``PromptRegistry``
+keeps each file in memory. It checks the file's mtime at most once every
+``check_interval`` seconds and reloads it when the file has changed, so
+edits to a prompt file take effect without a restart.
+
+``render(name, user_template, **fields)`` returns the prompt file, a blank
+line, and then ``user_template`` with its fields filled in. The file and the
+template's fixed text are combined into one compiled ``PromptTemplate`` the
+first time, so each request only substitutes the fields and does a single
+join. Prompt files are used verbatim, so JSON braces in them need no
+escaping. User templates use ``str.format`` syntax, with ``{{``/``}}`` for
+literal braces.
+
+Rendered prompts are ``Prompt`` strings. Each one records how long its
+leading part is that stays the same across calls. By default that part is
+the prompt file plus the template text before the first field;
+``context_through`` extends it through a field whose value is itself
+stable, such as a chapter body. The Gemini client can send that part as a
+cached context (see ``context_cache``).
+"""
+import logging
+import os
+import threading
+import time
+from string import Formatter
+
+logger = logging.getLogger(__name__)
+
+
+class Prompt(str):
+    """A rendered prompt whose first ``context_length`` characters repeat across calls.
+
+    ``name`` is the prompt file it was rendered from.
+    """
+
+    context_length = 0
+    name = None
+
+
+class PromptTemplate:
+    """A template split once into literal text and ``{field}`` slots"""
+
+    def __init__(self, template, prefix='', context_through=None, name=None):
+        self.name = name
+        pieces = [prefix]
+        self._slots = []
+        for literal, field, format_spec, conversion in Formatter().parse(template):
+            pieces[-1] += literal
+            if field is None:
+                continue
+            if not field.isidentifier() or format_spec or conversion:
+                raise ValueError(f"Unsupported prompt field: {{{field}}}")
+            self._slots.append((len(pieces), field))
+            pieces.extend((None, ''))
+        self._pieces = pieces
+        # Pieces up to this index form the repeated leading part
+        self._context_end = 1
+        if context_through is not None:
+            indexes = [index for index, field in self._slots if field == context_through]
+            if not indexes:
+                raise ValueError(f"Prompt template has no field {{{context_through}}}")
+            self._context_end = indexes[0] + 1
+
+    @property
+    def fields(self):
+        return {field for _, field in self._slots}
+
+    def render(self, **fields):
+        pieces = self._pieces[:]
+        for index, field in self._slots:
+            pieces[index] = str(fields[field])
+        prompt = Prompt(''.join(pieces))
+        prompt.context_length = sum(map(len, pieces[:self._context_end]))
+        prompt.name = self.name
+        return prompt
+
+
+class _PromptFile:
+    def __init__(self):
+        self.text = None
+        self.version = None
+        self.checked = 0.0
+        self.templates = {}
+
+
+class PromptRegistry:
+    """Prompt files from ``directory``, cached in memory and reloaded when they change"""
+
+    def __init__(self, directory='prompts', fallbacks=None, check_interval=1.0):
+        self.directory = directory
+        self.fallbacks = dict(fallbacks or {})
+        self.check_interval = check_interval
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _current(self, name):
+        """Return the file's cache entry, reloading it if the file changed"""
+        with self._lock:
+            entry = self._files.setdefault(name, _PromptFile())
+            now = time.monotonic()
+            if entry.text is not None and now - entry.checked < self.check_interval:
+                return entry
+            entry.checked = now
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                version = (stat.st_mtime_ns, stat.st_size)
+                if version != entry.version:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        text = f.read()
+                    if entry.version is not None:
+                        logger.info(f"Reloaded prompt {name}")
+                    entry.text, entry.version, entry.templates = text, version, {}
+            except FileNotFoundError:
+                if name not in self.fallbacks:
+                    raise
+                if entry.version != 'fallback':
+                    logger.error(f"Prompt file {path} not found, using the built-in fallback")
+                    entry.text, entry.version, entry.templates = self.fallbacks[name], 'fallback', {}
+            return entry
+
+    def get(self, name):
+        """Return the text of a prompt file"""
+        return self._current(name).text
+
+    def template(self, name, user_template, context_through=None):
+        """Return the compiled template for a prompt file followed by ``user_template``"""
+        entry = self._current(name)
+        template = entry.templates.get((user_template, context_through))
+        if template is None:
+            template = PromptTemplate(user_template, prefix=entry.text + "\n\n", context_through=context_through,
+                                      name=name)
+            entry.templates[(user_template, context_through)] = template
+        return template
+
+    def render(self, name, user_template, context_through=None, **fields):
+        """Return the prompt file, a blank line, then ``user_template`` with ``fields`` filled in"""
+        return self.template(name, user_template, context_through).render(**fields)
@@ -0,0 +1,212 @@
+"""Pre-generated quiz variants for every chapter.
+
+The chapter set is fixed, so quizzes can be produced ahead of time instead
+of making each user wait for a live model call. The bank keeps up to
+``variants_per_day`` quizzes per day and hands them out in rotation; a
+variant is not used up by being served. A variant is fresh for
+``ttl_seconds``. Only when fewer than ``low_water`` fresh variants are left
+for a day is that day topped up again in the background, and the old
+variants are served until the new ones are in. Model calls therefore depend
+on the number of chapters and the TTL, not on traffic.
+
+Variants live in a cache backend. With Redis (``REDIS_URL``) every worker
+and instance shares one bank, and a per-day lock (``add``, i.e. Redis SET NX)
+lets one worker refill a day while the others keep serving. With the
+in-process backend each worker has its own bank; it is snapshotted to a JSON
+file, and a worker adopts the fresh variants another worker saved there
+before generating its own.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import count_cache
+
+logger = logging.getLogger(__name__)
+
+
+class QuizBank:
+    """Background-filled store of quiz variants keyed by day number.
+
+    ``generate(day)`` must return a parsed quiz dict; any other result (an
+    error string, unparsed text) is discarded and retried on the next refill.
+    """
+
+    def __init__(self, generate, days, store, variants_per_day=2, low_water=1, ttl_seconds=21600,
+                 max_workers=2, lock_ttl=300, retry_after=60, path=None):
+        self.generate = generate
+        self.days = list(days)
+        self.store = store
+        self.variants_per_day = variants_per_day
+        self.low_water = min(max(1, low_water), max(1, variants_per_day))
+        self.ttl_seconds = ttl_seconds
+        self.max_workers = max_workers
+        self.lock_ttl = lock_ttl
+        self.retry_after = retry_after
+        self.path = path
+        self._refilling = set()
+        self._turn = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._token = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+    @property
+    def enabled(self):
+        return self.variants_per_day > 0 and bool(self.days)
+
+    def _ensure_started(self):
+        # Started lazily so each forked gunicorn worker gets its own threads
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='quiz-bank')
+            self._refilling = set()
+        if not self.store.shared:
+            self._load_snapshot()
+        for day in self.days:
+            self._check(day, self._variants(day))
+
+    def _key(self, day):
+        return f"day:{day}"
+
+    def _variants(self, day):
+        """Return the stored ``[{'quiz', 'created'}]`` list for ``day``"""
+        value = self.store.get(self._key(day))
+        if not value:
+            return []
+        try:
+            variants = json.loads(value)
+        except ValueError:
+            return []
+        return [variant for variant in variants if isinstance(variant, dict) and isinstance(variant.get('quiz'), dict)]
+
+    def _store_variants(self, day, variants):
+        # Stale variants are still served while a refill runs, so they outlive the TTL
+        self.store.set(self._key(day), json.dumps(variants, ensure_ascii=False), ttl_seconds=self.ttl_seconds * 2)
+
+    def _fresh(self, variants):
+        cutoff = time.time() - self.ttl_seconds
+        return [variant for variant in variants if variant.get('created', 0) > cutoff]
+
+    def get(self, day):
+        """Return a quiz for ``day`` from the bank, or None if none is ready yet"""
+        if not self.enabled or day not in self.days:
+            return None
+        self._ensure_started()
+        variants = self._variants(day)
+        choices = self._fresh(variants) or variants
+        if choices:
+            with self._lock:
+                self._turn += 1
+                quiz = choices[self._turn % len(choices)]['quiz']
+        else:
+            quiz = None
+        count_cache('quiz_bank', quiz is not None)
+        self._check(day, variants)
+        return quiz
+
+    def _check(self, day, variants):
+        """Queue a refill of ``day`` if its fresh variants are below the low-water mark"""
+        if len(self._fresh(variants)) >= self.low_water:
+            return
+        with self._lock:
+            if day in self._refilling:
+                return
+            self._refilling.add(day)
+        self._executor.submit(self._refill, day)
+
+    def _refill(self, day):
+        lock_key = f"refill:{day}"
+        try:
+            # One worker refills a day at a time; the others keep serving what is there
+            if not self.store.add(lock_key, self._token, ttl_seconds=self.lock_ttl):
+                return
+            failed = False
+            try:
+                if not self.store.shared:
+                    self._load_snapshot(day)
+                while True:
+                    variants = self._fresh(self._variants(day))
+                    if len(variants) >= self.variants_per_day:
+                        break
+                    quiz = self._generate(day)
+                    if quiz is None:
+                        failed = True
+                        break
+                    variants.append({'quiz': quiz, 'created': time.time()})
+                    self._store_variants(day, variants[-self.variants_per_day:])
+                    logger.info(f"Quiz bank stored a variant for day {day}")
+                    self._save_snapshot()
+            finally:
+                if failed:
+                    # Hold the lock a while so a failing generation isn't retried on every request
+                    self.store.set(lock_key, self._token, ttl_seconds=self.retry_after)
+                else:
+                    self.store.delete(lock_key)
+        finally:
+            with self._lock:
+                self._refilling.discard(day)
+
+    def _generate(self, day):
+        try:
+            quiz = self.generate(day)
+        except Exception as e:
+            logger.warning(f"Quiz bank generation failed for day {day}: {e}")
+            return None
+        if not isinstance(quiz, dict):
+            logger.warning(f"Quiz bank discarded an unparsed quiz for day {day}")
+            return None
+        return quiz
+
+    def _load_snapshot(self, only_day=None):
+        """Adopt fresh variants from the snapshot file for days this worker has fewer of"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        loaded = 0
+        for day in self.days if only_day is None else [only_day]:
+            saved = self._fresh([variant for variant in snapshot.get(str(day), [])
+                                 if isinstance(variant, dict) and isinstance(variant.get('quiz'), dict)])
+            if len(saved) > len(self._fresh(self._variants(day))):
+                self._store_variants(day, saved[-self.variants_per_day:])
+                loaded += len(saved)
+        if loaded:
+            logger.info(f"Quiz bank loaded {loaded} variants from {self.path}")
+
+    def _save_snapshot(self):
+        if not self.path or self.store.shared:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            with self._save_lock:
+                # Other workers share the file: keep whichever copy of a day is fresher
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        snapshot = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    snapshot = {}
+                for day in self.days:
+                    variants = self._variants(day)
+                    saved = snapshot.get(str(day))
+                    if not isinstance(saved, list) or len(self._fresh(variants)) >= len(self._fresh(
+                            [variant for variant in saved if isinstance(variant, dict)])):
+                        snapshot[str(day)] = variants
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(snapshot, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save quiz bank snapshot: {e}")
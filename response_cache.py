@@ -0,0 +1,196 @@
+"""Caches for generated model responses.
+
+Entries are keyed on a hash of everything that determines the output (model
+name, fully assembled prompt, image bytes) and expire after a TTL. Two
+backends share the CacheBackend interface:
+
+- ResponseCache: in-process, size-bounded LRU. Each gunicorn worker has its own.
+- RedisCache: any Redis-protocol server, shared by every worker and instance.
+
+``create_cache_backend`` picks Redis when ``REDIS_URL`` is set.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+from metrics import REDIS_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model_name, *parts):
+    """Hash the model name and prompt parts (text, bytes or image dicts) into a cache key"""
+    digest = hashlib.sha256(model_name.encode('utf-8'))
+    for part in parts:
+        if part is None:
+            continue
+        if isinstance(part, dict):
+            digest.update(b'\0mime:' + str(part.get('mime_type', '')).encode('utf-8'))
+            part = part.get('data', b'')
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(b'\0' + hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class CacheBackend:
+    """Interface shared by the cache implementations; values are strings"""
+
+    # True when every worker and instance sees the same entries
+    shared = False
+
+    def __init__(self, ttl_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        self._counter_lock = threading.Lock()
+        # Failed backend operations; SingleFlight stops waiting on a backend that errors
+        self.errors = 0
+
+    def get(self, key):
+        """Return the cached value, or None when missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl_seconds=None):
+        """Store a value for ``ttl_seconds`` (the backend default when None)"""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl_seconds=None):
+        """Store a value only if the key is absent; returns True if it was stored"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class ResponseCache(CacheBackend):
+    """Thread-safe in-process TTL + LRU cache"""
+
+    def __init__(self, max_entries=512, ttl_seconds=3600):
+        super().__init__(ttl_seconds)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                value = None
+            else:
+                self._entries.move_to_end(key)
+                value = entry[1]
+        return value
+
+    def set(self, key, value, ttl_seconds=None):
+        """Store a value, evicting the least recently used entries if full"""
+        if self.max_entries <= 0:
+            return
+        expires = time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add(self, key, value, ttl_seconds=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+        # Another thread may win the race between the check and the set; callers
+        # only use add() for best-effort coordination, so that is acceptable.
+        self.set(key, value, ttl_seconds)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(CacheBackend):
+    """Cache stored on a Redis-protocol server so all workers and instances share it.
+
+    Connection problems are logged and treated as cache misses, so an
+    unavailable Redis degrades to "no cache" rather than failed requests.
+    """
+
+    shared = True
+
+    def __init__(self, url, ttl_seconds=3600, prefix='cknbook:', socket_timeout=0.5):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("redis package is not installed")
+        super().__init__(ttl_seconds)
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, socket_timeout=socket_timeout, socket_connect_timeout=socket_timeout)
+
+    def _error(self, operation, error):
+        with self._counter_lock:
+            self.errors += 1
+        REDIS_ERRORS.labels(operation).inc()
+        logger.warning(f"Redis cache {operation} failed: {error}")
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except redis.RedisError as e:
+            self._error('get', e)
+            return None
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        try:
+            self.client.set(self.prefix + key, value.encode('utf-8'), px=max(1, int(ttl * 1000)))
+        except redis.RedisError as e:
+            self._error('set', e)
+
+    def add(self, key, value, ttl_seconds=None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        try:
+            return bool(self.client.set(self.prefix + key, value.encode('utf-8'), px=max(1, int(ttl * 1000)), nx=True))
+        except redis.RedisError as e:
+            self._error('add', e)
+            return False
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except redis.RedisError as e:
+            self._error('delete', e)
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + '*'))
+            if keys:
+                self.client.delete(*keys)
+        except redis.RedisError as e:
+            self._error('clear', e)
+
+
+def create_cache_backend(max_entries=512, ttl_seconds=3600, prefix='cknbook:'):
+    """Return a RedisCache when REDIS_URL is configured, else an in-process ResponseCache"""
+    url = os.getenv('REDIS_URL')
+    if url:
+        if REDIS_AVAILABLE:
+            logger.info("Using Redis cache backend")
+            return RedisCache(url, ttl_seconds=ttl_seconds, prefix=prefix)
+        logger.warning("REDIS_URL is set but the redis package is missing; using in-process cache")
+    return ResponseCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
@@ -0,0 +1,110 @@
+"""BM25 ranked retrieval over the knowledge chapters.
+
+Chinese text has no word boundaries, so it is tokenized into overlapping
+character bigrams and trigrams; Latin text is split into lowercase words.
+Postings are stored in flat typed arrays to keep the index compact.
+"""
+import heapq
+import math
+import re
+from array import array
+
+_TOKEN_PATTERN = re.compile(r'[㐀-䶿一-鿿]+|[a-z0-9]+')
+_CJK_START = '㐀'
+
+
+def tokenize(text):
+    """Split text into CJK character bigrams/trigrams and lowercase Latin words"""
+    tokens = []
+    for run in _TOKEN_PATTERN.findall(text.lower()):
+        if run[0] < _CJK_START:
+            tokens.append(run)
+            continue
+        if len(run) == 1:
+            tokens.append(run)
+            continue
+        for n in (2, 3):
+            for i in range(len(run) - n + 1):
+                tokens.append(run[i:i + n])
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 index over a list of documents.
+
+    ``terms`` maps a token to its id; the postings of term ``t`` are
+    ``doc_ids[offsets[t]:offsets[t + 1]]`` with matching ``term_freqs``.
+    """
+
+    # Results scoring below this fraction of the best match are treated as noise
+    min_relative_score = 0.3
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+        postings = {}
+        self.doc_lengths = array('I')
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            self.doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc_id, min(count, 0xFFFF)))
+
+        self.terms = {}
+        self.offsets = array('I', [0])
+        self.doc_ids = array('I')
+        self.term_freqs = array('H')
+        for term_id, (token, entries) in enumerate(sorted(postings.items())):
+            self.terms[token] = term_id
+            for doc_id, count in entries:
+                self.doc_ids.append(doc_id)
+                self.term_freqs.append(count)
+            self.offsets.append(len(self.doc_ids))
+
+        self.size = len(self.doc_lengths)
+        self.average_length = (sum(self.doc_lengths) / self.size) if self.size else 0.0
+        self.idf = array('f')
+        for term_id in range(len(self.terms)):
+            doc_freq = self.offsets[term_id + 1] - self.offsets[term_id]
+            self.idf.append(math.log(1 + (self.size - doc_freq + 0.5) / (doc_freq + 0.5)))
+
+    @classmethod
+    def from_arrays(cls, terms, offsets, doc_ids, term_freqs, doc_lengths, idf, k1=1.5, b=0.75):
+        """Wrap prebuilt postings, e.g. memoryviews over a memory-mapped index file"""
+        index = cls.__new__(cls)
+        index.k1 = k1
+        index.b = b
+        index.terms = terms
+        index.offsets = offsets
+        index.doc_ids = doc_ids
+        index.term_freqs = term_freqs
+        index.doc_lengths = doc_lengths
+        index.idf = idf
+        index.size = len(doc_lengths)
+        index.average_length = (sum(doc_lengths) / index.size) if index.size else 0.0
+        return index
+
+    def search(self, query, top_k=5):
+        """Return up to ``top_k`` (document position, score) pairs, best first"""
+        if not self.size:
+            return []
+
+        k1, b = self.k1, self.b
+        average_length = self.average_length or 1.0
+        scores = {}
+        for token in set(tokenize(query)):
+            term_id = self.terms.get(token)
+            if term_id is None:
+                continue
+            idf = self.idf[term_id]
+            for i in range(self.offsets[term_id], self.offsets[term_id + 1]):
+                doc_id = self.doc_ids[i]
+                tf = self.term_freqs[i]
+                norm = k1 * (1 - b + b * self.doc_lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,171 @@
+"""Tiny in-memory Redis-protocol (RESP2) server for local development.
+
+Implements just the commands the cache backends use, so the Redis code
+paths can be exercised without installing Redis:
+
+    python scripts/fake_redis_server.py --port 6390
+    REDIS_URL=redis://127.0.0.1:6390/0 python main.py
+"""
+import argparse
+import fnmatch
+import socketserver
+import threading
+import time
+
+_store = {}
+_lock = threading.Lock()
+
+
+def _expired(key, now):
+    entry = _store.get(key)
+    if entry is not None and entry[1] is not None and entry[1] <= now:
+        del _store[key]
+        return True
+    return entry is None
+
+
+def _get(key):
+    now = time.monotonic()
+    with _lock:
+        if _expired(key, now):
+            return None
+        return _store[key][0]
+
+
+def _encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        return b':%d\r\n' % int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, Exception):
+        return b'-ERR ' + str(value).encode() + b'\r\n'
+    if isinstance(value, str):
+        return b'+' + value.encode() + b'\r\n'
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(_encode(item) for item in value)
+    return b'$%d\r\n' % len(value) + value + b'\r\n'
+
+
+def _command_set(args):
+    key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+    expires = None
+    if b'EX' in options:
+        expires = time.monotonic() + int(args[2 + options.index(b'EX') + 1])
+    if b'PX' in options:
+        expires = time.monotonic() + int(args[2 + options.index(b'PX') + 1]) / 1000
+    with _lock:
+        exists = not _expired(key, time.monotonic())
+        if (b'NX' in options and exists) or (b'XX' in options and not exists):
+            return None
+        _store[key] = (value, expires)
+    return 'OK'
+
+
+def _command_incrby(key, amount):
+    with _lock:
+        current = 0 if _expired(key, time.monotonic()) else int(_store[key][0])
+        expires = _store[key][1] if key in _store else None
+        _store[key] = (str(current + amount).encode(), expires)
+        return current + amount
+
+
+def _command_pexpire(key, milliseconds):
+    with _lock:
+        if _expired(key, time.monotonic()):
+            return 0
+        _store[key] = (_store[key][0], time.monotonic() + milliseconds / 1000)
+        return 1
+
+
+def _command_delete(keys):
+    with _lock:
+        return sum(1 for key in keys if _store.pop(key, None) is not None)
+
+
+def _command_scan(args):
+    pattern = b'*'
+    if b'MATCH' in [a.upper() for a in args]:
+        pattern = args[[a.upper() for a in args].index(b'MATCH') + 1]
+    now = time.monotonic()
+    with _lock:
+        keys = [key for key in list(_store) if not _expired(key, now)]
+    return [b'0', [key for key in keys if fnmatch.fnmatchcase(key.decode(), pattern.decode())]]
+
+
+def execute(command, args):
+    name = command.upper()
+    if name == b'PING':
+        return 'PONG'
+    if name == b'GET':
+        return _get(args[0])
+    if name == b'SET':
+        return _command_set(args)
+    if name == b'DEL':
+        return _command_delete(args)
+    if name == b'EXISTS':
+        return sum(1 for key in args if _get(key) is not None)
+    if name == b'INCR':
+        return _command_incrby(args[0], 1)
+    if name == b'INCRBY':
+        return _command_incrby(args[0], int(args[1]))
+    if name == b'EXPIRE':
+        return _command_pexpire(args[0], int(args[1]) * 1000)
+    if name == b'PEXPIRE':
+        return _command_pexpire(args[0], int(args[1]))
+    if name == b'SCAN':
+        return _command_scan(args[1:])
+    if name == b'FLUSHDB':
+        with _lock:
+            _store.clear()
+        return 'OK'
+    if name in (b'SELECT', b'CLIENT'):
+        return 'OK'
+    return ValueError(f"unknown command '{command.decode(errors='replace')}'")
+
+
+class RedisProtocolHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        items = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            items.append(self.rfile.read(length + 2)[:-2])
+        return items
+
+    def handle(self):
+        while True:
+            items = self.read_command()
+            if not items:
+                return
+            try:
+                reply = execute(items[0], items[1:])
+            except (IndexError, ValueError) as e:
+                reply = ValueError(str(e) or 'syntax error')
+            self.wfile.write(_encode(reply))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(host='127.0.0.1', port=6390):
+    """Start the server on a background thread and return it"""
+    server = FakeRedisServer((host, port), RedisProtocolHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    options = parser.parse_args()
+    print(f"Fake Redis listening on {options.host}:{options.port}")
+    FakeRedisServer((options.host, options.port), RedisProtocolHandler).serve_forever()
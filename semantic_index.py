@@ -0,0 +1,131 @@
+"""Optional semantic retrieval over the knowledge passages (offline, CPU-only).
+
+Passages are embedded once by a pluggable local embedding function and the
+vectors are kept as a NumPy matrix persisted to disk, so later workers open
+it memory-mapped instead of re-embedding. Queries are answered with a
+vectorized cosine similarity top-k.
+
+The default embedder hashes CJK character unigrams/bigrams/trigrams and
+Latin words into a fixed-size vector. It needs no model download and still
+matches paraphrases that share characters (早飯 / 早餐). A real local model
+can be plugged in with ``KNOWLEDGE_EMBEDDER=module:function``; the function
+takes a list of strings and returns a 2-D float array.
+"""
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import zlib
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+from retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_DIR = os.getenv('SEMANTIC_CACHE_DIR', '.cache')
+HASHING_DIMENSIONS = 1024
+
+_CJK_CHARS = re.compile(r'[㐀-䶿一-鿿]')
+
+
+def hashing_embedder(texts, dimensions=HASHING_DIMENSIONS):
+    """Embed texts as L2-normalized hashed bags of character n-grams"""
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        # Single characters carry the overlap between near-synonyms
+        features = tokenize(text) + _CJK_CHARS.findall(text)
+        for feature in features:
+            vectors[row, zlib.crc32(feature.encode('utf-8')) % dimensions] += 1.0
+    np.log1p(vectors, out=vectors)
+    return normalize(vectors)
+
+
+def normalize(vectors):
+    """Scale each row to unit length so a dot product is the cosine similarity"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def load_embedder(spec=None):
+    """Resolve ``module:function`` (or the built-in hashing embedder) to a callable"""
+    spec = spec or os.getenv('KNOWLEDGE_EMBEDDER', '')
+    if not spec:
+        return hashing_embedder, 'hashing'
+    module_name, _, function_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), function_name), spec
+
+
+class SemanticIndex:
+    """Cosine top-k search over a matrix of passage embeddings.
+
+    ``search`` returns (position, score) pairs like ``BM25Index.search`` so
+    the two can be swapped behind ``KnowledgeStore.select_passages``.
+    """
+
+    # Cosine scores are compressed, so only keep results close to the best one
+    min_relative_score = 0.75
+
+    def __init__(self, matrix, embed):
+        self.matrix = matrix
+        self.embed = embed
+        self.size = matrix.shape[0]
+
+    @classmethod
+    def build_or_load(cls, texts, embed=None, name=None, cache_dir=SEMANTIC_CACHE_DIR):
+        """Open the persisted embeddings for these texts, embedding them if missing or stale"""
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("numpy is required for semantic retrieval")
+        if embed is None:
+            embed, name = load_embedder()
+
+        fingerprint = hashlib.sha256()
+        fingerprint.update((name or getattr(embed, '__name__', 'custom')).encode('utf-8'))
+        for text in texts:
+            fingerprint.update(b'\0' + text.encode('utf-8'))
+        fingerprint = fingerprint.hexdigest()
+
+        matrix_path = os.path.join(cache_dir, 'knowledge_embeddings.npy')
+        meta_path = os.path.join(cache_dir, 'knowledge_embeddings.json')
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('fingerprint') == fingerprint:
+                matrix = np.load(matrix_path, mmap_mode='r')
+                logger.info(f"Opened {matrix.shape[0]} passage embeddings from {matrix_path}")
+                return cls(matrix, embed)
+        except (FileNotFoundError, ValueError, OSError):
+            pass
+
+        matrix = normalize(np.asarray(embed(list(texts)), dtype=np.float32))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to temporary names first so a concurrent worker never sees half a file
+            np.save(matrix_path + '.tmp.npy', matrix)
+            os.replace(matrix_path + '.tmp.npy', matrix_path)
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'fingerprint': fingerprint, 'embedder': name, 'shape': list(matrix.shape)}, f)
+            os.replace(meta_path + '.tmp', meta_path)
+            matrix = np.load(matrix_path, mmap_mode='r')
+        except OSError as e:
+            logger.warning(f"Could not persist passage embeddings: {e}")
+        logger.info(f"Embedded {matrix.shape[0]} passages with {name}")
+        return cls(matrix, embed)
+
+    def search(self, query, top_k=5):
+        """Return up to ``top_k`` (passage position, cosine score) pairs, best first"""
+        if not self.size:
+            return []
+        query_vector = normalize(np.asarray(self.embed([query]), dtype=np.float32))[0]
+        scores = self.matrix @ query_vector
+        top_k = min(top_k, self.size)
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(position), float(scores[position])) for position in candidates if scores[position] > 0]
@@ -0,0 +1,103 @@
+"""Collapse identical concurrent generation calls into one upstream call.
+
+When a class is told to do the same quiz at once, dozens of identical
+requests arrive within seconds. Without coordination each misses the
+response cache and makes its own model call. ``SingleFlight.do`` lets the
+first caller for a key run the call while the others wait for its result:
+
+- Within a worker, waiters block on the in-flight call and share its result
+  (or its exception).
+- Across workers and instances, the leader also takes a short-lived lock in
+  a shared cache backend (``add``, i.e. Redis SET NX). Leaders in other
+  workers that find the lock taken poll the response cache until the
+  holder's result appears there. If the holder fails or the lock expires,
+  the next poller takes over.
+
+With the in-process cache backend only the first kind applies, since
+workers cannot see each other's locks.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Run at most one call per key at a time and share its result with concurrent callers"""
+
+    def __init__(self, backend=None, lock_ttl=60, poll_interval=0.1):
+        self.backend = backend
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._token = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+    def do(self, key, fn, lookup=None):
+        """Return ``fn()``, sharing one execution among concurrent callers with the same key.
+
+        ``lookup()`` returns the result another worker has published for
+        ``key`` (normally a response cache read), or None; without it only
+        callers within this process are coalesced.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_exclusive(key, fn, lookup)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run_exclusive(self, key, fn, lookup):
+        backend = self.backend
+        if lookup is None or backend is None or not backend.shared:
+            return fn()
+
+        lock_key = f"inflight:{key}"
+        deadline = time.monotonic() + self.lock_ttl
+        while True:
+            errors = backend.errors
+            if backend.add(lock_key, self._token, self.lock_ttl):
+                try:
+                    # The previous holder may have published just before releasing
+                    result = lookup()
+                    return result if result is not None else fn()
+                finally:
+                    backend.delete(lock_key)
+            if backend.errors != errors:
+                # The shared backend is unavailable; don't wait on it
+                return fn()
+
+            time.sleep(self.poll_interval)
+            result = lookup()
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                logger.warning(f"Gave up waiting for another worker's in-flight call after {self.lock_ttl}s")
+                return fn()
@@ -5,6 +5,11 @@ document.addEventListener('DOMContentLoaded', function() {
     const loading = document.getElementById('loading');
     const outputSection = document.getElementById('outputSection');
 
+    // Other pages load this file only for its shared helpers
+    if (!form) {
+        return;
+    }
+
     form.addEventListener('submit', async function(e) {
         e.preventDefault();
         
@@ -27,8 +32,8 @@ document.addEventListener('DOMContentLoaded', function() {
         outputSection.classList.add('hidden');
 
         try {
-            // Send request to backend
-            const response = await fetch('/process', {
+            // Stream the rewrite so the options fill in while the model is still writing
+            const response = await fetch('/process/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -36,21 +41,32 @@ document.addEventListener('DOMContentLoaded', function() {
                 body: JSON.stringify(data)
             });
 
-            const result = await response.json();
-
-            if (response.ok) {
-                // Parse the result and display outputs
-                parseAndDisplayResult(result.result);
-                outputSection.classList.remove('hidden');
-                
-                // Show the coffee button after successful generation
-                const coffeeSection = document.querySelector('.coffee-section');
-                if (coffeeSection) {
-                    coffeeSection.classList.remove('hidden');
-                }
-            } else {
+            if (!response.ok) {
+                const result = await response.json();
                 alert(result.error || '處理時發生錯誤');
+                return;
             }
+
+            let streamedText = '';
+            await readEventStream(response, function(event, payload) {
+                if (event === 'chunk') {
+                    streamedText += payload.text;
+                    loading.classList.add('hidden');
+                    outputSection.classList.remove('hidden');
+                    parseAndDisplayResult(streamedText, true);
+                } else if (event === 'done') {
+                    parseAndDisplayResult(payload.result);
+                    outputSection.classList.remove('hidden');
+                    
+                    // Show the coffee button after successful generation
+                    const coffeeSection = document.querySelector('.coffee-section');
+                    if (coffeeSection) {
+                        coffeeSection.classList.remove('hidden');
+                    }
+                } else if (event === 'error') {
+                    alert(payload.error || '處理時發生錯誤');
+                }
+            });
         } catch (error) {
             console.error('Error:', error);
             alert('網路錯誤，請稍後再試');
@@ -60,8 +76,43 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
-function parseAndDisplayResult(resultText) {
-    console.log('Parsing result:', resultText);
+// Read a text/event-stream response body, calling onEvent(event, payload) per message
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const message = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            for (const line of message.split('\n')) {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    data += line.slice(5).trim();
+                }
+            }
+            if (data) {
+                onEvent(event, JSON.parse(data));
+            }
+        }
+    }
+}
+
+// partial is true while the response is still streaming in
+function parseAndDisplayResult(resultText, partial = false) {
+    if (!partial) {
+        console.log('Parsing result:', resultText);
+    }
     
     // If there's an error message, show it in all outputs
     if (resultText.includes('錯誤:')) {
@@ -103,8 +154,13 @@ function parseAndDisplayResult(resultText) {
         }
     }
 
+    // Until an option label arrives, show the text streamed so far
+    if (partial && !option1 && !option2 && !option3) {
+        option1 = resultText;
+    }
+
     // Fallback: if no options found, try to split by numbers or common patterns
-    if (!option1 && !option2 && !option3) {
+    if (!partial && !option1 && !option2 && !option3) {
         const segments = resultText.split(/\d+[\.、:\s]/).filter(s => s.trim());
         if (segments.length >= 3) {
             option1 = segments[0] || '';
@@ -119,9 +175,10 @@ function parseAndDisplayResult(resultText) {
     }
 
     // Update the output divs
-    document.getElementById('output1').textContent = option1.trim() || '生成中發生錯誤';
-    document.getElementById('output2').textContent = option2.trim() || '生成中發生錯誤';
-    document.getElementById('output3').textContent = option3.trim() || '生成中發生錯誤';
+    const placeholder = partial ? '' : '生成中發生錯誤';
+    document.getElementById('output1').textContent = option1.trim() || placeholder;
+    document.getElementById('output2').textContent = option2.trim() || placeholder;
+    document.getElementById('output3').textContent = option3.trim() || placeholder;
 }
 
 function copyText(outputId) {
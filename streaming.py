@@ -0,0 +1,57 @@
+"""Server-Sent Events helpers for the streaming generation endpoints.
+
+The browser posts the same JSON body as the blocking endpoint and reads the
+response with ``fetch``. Three event types are sent:
+
+* ``chunk`` with ``{"text": ...}`` for every piece of model output
+* ``partial`` with ``{"result": ...}`` on JSON endpoints, whenever the value
+  parsed so far has grown (unfinished strings and containers are closed)
+* ``done`` with ``{"result": ...}`` once the completion is finished; the
+  result has the same shape as the blocking endpoint's ``result``
+* ``error`` with ``{"error": ...}`` if generation fails midway
+"""
+import json
+import logging
+
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+
+def sse_event(event, payload):
+    """Format one SSE message with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def event_stream(pieces, finish=None, error_message=None, partial=None):
+    """Forward text pieces as ``chunk`` events, then send ``done`` with ``finish(full_text)``.
+
+    ``partial`` is an incremental parser (see ``structured_output``) fed every
+    piece; each value it returns is sent as a ``partial`` event.
+    ``error_message`` replaces the exception text in the ``error`` event when
+    internal details should not reach the client.
+    """
+    collected = []
+    try:
+        for piece in pieces:
+            collected.append(piece)
+            yield sse_event('chunk', {'text': piece})
+            value = partial.feed(piece) if partial is not None else None
+            if value is not None:
+                yield sse_event('partial', {'result': value})
+        response_text = ''.join(collected)
+        if not response_text:
+            yield sse_event('error', {'error': "錯誤: API 回應為空"})
+            return
+        yield sse_event('done', {'result': finish(response_text) if finish else response_text})
+    except Exception as e:
+        logger.error(f"Error while streaming a response: {str(e)}")
+        yield sse_event('error', {'error': error_message or f"錯誤: {str(e)}"})
+
+
+def sse_response(stream):
+    """Wrap an SSE generator in a response that proxies will not buffer"""
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
@@ -0,0 +1,346 @@
+"""JSON replies from the model: requested, parsed, validated and repaired in one place.
+
+The quiz, reply and encouragement prompts ask the model for a JSON object.
+Each generation function used to carry its own copy of the markdown-fence
+stripping and ``json.loads``, and fell back to the raw text when parsing
+failed, leaving the user to retry. ``StructuredOutput`` replaces those
+copies:
+
+1. ``generation_config`` asks for schema-constrained JSON when the installed
+   google-generativeai supports it (``response_mime_type`` from 0.5,
+   ``response_schema`` from 0.6). With older versions it is None and the
+   prompt's own format instructions are all the model gets.
+2. ``parse`` strips code fences and any text around the JSON, then parses it.
+   Control characters inside strings are accepted.
+3. If the text still doesn't parse, a local repair drops trailing commas and
+   closes a truncated object. A reply cut off inside a string value is not
+   accepted this way, since its last field would be half a sentence. The
+   result is validated against the schema.
+4. If it is still malformed or fails validation, the model is asked to fix
+   it, at most ``max_repairs`` times. Only then is the raw text returned, as
+   before.
+
+``parser()`` returns an ``IncrementalJSONParser`` for streaming endpoints. It
+is fed the text as it arrives and returns the value parsed so far, with
+unfinished strings and containers closed, so clients can render quiz
+questions or reply fields before the stream ends.
+"""
+import dataclasses
+import json
+import logging
+import os
+import re
+
+from google.generativeai.types import generation_types
+
+from gemini_client import generate_text
+from metrics import STRUCTURED_OUTPUT
+
+logger = logging.getLogger(__name__)
+
+_CONFIG_FIELDS = {field.name for field in dataclasses.fields(generation_types.GenerationConfig)}
+JSON_MODE_AVAILABLE = 'response_mime_type' in _CONFIG_FIELDS
+RESPONSE_SCHEMA_AVAILABLE = 'response_schema' in _CONFIG_FIELDS
+
+# Model calls allowed per reply to fix malformed JSON (0 disables)
+STRUCTURED_OUTPUT_REPAIRS = int(os.getenv('STRUCTURED_OUTPUT_REPAIRS', '1'))
+
+# Strings are matched first so commas inside them are left alone
+_TRAILING_COMMA = re.compile(r'("(?:[^"\\]|\\.)*")|,(\s*[}\]])', re.DOTALL)
+_PARTIAL_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{0,3})?$')
+
+_PYTHON_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool,
+}
+
+REPAIR_PROMPT = """以下是一段應該符合指定JSON結構的輸出，但它無法解析或不符合結構。
+
+問題：
+{problems}
+
+JSON結構（JSON Schema）：
+{schema}
+
+原始輸出：
+{text}
+
+請修正這段輸出，保留原本的內容和語言，只輸出修正後的純JSON，不要使用 ``` 等markdown標記，也不要包含其他文字。"""
+
+
+def _string(description=None):
+    return {'type': 'string', 'description': description} if description else {'type': 'string'}
+
+
+def _object(properties, required=None):
+    return {'type': 'object', 'properties': properties, 'required': list(required or properties)}
+
+
+QUIZ_SCHEMA = _object({
+    '標題': _string(),
+    '問題': _string(),
+    '選項': _object({letter: _string() for letter in 'ABCD'}),
+    '答案': _string('選項字母，如：A 或 A,C'),
+    'explanation': _string(),
+})
+
+RESPONSE_SCHEMA = _object({
+    'feeling': _string(),
+    'knowledge': _string(),
+})
+
+ENCOURAGEMENT_SCHEMA = _object({
+    'analysis': _string(),
+    'type': _string(),
+    'encouragement1': _string(),
+    'encouragement2': _string(),
+    'encouragement3': _string(),
+})
+
+ENCOURAGEMENT_PACK_SCHEMA = {
+    'type': 'array',
+    'items': _object({'id': {'type': 'integer'}, **ENCOURAGEMENT_SCHEMA['properties']}),
+}
+
+
+def _json_tail(text):
+    """Return the reply from its first ``{`` or ``[`` to the end, code fences removed"""
+    clean_text = text.strip()
+    if '```' in clean_text:
+        start = clean_text.find('```')
+        start = clean_text.find('\n', start) + 1 if '\n' in clean_text[start:] else start + 3
+        end = clean_text.rfind('```')
+        clean_text = clean_text[start:end if end >= start else None].strip()
+    starts = [position for position in (clean_text.find('{'), clean_text.find('[')) if position != -1]
+    return clean_text[min(starts):] if starts else clean_text
+
+
+def extract_json(text):
+    """Return the JSON part of a reply: code fences and text around the outermost value removed"""
+    clean_text = _json_tail(text)
+    if clean_text[:1] not in ('{', '['):
+        return clean_text
+    end = clean_text.rfind('}' if clean_text[0] == '{' else ']')
+    return clean_text[:end + 1] if end > 0 else clean_text
+
+
+def validate(value, schema, path='$'):
+    """Return a list of the ways ``value`` doesn't match ``schema`` (a JSON Schema subset)"""
+    expected = schema.get('type', '').lower()
+    python_type = _PYTHON_TYPES.get(expected)
+    if python_type is not None and (not isinstance(value, python_type) or
+                                    (isinstance(value, bool) and expected != 'boolean')):
+        return [f"{path}: expected {expected}, got {type(value).__name__}"]
+    problems = []
+    if 'enum' in schema and value not in schema['enum']:
+        problems.append(f"{path}: {value!r} is not one of {schema['enum']}")
+    if expected == 'object':
+        for name in schema.get('required', ()):
+            if name not in value:
+                problems.append(f"{path}: missing field {name!r}")
+        for name, field_schema in schema.get('properties', {}).items():
+            if name in value:
+                problems.extend(validate(value[name], field_schema, f"{path}.{name}"))
+    elif expected == 'array' and 'items' in schema:
+        for position, item in enumerate(value):
+            problems.extend(validate(item, schema['items'], f"{path}[{position}]"))
+    return problems
+
+
+def _api_schema(schema):
+    """The schema as the Gemini API takes it: upper-case type names, no JSON Schema extras"""
+    converted = {}
+    for key, value in schema.items():
+        if key == 'type':
+            converted[key] = value.upper()
+        elif key == 'properties':
+            converted[key] = {name: _api_schema(field) for name, field in value.items()}
+        elif key == 'items':
+            converted[key] = _api_schema(value)
+        elif key in ('required', 'enum', 'description', 'nullable', 'format'):
+            converted[key] = value
+    return converted
+
+
+class IncrementalJSONParser:
+    """Parses a JSON value as its text streams in.
+
+    ``feed`` scans only the new text, tracking open strings and containers,
+    and returns the value parsed so far whenever it has grown, else None.
+    Text before the first ``{`` or ``[`` (such as a code fence) is skipped.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.value = None
+        self.done = False
+        self._position = 0
+        self._start = None
+        self._stack = []
+        self._expect_key = False
+        self._in_string = False
+        self._string_is_key = False
+        self._escaped = False
+        self._safe_end = None
+        self._safe_closers = ''
+        self._last_candidate = None
+
+    @property
+    def in_string_value(self):
+        """True if the text so far ends inside a string value"""
+        return self._in_string and not self._string_is_key and not self.done
+
+    def _closers(self):
+        return ''.join('}' if opener == '{' else ']' for opener in reversed(self._stack))
+
+    def _mark_safe(self, end):
+        self._safe_end = end
+        self._safe_closers = self._closers()
+
+    def feed(self, piece):
+        self.text += piece
+        if self.done:
+            return None
+        text = self.text
+        for position in range(self._position, len(text)):
+            char = text[position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if not self._string_is_key:
+                        self._mark_safe(position + 1)
+            elif self._start is None:
+                if char in '{[':
+                    self._start = position
+                    self._stack.append(char)
+                    self._expect_key = char == '{'
+                    self._mark_safe(position + 1)
+            elif char == '"':
+                self._in_string = True
+                self._string_is_key = self._stack[-1] == '{' and self._expect_key
+            elif char in '{[':
+                self._stack.append(char)
+                self._expect_key = char == '{'
+                self._mark_safe(position + 1)
+            elif char in '}]':
+                self._stack.pop()
+                # A closed value leaves its parent object waiting for a comma
+                self._expect_key = False
+                self._mark_safe(position + 1)
+                if not self._stack:
+                    self.done = True
+                    self._position = position + 1
+                    break
+            elif char == ',':
+                self._expect_key = self._stack[-1] == '{'
+                self._mark_safe(position)
+            elif char == ':':
+                self._expect_key = False
+        else:
+            self._position = len(text)
+        return self._snapshot()
+
+    def _snapshot(self):
+        if self._start is None:
+            return None
+        if self._in_string and not self._string_is_key and not self.done:
+            # Close the string being written so its text so far is included
+            body = _PARTIAL_ESCAPE.sub('', self.text[self._start:self._position])
+            candidate = body + '"' + self._closers()
+        else:
+            candidate = self.text[self._start:self._safe_end] + self._safe_closers
+        if candidate == self._last_candidate:
+            return None
+        self._last_candidate = candidate
+        try:
+            value = json.loads(candidate, strict=False)
+        except ValueError:
+            return None
+        if value == self.value:
+            return None
+        self.value = value
+        return value
+
+
+class StructuredOutput:
+    """A JSON reply format: the generation config that requests it and the parser that reads it"""
+
+    def __init__(self, name, schema, max_repairs=STRUCTURED_OUTPUT_REPAIRS):
+        self.name = name
+        self.schema = schema
+        self.max_repairs = max_repairs
+        self.generation_config = None
+        if JSON_MODE_AVAILABLE:
+            self.generation_config = {'response_mime_type': 'application/json'}
+            if RESPONSE_SCHEMA_AVAILABLE:
+                self.generation_config['response_schema'] = _api_schema(schema)
+
+    def _count(self, result):
+        STRUCTURED_OUTPUT.labels(self.name, result).inc()
+
+    def parser(self):
+        """Return a fresh incremental parser for one streamed reply"""
+        return IncrementalJSONParser()
+
+    def _load(self, text):
+        """Return (value, problems, repaired) for the reply text, repairing it locally if needed"""
+        clean_text = extract_json(text)
+        try:
+            value = json.loads(clean_text, strict=False)
+            repaired = False
+        except ValueError as e:
+            # Trailing commas, then a reply cut off before its closing brackets. The
+            # whole tail is used: trimming at the last bracket would drop every field
+            # after the last nested object or a bracket inside a string.
+            fixed = _TRAILING_COMMA.sub(lambda m: m.group(1) or m.group(2), _json_tail(text))
+            parser = IncrementalJSONParser()
+            parser.feed(fixed)
+            if parser.value is None:
+                return None, [f"invalid JSON: {e}"], False
+            value = parser.value
+            repaired = True
+            if parser.in_string_value:
+                return value, ["reply was cut off inside a string value"], True
+        return value, validate(value, self.schema), repaired
+
+    def parse(self, response_text):
+        """Return the reply as a validated JSON value, or the raw text if it can't be repaired"""
+        value, problems, repaired = self._load(response_text)
+        if not problems:
+            self._count('repaired_locally' if repaired else 'parsed')
+            return value
+
+        text = response_text
+        for _ in range(self.max_repairs):
+            logger.warning(f"{self.name} reply is malformed ({'; '.join(problems[:3])}), asking the model to fix it")
+            try:
+                text = generate_text(
+                    REPAIR_PROMPT.format(problems='\n'.join(problems), text=text,
+                                         schema=json.dumps(self.schema, ensure_ascii=False, indent=2)),
+                    generation_config=self.generation_config
+                ) or text
+            except Exception as e:
+                logger.error(f"Repairing the {self.name} reply failed: {str(e)}")
+                break
+            value, problems, _ = self._load(text)
+            if not problems:
+                self._count('repaired_by_model')
+                return value
+
+        logger.warning(f"{self.name} reply could not be parsed, returning the raw text")
+        self._count('failed')
+        return response_text
+
+
+QUIZ_OUTPUT = StructuredOutput('quiz', QUIZ_SCHEMA)
+RESPONSE_OUTPUT = StructuredOutput('response', RESPONSE_SCHEMA)
+ENCOURAGEMENT_OUTPUT = StructuredOutput('encouragement', ENCOURAGEMENT_SCHEMA)
+ENCOURAGEMENT_PACK_OUTPUT = StructuredOutput('encouragement pack', ENCOURAGEMENT_PACK_SCHEMA)
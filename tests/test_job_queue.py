@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from job_queue import JobQueue, JobQueueFull, JobStore
+
+ALLOWLIST = ['https://hooks.example.com/cknbook', 'http://10.0.0.5:8080/']
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(JobStore(directory=str(tmp_path)), max_workers=1, max_pending=2, webhook_allowlist=ALLOWLIST)
+
+
+@pytest.mark.parametrize('url', [
+    'https://hooks.example.com/cknbook',
+    'https://hooks.example.com/cknbook/',
+    'https://hooks.example.com/cknbook/jobs?id=1',
+    'https://HOOKS.example.com:443/cknbook/jobs',
+    'http://10.0.0.5:8080/anything',
+])
+def test_webhook_allowed(queue, url):
+    assert queue.webhook_allowed(url)
+
+
+@pytest.mark.parametrize('url', [
+    'http://hooks.example.com/cknbook',              # other scheme
+    'https://hooks.example.com:8443/cknbook',        # other port
+    'https://hooks.example.com/cknbook-evil',        # not under the path
+    'https://hooks.example.com/',                    # above the path
+    'https://hooks.example.com.evil.io/cknbook',     # other host
+    'https://user:pw@hooks.example.com/cknbook',     # credentials
+    'https://evil.io@hooks.example.com/cknbook',
+    'http://10.0.0.5/anything',                      # default port 80, not 8080
+    'http://10.0.0.5:99999/anything',                # invalid port
+    'ftp://hooks.example.com/cknbook',
+    'not a url',
+    '',
+    None,
+])
+def test_webhook_refused(queue, url):
+    assert not queue.webhook_allowed(url)
+
+
+def test_no_allowlist_refuses_every_webhook(tmp_path):
+    queue = JobQueue(JobStore(directory=str(tmp_path)), webhook_allowlist=['', 'javascript:alert(1)'])
+    assert queue.webhook_allowlist == []
+    assert not queue.webhook_allowed('https://hooks.example.com/cknbook')
+
+
+def _wait_for(queue, job_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job and job['status'] == status:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} never reached {status}")
+
+
+def test_job_records_result(queue):
+    job = queue.submit('quiz', lambda: {'標題': 't'})
+    assert job['status'] == 'queued'
+    assert _wait_for(queue, job['id'], 'done')['result'] == {'標題': 't'}
+
+
+def test_job_records_failure(queue):
+    def fail():
+        raise RuntimeError('boom')
+    job = queue.submit('quiz', fail)
+    assert 'error' in _wait_for(queue, job['id'], 'failed')
+
+
+def test_submit_refuses_beyond_max_pending(queue):
+    release = threading.Event()
+    first = queue.submit('quiz', lambda: release.wait(5))
+    second = queue.submit('quiz', lambda: release.wait(5))
+    with pytest.raises(JobQueueFull):
+        queue.submit('quiz', lambda: None)
+    release.set()
+    _wait_for(queue, first['id'], 'done')
+    _wait_for(queue, second['id'], 'done')
+    deadline = time.monotonic() + 5
+    while queue._pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    third = queue.submit('quiz', lambda: 'again')
+    assert _wait_for(queue, third['id'], 'done')['result'] == 'again'
+
+
+def test_unknown_or_malformed_job_id(queue):
+    assert queue.get('0' * 32) is None
+    assert queue.get('../../etc/passwd') is None
@@ -0,0 +1,34 @@
+from knowledge_store import KeywordIndex, parse_chapter
+
+
+def _chapters(*contents):
+    return [parse_chapter(f"第{day}天：章節.md", content) for day, content in enumerate(contents, start=1)]
+
+
+def test_postings_count_occurrences_per_chapter():
+    index = KeywordIndex(_chapters('蛋白質 蛋白質 脂肪', '脂肪', '維生素'), ['蛋白質', '脂肪'])
+    assert index.chapters_with('蛋白質') == {0: 2}
+    assert index.chapters_with('脂肪') == {0: 1, 1: 1}
+
+
+def test_unindexed_or_absent_term_has_no_chapters():
+    index = KeywordIndex(_chapters('蛋白質'), ['蛋白質', '纖維'])
+    assert index.chapters_with('纖維') == {}
+    assert index.chapters_with('not indexed') == {}
+
+
+def test_chapters_with_any_is_the_union():
+    index = KeywordIndex(_chapters('蛋白質', '脂肪', '維生素'), ['蛋白質', '脂肪', '維生素'])
+    assert index.chapters_with_any(['蛋白質', '維生素']) == {0, 2}
+    assert index.chapters_with_any([]) == set()
+
+
+def test_presence_scores_ignore_occurrence_counts():
+    index = KeywordIndex(_chapters('蛋白質 蛋白質 脂肪', '脂肪', '維生素'), ['蛋白質', '脂肪'])
+    assert index.presence_scores(['蛋白質', '脂肪'], 5) == {0: 10, 1: 5}
+
+
+def test_duplicate_terms_are_indexed_once():
+    index = KeywordIndex(_chapters('脂肪'), ['脂肪', '脂肪'])
+    assert list(index.postings) == ['脂肪']
+    assert index.size == 1
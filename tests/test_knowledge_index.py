@@ -0,0 +1,133 @@
+import os
+
+import pytest
+
+import knowledge_index
+from knowledge_store import KnowledgeStore
+
+CHAPTERS = {
+    '第1天：蛋白質.md': '第1天：蛋白質\n\n蛋白質是身體的建築材料，早餐多吃蛋白質更管飽。\n\n每公斤體重每天需要約一克蛋白質。',
+    '第2天：纖維.md': '第2天：纖維\n\n膳食纖維幫助消化，全穀類和蔬菜含有豐富的纖維。',
+    '第2課：纖維.md': '第2課：纖維\n\n膳食纖維幫助消化，全穀類和蔬菜含有豐富的纖維。',
+}
+
+
+@pytest.fixture
+def sources(tmp_path):
+    knowledge_dir = tmp_path / 'knowledge'
+    knowledge_dir.mkdir()
+    for filename, content in CHAPTERS.items():
+        (knowledge_dir / filename).write_text(content, encoding='utf-8')
+    book = tmp_path / 'book_knowledge.txt'
+    book.write_text('均衡飲食包括多種食物。', encoding='utf-8')
+    return knowledge_dir, book
+
+
+def _store(sources):
+    knowledge_dir, book = sources
+    return KnowledgeStore(knowledge_dir=str(knowledge_dir), book_knowledge_file=str(book))
+
+
+@pytest.fixture
+def index_path(sources, tmp_path):
+    store = _store(sources)
+    store.parse_sources()
+    path = str(tmp_path / 'knowledge.idx')
+    knowledge_index.write_index(store, path)
+    return path
+
+
+def test_round_trip_restores_store(sources, index_path):
+    parsed = _store(sources)
+    parsed.parse_sources()
+    opened = _store(sources)
+
+    assert knowledge_index.open_index(opened, index_path)
+    assert [chapter.filename for chapter in opened.chapters] == [chapter.filename for chapter in parsed.chapters]
+    assert [chapter.content for chapter in opened.chapters] == [chapter.content for chapter in parsed.chapters]
+    assert opened.general_knowledge == parsed.general_knowledge
+    assert opened.chunks == parsed.chunks
+    assert opened.chapter_for_day(2).filename == '第2天：纖維.md'
+    for query in ('蛋白質', '纖維 消化', '均衡飲食'):
+        assert opened.chunk_index.search(query) == pytest.approx(parsed.chunk_index.search(query))
+
+
+def test_postings_are_views_over_the_file(sources, index_path):
+    store = _store(sources)
+    assert knowledge_index.open_index(store, index_path)
+    assert isinstance(store.chunk_index.doc_ids, memoryview)
+    assert store.chunk_index.doc_ids.format == 'I'
+
+
+def test_sections_are_aligned(index_path):
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    assert data[:8] == knowledge_index.MAGIC
+    header_length = int.from_bytes(data[8:16], 'little')
+    header = knowledge_index.json.loads(data[16:16 + header_length])
+    assert header['version'] == knowledge_index.FORMAT_VERSION
+    for name, (offset, *_) in header['sections'].items():
+        assert offset % 8 == 0, name
+
+
+def test_edited_source_makes_index_stale(sources, index_path):
+    knowledge_dir, _ = sources
+    (knowledge_dir / '第1天：蛋白質.md').write_text('第1天：蛋白質\n\n改寫過的內容。', encoding='utf-8')
+    assert not knowledge_index.open_index(_store(sources), index_path)
+
+
+def test_touched_but_unchanged_source_keeps_index_fresh(sources, index_path):
+    knowledge_dir, _ = sources
+    path = knowledge_dir / '第1天：蛋白質.md'
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 5_000_000_000))
+    assert knowledge_index.open_index(_store(sources), index_path)
+
+
+def test_added_or_removed_source_makes_index_stale(sources, index_path):
+    knowledge_dir, _ = sources
+    (knowledge_dir / '第3天：脂肪.md').write_text('第3天：脂肪\n\n好的脂肪。', encoding='utf-8')
+    assert not knowledge_index.open_index(_store(sources), index_path)
+    os.unlink(knowledge_dir / '第3天：脂肪.md')
+    assert knowledge_index.open_index(_store(sources), index_path)
+    os.unlink(knowledge_dir / '第2課：纖維.md')
+    assert not knowledge_index.open_index(_store(sources), index_path)
+
+
+def test_missing_general_knowledge_file_is_tracked(sources, tmp_path):
+    _, book = sources
+    os.unlink(book)
+    store = _store(sources)
+    store.parse_sources()
+    path = str(tmp_path / 'no-book.idx')
+    knowledge_index.write_index(store, path)
+    assert knowledge_index.open_index(_store(sources), path)
+    book.write_text('新增的知識。', encoding='utf-8')
+    assert not knowledge_index.open_index(_store(sources), path)
+
+
+def test_other_version_or_foreign_file_is_rejected(sources, index_path, tmp_path):
+    with open(index_path, 'rb') as f:
+        data = f.read()
+    old = data.replace(b'"version": %d' % knowledge_index.FORMAT_VERSION, b'"version": 1', 1)
+    assert old != data
+    old_path = tmp_path / 'old.idx'
+    old_path.write_bytes(old)
+    assert not knowledge_index.open_index(_store(sources), str(old_path))
+
+    foreign = tmp_path / 'foreign.idx'
+    foreign.write_bytes(b'not an index at all')
+    assert not knowledge_index.open_index(_store(sources), str(foreign))
+
+    empty = tmp_path / 'empty.idx'
+    empty.write_bytes(b'')
+    assert not knowledge_index.open_index(_store(sources), str(empty))
+    assert not knowledge_index.open_index(_store(sources), str(tmp_path / 'missing.idx'))
+
+
+def test_load_rebuilds_and_rewrites_a_stale_index(sources, index_path):
+    knowledge_dir, _ = sources
+    (knowledge_dir / '第1天：蛋白質.md').write_text('第1天：蛋白質\n\n改寫過的內容。', encoding='utf-8')
+    store = _store(sources).load(index_path)
+    assert '改寫過的內容。' in store.chapters[0].content
+    assert knowledge_index.open_index(_store(sources), index_path)
@@ -0,0 +1,35 @@
+import pytest
+from flask import Flask
+
+import metrics
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.add_url_rule('/metrics', 'metrics', lambda: metrics.metrics_response(require_token=True))
+    app.add_url_rule('/dev-metrics', 'dev_metrics', metrics.metrics_response)
+    return app.test_client()
+
+
+def test_hidden_without_a_configured_token(client, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', '')
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/dev-metrics').status_code in (200, 503)
+
+
+@pytest.mark.parametrize('header', [None, 'Bearer wrong', 'Bearer s3cret2', 's3cret', 'Basic s3cret'])
+def test_refuses_missing_or_wrong_token(client, monkeypatch, header):
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 's3cret')
+    response = client.get('/metrics', headers={'Authorization': header} if header else {})
+    assert response.status_code == 401
+    assert response.headers['WWW-Authenticate'] == 'Bearer'
+
+
+def test_serves_metrics_with_the_token(client, monkeypatch):
+    if not metrics.PROMETHEUS_AVAILABLE:
+        pytest.skip("prometheus_client is not installed")
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 's3cret')
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    assert b'cknbook_cache_requests' in response.data
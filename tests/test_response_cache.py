@@ -0,0 +1,125 @@
+import importlib.util
+import os
+import time
+
+import pytest
+
+from response_cache import REDIS_AVAILABLE, RedisCache, ResponseCache, create_cache_backend, make_cache_key
+
+
+@pytest.fixture(scope='module')
+def fake_redis():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', 'fake_redis_server.py')
+    spec = importlib.util.spec_from_file_location('fake_redis_server', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    server = module.serve(port=0)
+    yield f"redis://127.0.0.1:{server.server_address[1]}/0"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def redis_cache(fake_redis):
+    if not REDIS_AVAILABLE:
+        pytest.skip("redis package is not installed")
+    cache = RedisCache(fake_redis, ttl_seconds=60, prefix='test:')
+    cache.clear()
+    return cache
+
+
+def test_cache_key_depends_on_model_and_every_part():
+    key = make_cache_key('model', 'prompt', {'mime_type': 'image/png', 'data': b'x'})
+    assert key == make_cache_key('model', 'prompt', {'mime_type': 'image/png', 'data': b'x'})
+    assert key != make_cache_key('other', 'prompt', {'mime_type': 'image/png', 'data': b'x'})
+    assert key != make_cache_key('model', 'prompt', {'mime_type': 'image/jpeg', 'data': b'x'})
+    assert key != make_cache_key('model', 'prompt', {'mime_type': 'image/png', 'data': b'y'})
+    assert make_cache_key('model', 'ab', 'c') != make_cache_key('model', 'a', 'bc')
+    assert make_cache_key('model', 'a', None) == make_cache_key('model', 'a')
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    assert cache.get('a') == '1'
+    cache.set('c', '3')
+    assert cache.get('b') is None
+    assert cache.get('a') == '1'
+    assert cache.get('c') == '3'
+
+
+def test_memory_cache_expires_entries():
+    cache = ResponseCache(ttl_seconds=60)
+    cache.set('short', 'v', ttl_seconds=0.01)
+    cache.set('long', 'v')
+    time.sleep(0.02)
+    assert cache.get('short') is None
+    assert cache.get('long') == 'v'
+
+
+def test_memory_cache_add_only_when_absent():
+    cache = ResponseCache()
+    assert cache.add('lock', 'a')
+    assert not cache.add('lock', 'b')
+    assert cache.get('lock') == 'a'
+    cache.delete('lock')
+    assert cache.add('lock', 'c')
+
+
+def test_memory_cache_disabled_with_no_entries():
+    cache = ResponseCache(max_entries=0)
+    cache.set('a', '1')
+    assert cache.get('a') is None
+
+
+def test_redis_cache_round_trip(redis_cache):
+    assert redis_cache.shared
+    assert redis_cache.get('missing') is None
+    redis_cache.set('key', '營養')
+    assert redis_cache.get('key') == '營養'
+    redis_cache.delete('key')
+    assert redis_cache.get('key') is None
+
+
+def test_redis_cache_expires_entries(redis_cache):
+    redis_cache.set('short', 'v', ttl_seconds=0.05)
+    assert redis_cache.get('short') == 'v'
+    time.sleep(0.1)
+    assert redis_cache.get('short') is None
+
+
+def test_redis_cache_add_is_set_if_absent(redis_cache):
+    assert redis_cache.add('lock', 'a', ttl_seconds=5)
+    assert not redis_cache.add('lock', 'b', ttl_seconds=5)
+    assert redis_cache.get('lock') == 'a'
+
+
+def test_redis_cache_clear_only_removes_its_prefix(redis_cache, fake_redis):
+    other = RedisCache(fake_redis, prefix='other:')
+    other.set('kept', 'v')
+    redis_cache.set('a', '1')
+    redis_cache.set('b', '2')
+    redis_cache.clear()
+    assert redis_cache.get('a') is None
+    assert redis_cache.get('b') is None
+    assert other.get('kept') == 'v'
+
+
+def test_redis_cache_degrades_to_misses_when_unreachable():
+    if not REDIS_AVAILABLE:
+        pytest.skip("redis package is not installed")
+    cache = RedisCache('redis://127.0.0.1:1/0', socket_timeout=0.2)
+    cache.set('key', 'v')
+    assert cache.get('key') is None
+    assert not cache.add('key', 'v')
+    cache.delete('key')
+    assert cache.errors == 4
+
+
+def test_create_cache_backend_follows_redis_url(monkeypatch, fake_redis):
+    monkeypatch.delenv('REDIS_URL', raising=False)
+    assert isinstance(create_cache_backend(), ResponseCache)
+    monkeypatch.setenv('REDIS_URL', fake_redis)
+    backend = create_cache_backend(prefix='test:')
+    assert isinstance(backend, RedisCache if REDIS_AVAILABLE else ResponseCache)
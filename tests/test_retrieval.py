@@ -0,0 +1,71 @@
+from array import array
+
+from retrieval import BM25Index, tokenize
+
+DOCUMENTS = [
+    '蛋白質是身體的建築材料，早餐多吃蛋白質更管飽。',
+    '膳食纖維幫助消化，全穀類和蔬菜含有豐富的纖維。',
+    '維生素C存在於水果中，Vitamin C helps absorb iron.',
+]
+
+
+def test_tokenize_cjk_runs_into_bigrams_and_trigrams():
+    assert tokenize('蛋白質') == ['蛋白', '白質', '蛋白質']
+
+
+def test_tokenize_keeps_single_cjk_character():
+    assert tokenize('蛋') == ['蛋']
+
+
+def test_tokenize_lowercases_latin_words_and_drops_punctuation():
+    assert tokenize('Vitamin C，B12!') == ['vitamin', 'c', 'b12']
+
+
+def test_search_ranks_matching_document_first():
+    index = BM25Index(DOCUMENTS)
+    results = index.search('蛋白質')
+    assert results[0][0] == 0
+    assert all(position != 1 for position, _ in results)
+
+
+def test_search_matches_latin_terms_case_insensitively():
+    assert BM25Index(DOCUMENTS).search('VITAMIN')[0][0] == 2
+
+
+def test_search_with_no_known_terms_returns_nothing():
+    assert BM25Index(DOCUMENTS).search('xyz') == []
+    assert BM25Index([]).search('蛋白質') == []
+
+
+def test_search_respects_top_k():
+    index = BM25Index(DOCUMENTS)
+    assert len(index.search('蛋白質 纖維 維生素')) == 3
+    assert len(index.search('蛋白質 纖維 維生素', top_k=1)) == 1
+
+
+def test_higher_term_frequency_scores_higher():
+    index = BM25Index(['纖維 纖維 纖維 其他', '纖維 其他 其他 其他'])
+    scores = dict(index.search('纖維'))
+    assert scores[0] > scores[1]
+
+
+def test_postings_are_flat_arrays():
+    index = BM25Index(['甲乙', '乙丙甲乙'])
+    term_id = index.terms['甲乙']
+    start, end = index.offsets[term_id], index.offsets[term_id + 1]
+    assert list(index.doc_ids[start:end]) == [0, 1]
+    assert list(index.term_freqs[start:end]) == [1, 1]
+    assert list(index.doc_lengths) == [1, 5]
+    assert len(index.offsets) == len(index.terms) + 1
+
+
+def test_from_arrays_scores_like_the_built_index():
+    built = BM25Index(DOCUMENTS, k1=1.2, b=0.6)
+    arrays = {
+        name: memoryview(array(typecode, getattr(built, name)).tobytes()).cast(typecode)
+        for name, typecode in (('offsets', 'I'), ('doc_ids', 'I'), ('term_freqs', 'H'),
+                               ('doc_lengths', 'I'), ('idf', 'f'))
+    }
+    loaded = BM25Index.from_arrays(dict(built.terms), k1=1.2, b=0.6, **arrays)
+    for query in ('蛋白質早餐', '纖維', 'vitamin 水果'):
+        assert [position for position, _ in loaded.search(query)] == [position for position, _ in built.search(query)]
@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+
+
+class SharedCache(ResponseCache):
+    """In-process cache that pretends to be shared, so two SingleFlights act as two workers"""
+    shared = True
+
+
+class BrokenCache(SharedCache):
+    def add(self, key, value, ttl_seconds=None):
+        self.errors += 1
+        return False
+
+
+def _run_concurrently(count, target):
+    results = [None] * count
+    errors = [None] * count
+
+    def run(position):
+        try:
+            results[position] = target()
+        except Exception as e:
+            errors[position] = e
+
+    threads = [threading.Thread(target=run, args=(position,)) for position in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results, errors
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return 'quiz'
+
+    threads, results, errors = _run_concurrently(8, lambda: flight.do('key', fn))
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1]
+    assert results == ['quiz'] * 8
+    assert errors == [None] * 8
+
+
+def test_waiters_get_the_leaders_exception():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError('upstream failed')
+
+    threads, results, errors = _run_concurrently(4, lambda: flight.do('key', fn))
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert all(isinstance(error, RuntimeError) for error in errors)
+
+
+def test_calls_after_completion_run_again():
+    flight = SingleFlight()
+    counter = iter(range(10))
+    assert flight.do('key', lambda: next(counter)) == 0
+    assert flight.do('key', lambda: next(counter)) == 1
+    assert flight._calls == {}
+
+
+def test_different_keys_do_not_wait_for_each_other():
+    flight = SingleFlight()
+    release = threading.Event()
+    threads, _, _ = _run_concurrently(1, lambda: flight.do('slow', lambda: release.wait(5)))
+    time.sleep(0.05)
+    assert flight.do('fast', lambda: 'done') == 'done'
+    release.set()
+    threads[0].join(5)
+
+
+def test_other_worker_waits_for_published_result():
+    backend = SharedCache()
+    leader = SingleFlight(backend, lock_ttl=5, poll_interval=0.01)
+    follower = SingleFlight(backend, lock_ttl=5, poll_interval=0.01)
+    release = threading.Event()
+    published = {}
+
+    def leader_fn():
+        release.wait(5)
+        published['value'] = 'from leader'
+        return 'from leader'
+
+    threads, results, _ = _run_concurrently(
+        1, lambda: leader.do('key', leader_fn, lookup=lambda: published.get('value'))
+    )
+    time.sleep(0.05)
+
+    def follower_fn():
+        raise AssertionError("follower should not call upstream")
+
+    follower_threads, follower_results, follower_errors = _run_concurrently(
+        1, lambda: follower.do('key', follower_fn, lookup=lambda: published.get('value'))
+    )
+    time.sleep(0.05)
+    release.set()
+    for thread in threads + follower_threads:
+        thread.join(5)
+    assert results == ['from leader']
+    assert follower_results == ['from leader']
+    assert follower_errors == [None]
+    assert backend.get('inflight:key') is None
+
+
+def test_lock_holder_checks_for_result_published_meanwhile():
+    flight = SingleFlight(SharedCache(), lock_ttl=5)
+    result = flight.do('key', lambda: pytest.fail("should use the published result"), lookup=lambda: 'cached')
+    assert result == 'cached'
+
+
+def test_gives_up_waiting_when_lock_is_never_released():
+    backend = SharedCache()
+    backend.add('inflight:key', 'someone else', 60)
+    flight = SingleFlight(backend, lock_ttl=0.1, poll_interval=0.02)
+    started = time.monotonic()
+    assert flight.do('key', lambda: 'own call', lookup=lambda: None) == 'own call'
+    assert time.monotonic() - started >= 0.1
+
+
+def test_backend_errors_skip_the_shared_lock():
+    flight = SingleFlight(BrokenCache(), lock_ttl=5, poll_interval=1)
+    started = time.monotonic()
+    assert flight.do('key', lambda: 'direct', lookup=lambda: None) == 'direct'
+    assert time.monotonic() - started < 0.5
+
+
+def test_unshared_backend_only_coalesces_in_process():
+    backend = ResponseCache()
+    flight = SingleFlight(backend)
+    assert flight.do('key', lambda: 'value', lookup=lambda: None) == 'value'
+    assert backend.get('inflight:key') is None
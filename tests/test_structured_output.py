@@ -0,0 +1,161 @@
+import pytest
+
+import structured_output
+from structured_output import (
+    QUIZ_OUTPUT,
+    RESPONSE_OUTPUT,
+    IncrementalJSONParser,
+    extract_json,
+    validate,
+)
+
+QUIZ_HEAD = ('{"標題": "第一天", "問題": "哪一個正確？", '
+             '"選項": {"A": "甲", "B": "乙", "C": "丙", "D": "丁"}, "答案": "A", ')
+
+
+@pytest.fixture
+def no_model(monkeypatch):
+    """Fail the test if a reply is sent to the model for repair"""
+    def generate_text(*args, **kwargs):
+        raise AssertionError("unexpected model repair call")
+    monkeypatch.setattr(structured_output, 'generate_text', generate_text)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1}', '{"a": 1}'),
+    ('```json\n{"a": 1}\n```', '{"a": 1}'),
+    ('Here it is: {"a": {"b": 2}} hope that helps', '{"a": {"b": 2}}'),
+    ('list: [1, 2] end', '[1, 2]'),
+    ('no json here', 'no json here'),
+])
+def test_extract_json(text, expected):
+    assert extract_json(text) == expected
+
+
+def test_validate_reports_missing_and_mistyped_fields():
+    problems = validate({'feeling': 1}, RESPONSE_OUTPUT.schema)
+    assert "$: missing field 'knowledge'" in problems
+    assert '$.feeling: expected string, got int' in problems
+    assert validate({'feeling': 'a', 'knowledge': 'b'}, RESPONSE_OUTPUT.schema) == []
+
+
+def test_validate_rejects_bool_for_integer():
+    assert validate(True, {'type': 'integer'}) == ['$: expected integer, got bool']
+
+
+def test_load_parses_fenced_reply(no_model):
+    value, problems, repaired = RESPONSE_OUTPUT._load('```json\n{"feeling": "好", "knowledge": "知"}\n```')
+    assert value == {'feeling': '好', 'knowledge': '知'}
+    assert problems == []
+    assert not repaired
+
+
+def test_load_drops_trailing_commas(no_model):
+    value, problems, repaired = RESPONSE_OUTPUT._load('{"feeling": "a, b", "knowledge": "c",}')
+    assert value == {'feeling': 'a, b', 'knowledge': 'c'}
+    assert problems == []
+    assert repaired
+
+
+def test_load_keeps_fields_after_nested_object_when_truncated(no_model):
+    # Cut before the closing brace: the last '}' closes 選項, not the reply
+    value, problems, repaired = QUIZ_OUTPUT._load(QUIZ_HEAD + '"explanation": "因為甲是對的"')
+    assert problems == []
+    assert repaired
+    assert value['答案'] == 'A'
+    assert value['explanation'] == '因為甲是對的'
+
+
+def test_load_keeps_fields_after_bracket_in_string_when_truncated(no_model):
+    value, problems, _ = RESPONSE_OUTPUT._load('{"feeling": "a } b", "knowledge": "c"')
+    assert value == {'feeling': 'a } b', 'knowledge': 'c'}
+    assert problems == []
+
+
+def test_load_flags_reply_cut_inside_nested_quiz_string(no_model):
+    value, problems, _ = QUIZ_OUTPUT._load(QUIZ_HEAD + '"explanation": "因為甲')
+    assert value['答案'] == 'A'
+    assert problems == ['reply was cut off inside a string value']
+
+
+def test_load_flags_flat_reply_cut_inside_string(no_model):
+    _, problems, _ = RESPONSE_OUTPUT._load('{"feeling": "很好", "knowledge": "cut off mid-sent')
+    assert problems == ['reply was cut off inside a string value']
+
+
+def test_parse_returns_raw_text_when_truncated_and_repairs_disabled(no_model, monkeypatch):
+    monkeypatch.setattr(RESPONSE_OUTPUT, 'max_repairs', 0)
+    text = '{"feeling": "很好", "knowledge": "cut off'
+    assert RESPONSE_OUTPUT.parse(text) == text
+
+
+def test_parse_asks_model_to_repair_truncated_reply(monkeypatch):
+    prompts = []
+
+    def generate_text(prompt, **kwargs):
+        prompts.append(prompt)
+        return '{"feeling": "很好", "knowledge": "完整的句子。"}'
+    monkeypatch.setattr(structured_output, 'generate_text', generate_text)
+    monkeypatch.setattr(RESPONSE_OUTPUT, 'max_repairs', 1)
+
+    value = RESPONSE_OUTPUT.parse('{"feeling": "很好", "knowledge": "完整')
+    assert value == {'feeling': '很好', 'knowledge': '完整的句子。'}
+    assert len(prompts) == 1
+    assert 'cut off inside a string value' in prompts[0]
+
+
+def _feed_all(pieces):
+    parser = IncrementalJSONParser()
+    values = [parser.feed(piece) for piece in pieces]
+    return parser, values
+
+
+def test_incremental_parser_skips_text_before_value():
+    parser, values = _feed_all(['```json\n', '{"a": 1}'])
+    assert values == [None, {'a': 1}]
+    assert parser.done
+
+
+def test_incremental_parser_closes_partial_string_value():
+    parser, values = _feed_all(['{"feeling": "好', '天氣'])
+    assert values == [{'feeling': '好'}, {'feeling': '好天氣'}]
+    assert parser.in_string_value
+    assert not parser.done
+
+
+def test_incremental_parser_leaves_out_partial_key():
+    parser, values = _feed_all(['{"a": "x", "kno'])
+    assert values == [{'a': 'x'}]
+    assert not parser.in_string_value
+
+
+def test_incremental_parser_reports_only_growth():
+    parser = IncrementalJSONParser()
+    # A number is only taken once something ends it
+    assert parser.feed('{"a": [1') == {'a': []}
+    assert parser.feed(', ') == {'a': [1]}
+    assert parser.feed('2') is None
+    assert parser.feed(']') == {'a': [1, 2]}
+
+
+def test_incremental_parser_drops_partial_escape():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"a": "x\\u00') == {'a': 'x'}
+    assert parser.feed('e9"}') == {'a': 'xé'}
+
+
+def test_incremental_parser_stops_at_end_of_value():
+    parser = IncrementalJSONParser()
+    assert parser.feed('[1, {"b": "}"}] trailing {') == [1, {'b': '}'}]
+    assert parser.done
+    assert parser.feed('more') is None
+    assert parser.value == [1, {'b': '}'}]
+
+
+def test_incremental_parser_matches_json_loads_one_char_at_a_time():
+    text = QUIZ_HEAD + '"explanation": "含有 \\"引號\\" 與 [括號]"}'
+    parser = IncrementalJSONParser()
+    for char in text:
+        parser.feed(char)
+    assert parser.done
+    assert parser.value == structured_output.json.loads(text)
@@ -0,0 +1,41 @@
+import io
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from uploads import ImageTooLarge, ImageUploadError, read_image_upload
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 32
+HEIC = b'\0\0\0\x18ftypheic' + b'\0' * 32
+
+
+def _upload(data, content_type, filename='photo'):
+    return FileStorage(io.BytesIO(data), filename=filename, content_type=content_type)
+
+
+@pytest.mark.parametrize('data, content_type, expected', [
+    (HEIC, 'application/octet-stream', 'image/heic'),
+    (PNG, 'image/jpeg', 'image/png'),
+    (PNG, '', 'image/png'),
+])
+def test_type_comes_from_the_file_not_the_browser(data, content_type, expected):
+    image = read_image_upload(_upload(data, content_type))
+    assert image == {'mime_type': expected, 'data': data}
+
+
+def test_non_image_is_rejected_whatever_its_content_type():
+    with pytest.raises(ImageUploadError) as error:
+        read_image_upload(_upload(b'%PDF-1.7 not an image', 'image/jpeg'))
+    assert error.value.status == 400
+
+
+def test_oversized_upload_is_rejected():
+    with pytest.raises(ImageTooLarge) as error:
+        read_image_upload(_upload(PNG + b'\0' * 100, 'image/png'), max_bytes=64)
+    assert error.value.status == 413
+
+
+def test_missing_or_empty_upload_is_no_image():
+    assert read_image_upload(None) is None
+    assert read_image_upload(_upload(PNG, 'image/png', filename='')) is None
+    assert read_image_upload(_upload(b'', 'image/png')) is None
@@ -0,0 +1,220 @@
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as api_exceptions
+
+import upstream_governor
+from upstream_governor import CircuitBreaker, DeadlinePassed, TokenBucket, UpstreamGovernor, UpstreamUnavailable
+
+
+class FakeTime:
+    """Stands in for the time module inside upstream_governor; only advanced by tests"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(upstream_governor, 'time', fake)
+    return fake
+
+
+def _open(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.is_open
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_through_after_reset_timeout(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    _open(breaker)
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_reopens_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    clock.now += 29
+    assert not breaker.allow()
+
+
+def test_released_trial_lets_the_next_call_try(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    _open(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release_trial()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_breaker_disabled_with_zero_threshold():
+    breaker = CircuitBreaker(failure_threshold=0)
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_token_bucket_allows_burst_then_refuses():
+    bucket = TokenBucket(rate=1, burst=2)
+    assert bucket.acquire(0)
+    assert bucket.acquire(0)
+    assert not bucket.acquire(0)
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(rate=50, burst=1)
+    assert bucket.acquire(0)
+    started = time.monotonic()
+    assert bucket.acquire(1)
+    assert time.monotonic() - started >= 0.01
+
+
+def test_token_bucket_disabled_with_zero_rate():
+    bucket = TokenBucket(rate=0, burst=1)
+    assert all(bucket.acquire(0) for _ in range(100))
+
+
+def test_retryable_errors_are_retried():
+    governor = UpstreamGovernor(max_retries=2, backoff_base=0.001, failure_threshold=10)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise api_exceptions.ServiceUnavailable('busy')
+        return 'ok'
+
+    assert governor.call(fn) == 'ok'
+    assert len(attempts) == 3
+    assert governor.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_client_errors_are_not_retried_or_counted():
+    governor = UpstreamGovernor(max_retries=2, failure_threshold=1)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        raise api_exceptions.InvalidArgument('bad request')
+
+    with pytest.raises(api_exceptions.InvalidArgument):
+        governor.call(fn)
+    assert len(attempts) == 1
+    assert governor.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_stops_retries_and_rejects():
+    governor = UpstreamGovernor(max_retries=5, backoff_base=0.001, failure_threshold=1, reset_timeout=60)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        raise api_exceptions.ServiceUnavailable('down')
+
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        governor.call(fn)
+    assert len(attempts) == 1
+    with pytest.raises(UpstreamUnavailable):
+        governor.call(fn)
+    assert len(attempts) == 1
+
+
+def test_expired_deadline_is_not_sent_and_not_counted():
+    governor = UpstreamGovernor(failure_threshold=1)
+    with pytest.raises(DeadlinePassed):
+        governor.call(lambda: pytest.fail("should not be sent"), deadline=time.monotonic())
+    assert governor.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_cancelled_trial_call_releases_the_trial(clock):
+    governor = UpstreamGovernor(failure_threshold=1, reset_timeout=30, max_retries=0)
+    governor.breaker.record_failure()
+    clock.now += 30
+
+    def cancelled():
+        raise api_exceptions.Cancelled('lost the hedge')
+
+    with pytest.raises(api_exceptions.Cancelled):
+        governor.call(cancelled)
+    assert governor.breaker.state == CircuitBreaker.HALF_OPEN
+    assert governor.call(lambda: 'ok') == 'ok'
+    assert governor.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retry_backoff_never_runs_past_deadline(monkeypatch):
+    monkeypatch.setattr(upstream_governor.random, 'uniform', lambda low, high: high)
+    governor = UpstreamGovernor(max_retries=5, backoff_base=10, backoff_cap=10, failure_threshold=10)
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        raise api_exceptions.ServiceUnavailable('busy')
+
+    started = time.monotonic()
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        governor.call(fn, deadline=started + 0.001)
+    assert time.monotonic() - started < 1
+    assert len(attempts) == 1
+
+
+def test_concurrency_cap_rejects_when_saturated():
+    governor = UpstreamGovernor(max_concurrency=1, queue_timeout=0.05)
+    holding = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        holding.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=lambda: governor.call(hold))
+    thread.start()
+    assert holding.wait(5)
+    with pytest.raises(UpstreamUnavailable):
+        governor.call(lambda: 'second')
+    release.set()
+    thread.join(5)
+    assert governor.call(lambda: 'third') == 'third'
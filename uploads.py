@@ -0,0 +1,82 @@
+"""Multipart image uploads for the reply endpoints.
+
+The page used to read the photo with ``readAsDataURL`` and post it
+base64-encoded inside the JSON body. That made the upload about a third
+larger, and the server kept the JSON text, the parsed string and the decoded
+image in memory together. The reply endpoints now also take
+``multipart/form-data`` with the photo as a file field. Werkzeug streams the
+file part into a spooled buffer: memory for small files, a temporary file
+above 500 KB. ``read_image_upload`` then reads at most ``max_bytes`` of it
+and hands the raw bytes to the model client as an image part, so nothing is
+base64-encoded or decoded anywhere.
+
+Whether a file is an image is decided from its magic bytes, not the
+browser's Content-Type: browsers often send HEIC/HEIF photos as
+``application/octet-stream``.
+
+Requests larger than ``MAX_REQUEST_BYTES`` (Flask's ``MAX_CONTENT_LENGTH``)
+are refused before their body is read.
+"""
+import os
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from image_prep import sniff_mime_type
+
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', str(8 * 1024 * 1024)))
+
+# Room for a base64 image in a JSON body (4/3 of the image) plus the text fields
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', str(MAX_IMAGE_BYTES * 4 // 3 + 1024 * 1024)))
+
+
+class ImageUploadError(ValueError):
+    """The uploaded image can't be used; ``status`` is the HTTP status to answer with"""
+
+    status = 400
+
+
+class ImageTooLarge(ImageUploadError):
+    status = 413
+
+
+def is_multipart(request):
+    return request.mimetype == 'multipart/form-data'
+
+
+def _too_large(max_bytes):
+    limit = f"{max_bytes // (1024 * 1024)}MB" if max_bytes >= 1024 * 1024 else f"{max_bytes // 1024}KB"
+    return ImageTooLarge(f"圖片過大，請上傳小於 {limit} 的圖片")
+
+
+def read_image_upload(upload, max_bytes=MAX_IMAGE_BYTES):
+    """Return an uploaded file as a ``{'mime_type', 'data'}`` image part with raw bytes, or None if empty"""
+    if upload is None or not upload.filename:
+        return None
+    data = upload.stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise _too_large(max_bytes)
+    if not data:
+        return None
+    mime_type = sniff_mime_type(data)
+    if mime_type is None:
+        raise ImageUploadError("只接受圖片檔案")
+    return {'mime_type': mime_type, 'data': data}
+
+
+def read_reply_request(request, max_bytes=MAX_IMAGE_BYTES):
+    """Return (text, image, tone) from a JSON body or a multipart form.
+
+    ``image`` is the base64 string of a JSON request, or an image part with
+    the raw bytes of a form upload.
+    """
+    try:
+        if is_multipart(request):
+            image = read_image_upload(request.files.get('image'), max_bytes)
+            return request.form.get('text', ''), image, request.form.get('tone', '')
+        data = request.json
+        image = data.get('image', '')
+        if image and len(image) * 3 // 4 > max_bytes:
+            raise _too_large(max_bytes)
+        return data.get('text', ''), image, data.get('tone', '')
+    except RequestEntityTooLarge:
+        raise _too_large(max_bytes)
@@ -0,0 +1,229 @@
+"""Admission control, retries and a circuit breaker for Gemini API calls.
+
+Every model call goes through ``UpstreamGovernor``:
+
+1. Circuit breaker: after ``failure_threshold`` consecutive upstream
+   failures (5xx, timeouts, quota exhaustion) calls fail fast with
+   ``UpstreamUnavailable`` for ``reset_timeout`` seconds. After that a
+   single trial call is let through; its outcome closes or re-opens the
+   breaker.
+2. Token bucket: at most ``rate`` calls per second per worker, with bursts
+   of ``burst``.
+3. Concurrency cap: at most ``max_concurrency`` calls in flight per worker.
+   Waiting for a token or a slot is bounded by ``queue_timeout``.
+4. Retries: retryable errors are retried up to ``max_retries`` times with
+   full-jitter exponential backoff, unless the breaker has opened meanwhile
+   or the backoff would run past the caller's deadline.
+
+Client errors (bad request, blocked content) are not retried and do not
+count against the breaker. Neither do calls whose deadline has already
+passed: they raise ``DeadlinePassed`` without being sent.
+"""
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from google.api_core import exceptions as api_exceptions
+
+from metrics import GEMINI_BREAKER_OPEN, GEMINI_BREAKER_OPENED, GEMINI_IN_FLIGHT, GEMINI_REJECTED, GEMINI_RETRIES
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.InternalServerError,
+    api_exceptions.BadGateway,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.GatewayTimeout,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling the API when the breaker is open or the worker is saturated"""
+
+
+class DeadlinePassed(Exception):
+    """Raised instead of calling the API when the caller's deadline is already over"""
+
+
+def is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class TokenBucket:
+    """Thread-safe token bucket; a rate of 0 disables it"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """Take one token, waiting up to ``timeout`` seconds; returns False on timeout"""
+        if self.rate <= 0:
+            return True
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker with a single half-open trial call"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go out now"""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                GEMINI_BREAKER_OPEN.set(0)
+                logger.info("Gemini circuit breaker closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and 0 < self.failure_threshold <= self.failures):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                GEMINI_BREAKER_OPENED.inc()
+                GEMINI_BREAKER_OPEN.set(1)
+                logger.warning(f"Gemini circuit breaker opened after {self.failures} failures; "
+                               f"failing fast for {self.reset_timeout}s")
+
+    def release_trial(self):
+        """End a half-open trial that finished without an upstream verdict"""
+        with self._lock:
+            self._trial_running = False
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN
+
+
+class UpstreamGovernor:
+    """Concurrency cap, rate limit, retry policy and circuit breaker for one upstream"""
+
+    def __init__(self, max_concurrency=32, rate=0.0, burst=10, queue_timeout=10.0,
+                 max_retries=2, backoff_base=0.5, backoff_cap=8.0,
+                 failure_threshold=5, reset_timeout=30):
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def _reject(self, reason, message):
+        GEMINI_REJECTED.labels(reason).inc()
+        raise UpstreamUnavailable(message)
+
+    @contextmanager
+    def admit(self, deadline=None):
+        """Hold a call slot for the duration of the block (one attempt, no retry).
+
+        Retryable errors raised inside the block count against the breaker;
+        anything else (including the caller abandoning a stream) does not.
+        Waiting for admission never runs past ``deadline`` (a monotonic time).
+        """
+        if deadline is not None and time.monotonic() >= deadline:
+            raise DeadlinePassed("Request deadline passed before the Gemini call")
+        if not self.breaker.allow():
+            self._reject('breaker_open', "Gemini API circuit breaker is open")
+        queue_timeout = self.queue_timeout
+        if deadline is not None:
+            queue_timeout = max(0.0, min(queue_timeout, deadline - time.monotonic()))
+        verdict = False
+        try:
+            if not self.bucket.acquire(queue_timeout):
+                self._reject('rate_limited', "Gemini API rate limit reached")
+            if not self._slots.acquire(timeout=queue_timeout):
+                self._reject('saturated', "Too many Gemini API calls in flight")
+            GEMINI_IN_FLIGHT.inc()
+            try:
+                yield
+            except (api_exceptions.Cancelled, DeadlinePassed):
+                # Cancelled by us (e.g. the losing half of a hedged call) or never sent: no verdict
+                raise
+            except Exception as e:
+                verdict = True
+                if is_retryable(e):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                raise
+            else:
+                verdict = True
+                self.breaker.record_success()
+            finally:
+                GEMINI_IN_FLIGHT.dec()
+                self._slots.release()
+        finally:
+            if not verdict:
+                self.breaker.release_trial()
+
+    def call(self, fn, deadline=None):
+        """Run ``fn()`` under admission control, retrying retryable errors with backoff"""
+        attempt = 0
+        while True:
+            try:
+                with self.admit(deadline):
+                    return fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries or self.breaker.is_open:
+                    raise
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                GEMINI_RETRIES.inc()
+                logger.warning(f"Retrying Gemini call in {delay:.2f}s (attempt {attempt + 1}): {e}")
+                time.sleep(delay)